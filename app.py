@@ -5,20 +5,58 @@ NOTE:
 1. This is a little longer task, so for v1 is still fast but later it can more deep,
    so we need a basic implementation of background tasks so that api call doesn't timeout.
 '''
-from datetime import datetime
-from fastapi import FastAPI, UploadFile, File, BackgroundTasks
+from contextlib import asynccontextmanager
+import asyncio
+from typing import List
+from fastapi import FastAPI, UploadFile, File, BackgroundTasks, Request
 from fastapi.middleware.cors import CORSMiddleware
-from utils.file_processor import process_uploaded_file, get_task_status_from_db
+from utils.file_processor import process_uploaded_file, process_batch_upload, get_task_status_from_db
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
-from database.get_client import get_client
+from fastapi.responses import HTMLResponse, Response, FileResponse, JSONResponse
+from database.get_client import get_client, close_client
+from database.repository import ensure_indexes, recover_interrupted_tasks
+from utils.log_sink import shutdown_writers
+from utils.metrics import render_metrics
+from utils.storage import get_storage, LocalStorage
+from utils.warmup import ReadinessGate, landing_page, warm_up, warmup_state
+from utils.health import install_executor, monitor_event_loop, liveness, readiness
 import uvicorn
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Count the jobs of asyncio.to_thread and watch the event-loop lag (readiness and liveness)
+    install_executor()
+    monitor_task = asyncio.create_task(monitor_event_loop())
+
+    # Get database connection
+    client = await get_client()
+
+    # Create the indexes and apply the log retention (idempotent)
+    await ensure_indexes(client)
+    
+    # Fail all tasks that were left in "processing" state, in a single update
+    interrupted_tasks = await recover_interrupted_tasks(client)
+    
+    print(f"Updated {interrupted_tasks} interrupted tasks due to server restart")
+
+    # Preload the landing page and the analysis stack, the readiness gate holds the requests until it is done
+    warmup_task = asyncio.create_task(warm_up())
+
+    yield
+
+    if not warmup_task.done():
+        warmup_task.cancel()
+    monitor_task.cancel()
+    # Write the buffered logs and progress updates before the process exits
+    await shutdown_writers()
+    close_client()
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Deep Analysis API",
     description="API for generating data analysis reports",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Add CORS middleware to allow cross-origin requests from the React app
@@ -30,15 +68,65 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Hold the requests until the worker is warmed up (outermost, so CORS preflights wait too)
+app.add_middleware(ReadinessGate)
+
 @app.get("/")
-def read_root():
-    return HTMLResponse(content=open("templates/index.html").read())
+async def read_root(request: Request):
+    # Served from memory, browsers revalidate it with its ETag
+    body, etag = landing_page.get()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(content=body, headers=headers)
 
 
 @app.get("/health")
-def health_check():
-    """Health check endpoint to verify the API is running"""
-    return {"status": "healthy"}
+@app.get("/health/live")
+async def health_check():
+    """Liveness: the event loop is running (503 when it has been stuck for LIVENESS_MAX_STALL_SECONDS)"""
+    alive, body = liveness()
+    return JSONResponse(content=body, status_code=200 if alive else 503)
+
+@app.get("/health/ready")
+async def readiness_check():
+    """Readiness: warmed up, with event-loop lag, analyses, executor and memory within limits (503 otherwise)"""
+    ready, body = readiness(warmup_state["status"])
+    return JSONResponse(content=body, status_code=200 if ready else 503)
+
+@app.get("/warmup")
+def warmup_status():
+    """Warm-up status of the worker, with the duration of each step and the import time of each module"""
+    return warmup_state
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus metrics: stage durations, task outcomes, debug attempts and cache lookups"""
+    body, content_type = render_metrics()
+    if body is None:
+        return Response(content="prometheus_client is not installed", status_code=503, media_type="text/plain")
+    return Response(content=body, media_type=content_type)
+
+@app.get("/storage/{container}/{blob:path}")
+def get_stored_blob(container: str, blob: str):
+    """Serve the files of the local storage backend (STORAGE_BACKEND=local) with their upload settings"""
+    try:
+        storage = get_storage()
+        blob_client = storage.get_blob_client(container, blob) if isinstance(storage, LocalStorage) else None
+    except ValueError:
+        # Azure not configured, or a name escaping the storage root
+        blob_client = None
+    if blob_client is None or not blob_client.exists():
+        return Response(content="Not found", status_code=404, media_type="text/plain")
+
+    metadata = blob_client.get_metadata()
+    headers = {}
+    if metadata.get("content_encoding"):
+        headers["Content-Encoding"] = metadata["content_encoding"]
+    if metadata.get("cache_control"):
+        headers["Cache-Control"] = metadata["cache_control"]
+    return FileResponse(blob_client.path, media_type=metadata.get("content_type") or "application/octet-stream",
+                        headers=headers)
 
 @app.post("/analyze/")
 async def analyze_data(
@@ -49,30 +137,17 @@ async def analyze_data(
     Upload a CSV file and start the analysis process in the background
     """
     return await process_uploaded_file(file, background_tasks)
-@app.on_event("startup")
-async def startup_event():
-    # Get database connection
-    client = await get_client()
-    db = client["Python-Data-Analyst"]
-    tasks_collection = db["analysis_tasks"]
-    
-    # Find all tasks that were left in "processing" state
-    interrupted_tasks = await tasks_collection.find(
-        {"status": "processing"}
-    ).to_list(length=None)
-    
-    # Update their status to indicate server restart
-    for task in interrupted_tasks:
-        await tasks_collection.update_one(
-            {"task_id": task["task_id"]},
-            {"$set": {
-                "status": "failed",
-                "message": "Analysis was interrupted due to server resource constraints. Please try again later in 5 minutes.",
-                "updated_at": datetime.now()
-            }}
-        )
-    
-    print(f"Updated {len(interrupted_tasks)} interrupted tasks due to server restart")
+
+@app.post("/analyze/batch")
+async def analyze_batch(
+    files: List[UploadFile] = File(...),
+    background_tasks: BackgroundTasks = None
+):
+    """
+    Upload several CSV files, or zip archives of CSVs, and analyze them as one batch in the background.
+    GET /task/{task_id} of the returned task gives the aggregate progress, its children are regular tasks
+    """
+    return await process_batch_upload(files, background_tasks)
 
 @app.get("/task/{task_id}")
 async def get_task_status(task_id: str):
@@ -0,0 +1,104 @@
+'''
+Synthetic datasets for the benchmarks.
+
+Note:
+1. A DatasetSpec sets the shape of the CSV: rows, how many numeric/categorical/date/text columns, the cardinality
+   of the categorical columns and the share of missing values. Generation is seeded, a spec always gives the same file.
+2. Columns are named by kind (amount_0, segment_0, date_0, note_0...), the stub agents write their KPIs and code
+   from these names (see stubs.py).
+'''
+
+import os
+from dataclasses import dataclass, asdict
+import numpy as np
+import pandas as pd
+
+
+@dataclass
+class DatasetSpec:
+    rows: int = 10000
+    numeric: int = 6
+    categorical: int = 4
+    dates: int = 1
+    text: int = 0
+    cardinality: int = 20
+    null_ratio: float = 0.0
+    seed: int = 42
+
+    def numeric_columns(self) -> list:
+        return [f"amount_{i}" for i in range(self.numeric)]
+
+    def categorical_columns(self) -> list:
+        return [f"segment_{i}" for i in range(self.categorical)]
+
+    def date_columns(self) -> list:
+        return [f"date_{i}" for i in range(self.dates)]
+
+    def text_columns(self) -> list:
+        return [f"note_{i}" for i in range(self.text)]
+
+    def file_name(self) -> str:
+        return (f"bench_{self.rows}r_{self.numeric}n_{self.categorical}c_{self.dates}d_{self.text}t_"
+                f"{self.cardinality}k_{int(self.null_ratio * 100)}null_{self.seed}.csv")
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def generate_dataset(spec: DatasetSpec) -> pd.DataFrame:
+    """
+    This function is used to generate the dataframe described by a spec.
+
+    Args:
+        spec: DatasetSpec - Shape of the dataset
+
+    Returns:
+        pd.DataFrame - The dataset
+    """
+    rng = np.random.default_rng(spec.seed)
+    columns = {}
+
+    for i, column in enumerate(spec.numeric_columns()):
+        # Mix of integer counts and skewed float amounts, like the sales/finance files we get
+        if i % 3 == 2:
+            columns[column] = rng.poisson(5 + i, spec.rows)
+        else:
+            columns[column] = np.round(rng.lognormal(3 + i % 4, 0.8, spec.rows), 2)
+
+    for i, column in enumerate(spec.categorical_columns()):
+        labels = np.array([f"{column}_{j}" for j in range(spec.cardinality)])
+        # Zipf-like weights, a few categories dominate
+        weights = 1 / np.arange(1, spec.cardinality + 1)
+        columns[column] = rng.choice(labels, spec.rows, p=weights / weights.sum())
+
+    for i, column in enumerate(spec.date_columns()):
+        days = rng.integers(0, 3 * 365, spec.rows)
+        columns[column] = (pd.Timestamp("2022-01-01") + pd.to_timedelta(days, unit="D")).strftime("%Y-%m-%d")
+
+    for i, column in enumerate(spec.text_columns()):
+        words = np.array(["late", "damaged", "great", "refund", "fast", "support", "price", "quality"])
+        columns[column] = [" ".join(rng.choice(words, 4)) for _ in range(spec.rows)]
+
+    df = pd.DataFrame(columns)
+    if spec.null_ratio > 0:
+        for column in spec.numeric_columns() + spec.categorical_columns():
+            df.loc[rng.random(spec.rows) < spec.null_ratio, column] = None
+    return df
+
+
+def write_dataset(spec: DatasetSpec, directory: str) -> str:
+    """
+    This function is used to write the CSV of a spec, it is reused when it already exists.
+
+    Args:
+        spec: DatasetSpec - Shape of the dataset
+        directory: str - Where to write it
+
+    Returns:
+        str - Path of the CSV
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, spec.file_name())
+    if not os.path.exists(path):
+        generate_dataset(spec).to_csv(path, index=False)
+    return path
@@ -0,0 +1,445 @@
+'''
+HTTP load tests of the API: how many concurrent analyses one worker supports.
+
+Usage:
+    python -m benchmarks.load                                  # 1, 2, 4 and 8 concurrent analyses, in-process
+    python -m benchmarks.load --concurrency 4 16 --pollers 20  # other levels, more clients polling /task
+    python -m benchmarks.load --mode localhost                 # through uvicorn and a real socket
+    python -m benchmarks.load --sizes 10000 200000 --agent-latency 1
+
+Note:
+1. The requests go to app.app with the stand-ins of stubs.py (MongoDB, model calls) and the local storage backend
+   in a temporary directory, so nothing leaves the machine. --mode inprocess sends them through an ASGI transport
+   in the same event loop, --mode localhost starts uvicorn on a free port in a thread of the same process.
+2. Each concurrency level runs in a fresh process and simulates:
+   - upload clients: each one uploads a CSV (sizes are taken in turn from --sizes) with a multipart POST /analyze/,
+     waits for its analysis to finish and uploads the next one, so the level is the number of running analyses,
+   - --pollers clients polling GET /task/{task_id} of the running analyses every --poll-interval,
+   - --landing-clients clients loading the landing page every --landing-interval.
+3. Reported per level: latency percentiles (p50/p95/p99/max) and error rate per endpoint, analysis durations and
+   throughput, the event-loop lag of the server (how late a periodic timer of the server loop fires, measured on
+   the loop that runs the app) and the peak RSS of the process (in-process, client and server share it).
+4. A level is within the SLO when no request failed and the p95 of the polls, the landing page and the event-loop
+   lag are under --slo-ms: the last level within it is the number of concurrent analyses a worker supports.
+'''
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field, asdict
+from unittest import mock
+from benchmarks.datasets import DatasetSpec, write_dataset
+from benchmarks.run import DATA_DIR, REPO_ROOT, StubSettings, peak_rss_mb
+from utils.memory_budget import process_memory, MB
+
+# Statuses of a finished analysis
+TERMINAL_STATUSES = ("completed", "failed")
+
+
+@dataclass
+class LoadProfile:
+    concurrency: int = 1
+    # Analyses per upload client, one after the other
+    uploads_per_client: int = 1
+    sizes: list = field(default_factory=lambda: [5000, 20000, 50000])
+    pollers: int = 10
+    poll_interval: float = 0.5
+    landing_clients: int = 2
+    landing_interval: float = 0.2
+    mode: str = "inprocess"
+    # Seconds before the unfinished analyses are given up
+    timeout: float = 600.0
+    lag_interval: float = 0.05
+
+
+def percentiles(values: list) -> dict:
+    """
+    Nearest-rank p50/p95/p99 and max of a list of seconds, in milliseconds.
+    """
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    ordered = sorted(values)
+
+    def rank(share):
+        return round(ordered[min(len(ordered) - 1, max(0, int(share * len(ordered) + 0.5) - 1))] * 1000, 1)
+
+    return {"p50": rank(0.50), "p95": rank(0.95), "p99": rank(0.99), "max": round(ordered[-1] * 1000, 1)}
+
+
+class RequestStats:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, endpoint: str, latency: float, ok: bool):
+        self.latencies.setdefault(endpoint, []).append(latency)
+        if not ok:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def summary(self) -> dict:
+        return {
+            endpoint: {
+                "requests": len(latencies),
+                "errors": self.errors.get(endpoint, 0),
+                "error_rate": round(self.errors.get(endpoint, 0) / len(latencies), 4),
+                **percentiles(latencies),
+            }
+            for endpoint, latencies in self.latencies.items()
+        }
+
+
+class DetachedBackgroundApp:
+    """
+    ASGI wrapper that returns as soon as the response is sent.
+
+    httpx's ASGITransport waits for the whole app call, which includes the background tasks of the response (the
+    analysis of POST /analyze/). The wrapper runs the call in a task and returns once the last body chunk is sent,
+    the background tasks keep running like behind a real server.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.tasks = set()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        response_sent = asyncio.Event()
+
+        async def detached_send(message):
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                response_sent.set()
+
+        task = asyncio.create_task(self.app(scope, receive, detached_send))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        task.add_done_callback(lambda _: response_sent.set())
+        await response_sent.wait()
+        if task.done() and task.exception() is not None:
+            raise task.exception()
+
+
+async def monitor_loop(samples: dict, interval: float, stop: threading.Event):
+    """
+    Measure the lag of the loop it runs on (how late a timer fires) and the RSS of the process until stop is set.
+    """
+    while not stop.is_set():
+        expected = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        samples["lag"].append(max(0.0, time.perf_counter() - expected))
+        rss, _ = process_memory()
+        if rss is not None:
+            samples["rss"] = max(samples["rss"], rss)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(app, samples: dict, profile: LoadProfile, stop: threading.Event):
+    """
+    This function is used to run the app with uvicorn in a thread, with the lag monitor on the server loop.
+
+    Returns:
+        tuple - (base URL, uvicorn server, thread)
+    """
+    import uvicorn
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+
+    def serve():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.create_task(monitor_loop(samples, profile.lag_interval, stop))
+        loop.run_until_complete(server.serve())
+        loop.close()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("uvicorn failed to start")
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}", server, thread
+
+
+async def run_load(profile: LoadProfile, settings: StubSettings, data_paths: list) -> dict:
+    """
+    This function is used to run one concurrency level against the app.
+
+    Args:
+        profile: LoadProfile - The traffic to simulate
+        settings: StubSettings - Settings of the stand-ins
+        data_paths: list - CSVs uploaded in turn
+
+    Returns:
+        dict - The measurements of the level
+    """
+    import httpx
+    import app as app_module
+    import database.get_client
+    import utils.file_processor
+    from benchmarks.stubs import InMemoryMongoClient, StubRunner, stub_services
+    from utils.storage import LocalStorage
+
+    client = InMemoryMongoClient(settings.db_latency)
+
+    async def get_client():
+        return client
+
+    storage = LocalStorage(root=tempfile.mkdtemp(prefix="analysis-load-storage-"))
+    runner = StubRunner(DatasetSpec(), settings.agent_latency, settings.ttft_ratio, settings.jitter,
+                        settings.debug_ratio)
+    uploads = []
+    for path in data_paths:
+        with open(path, "rb") as file:
+            uploads.append((os.path.basename(path), file.read()))
+    upload_cycle = itertools.cycle(uploads)
+
+    stats = RequestStats()
+    samples = {"lag": [], "rss": 0}
+    stop = threading.Event()
+    # task_id -> [upload time, status, finish time]
+    analyses = {}
+    rss_before = peak_rss_mb()
+
+    async def timed(http, endpoint: str, method: str, url: str, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await http.request(method, url, **kwargs)
+            ok = response.status_code < 400
+        except httpx.HTTPError:
+            response, ok = None, False
+        stats.record(endpoint, time.perf_counter() - start, ok)
+        return response if ok else None
+
+    async def upload_client(http):
+        for _ in range(profile.uploads_per_client):
+            name, content = next(upload_cycle)
+            response = await timed(http, "POST /analyze/", "POST", "/analyze/",
+                                   files={"file": (name, content, "text/csv")})
+            if response is None:
+                continue
+            task_id = response.json()["task_id"]
+            analyses[task_id] = [time.perf_counter(), "pending", None]
+            # The next upload starts when the pollers see this one finished
+            while analyses[task_id][1] not in TERMINAL_STATUSES:
+                await asyncio.sleep(profile.poll_interval / 2)
+
+    async def poller(http, done: asyncio.Event):
+        while not done.is_set():
+            running = [task_id for task_id, state in analyses.items() if state[1] not in TERMINAL_STATUSES]
+            if running:
+                task_id = random.choice(running)
+                response = await timed(http, "GET /task/{id}", "GET", f"/task/{task_id}")
+                if response is not None:
+                    status = response.json().get("status")
+                    if status in TERMINAL_STATUSES and analyses[task_id][1] not in TERMINAL_STATUSES:
+                        analyses[task_id][2] = time.perf_counter()
+                    analyses[task_id][1] = status
+            await asyncio.sleep(profile.poll_interval * random.uniform(0.5, 1.5))
+
+    async def landing_client(http, done: asyncio.Event):
+        while not done.is_set():
+            await timed(http, "GET /", "GET", "/")
+            await asyncio.sleep(profile.landing_interval * random.uniform(0.5, 1.5))
+
+    async def drive(http):
+        # Traffic starts once the worker is warmed up, the readiness gate would hold the first requests
+        while (await http.get("/warmup")).json().get("status") not in ("ready", "degraded"):
+            await asyncio.sleep(0.05)
+        done = asyncio.Event()
+        background = [asyncio.create_task(poller(http, done)) for _ in range(max(1, profile.pollers))]
+        background += [asyncio.create_task(landing_client(http, done)) for _ in range(profile.landing_clients)]
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.gather(*(upload_client(http) for _ in range(profile.concurrency))),
+                                   profile.timeout)
+        except asyncio.TimeoutError:
+            pass
+        wall_seconds = time.perf_counter() - start
+        done.set()
+        await asyncio.gather(*background)
+        return wall_seconds
+
+    with stub_services(runner, storage), \
+            mock.patch.object(app_module, "get_client", get_client), \
+            mock.patch.object(utils.file_processor, "get_client", get_client), \
+            mock.patch.object(database.get_client, "get_client", get_client):
+        if profile.mode == "localhost":
+            base_url, server, thread = start_server(app_module.app, samples, profile, stop)
+            try:
+                async with httpx.AsyncClient(base_url=base_url, timeout=profile.timeout) as http:
+                    wall_seconds = await drive(http)
+            finally:
+                stop.set()
+                server.should_exit = True
+                thread.join()
+        else:
+            asgi_app = DetachedBackgroundApp(app_module.app)
+            monitor = asyncio.create_task(monitor_loop(samples, profile.lag_interval, stop))
+            async with app_module.app.router.lifespan_context(app_module.app):
+                transport = httpx.ASGITransport(app=asgi_app)
+                async with httpx.AsyncClient(transport=transport, base_url="http://load.test",
+                                             timeout=profile.timeout) as http:
+                    wall_seconds = await drive(http)
+                # Analyses given up after the timeout still run, they are cancelled with the level
+                for task in list(asgi_app.tasks):
+                    task.cancel()
+            stop.set()
+            await monitor
+
+    finished = [state[2] - state[0] for state in analyses.values() if state[2] is not None]
+    rss_after = peak_rss_mb()
+    return {
+        "concurrency": profile.concurrency,
+        "mode": profile.mode,
+        "analyses": len(analyses),
+        "completed": sum(state[1] == "completed" for state in analyses.values()),
+        "failed": sum(state[1] == "failed" for state in analyses.values()),
+        "unfinished": sum(state[1] not in TERMINAL_STATUSES for state in analyses.values()),
+        "wall_seconds": round(wall_seconds, 4),
+        "analyses_per_minute": round(len(finished) * 60 / wall_seconds, 2) if wall_seconds else None,
+        "analysis_seconds": {key: round(value / 1000, 3) if value is not None else None
+                             for key, value in percentiles(finished).items()},
+        "requests": stats.summary(),
+        "event_loop_lag_ms": percentiles(samples["lag"]),
+        "peak_rss_mb": rss_after,
+        "max_sampled_rss_mb": round(samples["rss"] / MB, 1) if samples["rss"] else None,
+        "rss_growth_mb": round(rss_after - rss_before, 1) if rss_after is not None else None,
+    }
+
+
+def run_child(profile: LoadProfile, settings: StubSettings, data_paths: list, result_file: str):
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    os.environ["STORAGE_BACKEND"] = "local"
+    # The chart code writes its image files in the working directory, the landing page is read from it
+    os.chdir(tempfile.mkdtemp(prefix="analysis-load-"))
+    os.symlink(os.path.join(REPO_ROOT, "templates"), "templates")
+    sys.path.insert(0, REPO_ROOT)
+    result = asyncio.run(run_load(profile, settings, data_paths))
+    with open(result_file, "w") as file:
+        json.dump(result, file)
+
+
+def run_in_subprocess(profile: LoadProfile, settings: StubSettings, data_paths: list, verbose: bool = False) -> dict:
+    """
+    This function is used to run one concurrency level in a fresh process.
+    """
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as file:
+        result_file = file.name
+    command = [sys.executable, "-m", "benchmarks.load", "--child", "--result-file", result_file,
+               "--profile", json.dumps(asdict(profile)), "--settings", json.dumps(asdict(settings)),
+               "--data-paths", *data_paths]
+    try:
+        completed = subprocess.run(command, cwd=REPO_ROOT, stdout=None if verbose else subprocess.DEVNULL,
+                                   stderr=None if verbose else subprocess.PIPE, text=True)
+        if completed.returncode != 0:
+            raise RuntimeError(f"Concurrency {profile.concurrency} failed:\n{completed.stderr or ''}")
+        with open(result_file) as file:
+            return json.load(file)
+    finally:
+        os.remove(result_file)
+
+
+def within_slo(result: dict, slo_ms: float) -> bool:
+    if result["unfinished"] or any(stats["errors"] for stats in result["requests"].values()):
+        return False
+    checked = [stats["p95"] for endpoint, stats in result["requests"].items() if endpoint != "POST /analyze/"]
+    checked.append(result["event_loop_lag_ms"]["p95"])
+    return all(value is None or value <= slo_ms for value in checked)
+
+
+def print_result(result: dict, slo_ms: float):
+    seconds = result["analysis_seconds"]
+    print(f"\n{result['concurrency']} concurrent analyses ({result['mode']}): {result['completed']} completed, "
+          f"{result['failed']} failed, {result['unfinished']} unfinished in {result['wall_seconds']}s "
+          f"({result['analyses_per_minute']} analyses/min, analysis p50 {seconds['p50']}s p95 {seconds['p95']}s)")
+    for endpoint, stats in result["requests"].items():
+        print(f"  {endpoint:<16} {stats['requests']:>5} requests, {stats['error_rate']:.1%} errors, "
+              f"p50 {stats['p50']} ms, p95 {stats['p95']} ms, p99 {stats['p99']} ms, max {stats['max']} ms")
+    lag = result["event_loop_lag_ms"]
+    print(f"  event-loop lag   p50 {lag['p50']} ms, p95 {lag['p95']} ms, p99 {lag['p99']} ms, max {lag['max']} ms")
+    print(f"  peak RSS {result['peak_rss_mb']} MB (+{result['rss_growth_mb']} MB during the run), "
+          f"{'within' if within_slo(result, slo_ms) else 'over'} the {slo_ms:.0f} ms SLO")
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="HTTP load tests of the API with stubbed backends")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8],
+                        help="Concurrent analyses (upload clients), one run per level")
+    parser.add_argument("--uploads-per-client", type=int, default=LoadProfile.uploads_per_client,
+                        help="Analyses each upload client runs one after the other")
+    parser.add_argument("--sizes", type=int, nargs="+", default=LoadProfile().sizes,
+                        help="Rows of the uploaded CSVs, used in turn")
+    parser.add_argument("--pollers", type=int, default=LoadProfile.pollers, help="Clients polling /task/{id}")
+    parser.add_argument("--poll-interval", type=float, default=LoadProfile.poll_interval,
+                        help="Seconds between the polls of a client")
+    parser.add_argument("--landing-clients", type=int, default=LoadProfile.landing_clients,
+                        help="Clients loading the landing page")
+    parser.add_argument("--landing-interval", type=float, default=LoadProfile.landing_interval,
+                        help="Seconds between the landing page loads of a client")
+    parser.add_argument("--mode", choices=["inprocess", "localhost"], default=LoadProfile.mode,
+                        help="ASGI transport in the same loop, or uvicorn on a local port")
+    parser.add_argument("--timeout", type=float, default=LoadProfile.timeout,
+                        help="Seconds before the unfinished analyses of a level are given up")
+    parser.add_argument("--slo-ms", type=float, default=500.0,
+                        help="p95 of the polls, the landing page and the event-loop lag a level must stay under")
+    parser.add_argument("--agent-latency", type=float, default=StubSettings.agent_latency,
+                        help="Seconds per model call")
+    parser.add_argument("--debug-ratio", type=float, default=StubSettings.debug_ratio,
+                        help="Share of the generated code that fails on its first run")
+    parser.add_argument("--db-latency", type=float, default=StubSettings.db_latency,
+                        help="Seconds per database call")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the app")
+    # Internal: one level in a fresh process
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    parser.add_argument("--profile", help=argparse.SUPPRESS)
+    parser.add_argument("--settings", help=argparse.SUPPRESS)
+    parser.add_argument("--data-paths", nargs="+", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        run_child(LoadProfile(**json.loads(args.profile)), StubSettings(**json.loads(args.settings)),
+                  args.data_paths, args.result_file)
+        return 0
+
+    # Uploads always go through the local storage backend, the analyses read them back from its files
+    settings = StubSettings(agent_latency=args.agent_latency, debug_ratio=args.debug_ratio,
+                            db_latency=args.db_latency, storage="local")
+    data_paths = [write_dataset(DatasetSpec(rows=rows), DATA_DIR) for rows in args.sizes]
+
+    results = []
+    for concurrency in args.concurrency:
+        profile = LoadProfile(concurrency, args.uploads_per_client, args.sizes, args.pollers, args.poll_interval,
+                              args.landing_clients, args.landing_interval, args.mode, args.timeout)
+        results.append(run_in_subprocess(profile, settings, data_paths, args.verbose))
+        print_result(results[-1], args.slo_ms)
+
+    supported = [result["concurrency"] for result in results if within_slo(result, args.slo_ms)]
+    print(f"\nHighest level within the SLO: "
+          f"{f'{max(supported)} concurrent analyses' if supported else 'none'}")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"settings": asdict(settings), "slo_ms": args.slo_ms, "levels": results}, file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
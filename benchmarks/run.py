@@ -0,0 +1,388 @@
+'''
+Offline end-to-end benchmarks of run_analysis.
+
+Usage:
+    python -m benchmarks.run                          # every scenario, checked against benchmarks/baselines.json
+    python -m benchmarks.run --scenario small wide    # some scenarios
+    python -m benchmarks.run --agent-latency 2        # slower model calls
+    python -m benchmarks.run --update-baseline        # store the results as the new baselines
+
+Note:
+1. Each scenario generates its synthetic CSV (datasets.py) and runs run_analysis on it with the stand-ins of
+   stubs.py, so no OpenAI, MongoDB or Azure access is needed. The CSV is read from the local disk (with
+   --storage local, through the local storage backend), the HTTP download of the Azure backend is not measured.
+2. Every run is a separate process, so the peak RSS is the one of the scenario and module level settings
+   (CHART_*, thresholds...) can be changed per scenario through its env. Results are the median of --repeat runs.
+3. Reported: wall time, task duration, per-stage totals (from the task document), throughput (rows per second and tasks per
+   minute), peak RSS, uploaded bytes, model tokens and the model calls per agent.
+4. baselines.json stores the results and the regression thresholds. A run fails (exit code 1) when a scenario is
+   slower, uses more memory or has a lower throughput than its baseline by more than the threshold. Baselines are
+   only compared when they were recorded with the same stub settings, and they depend on the machine: record them
+   on the machine that runs the check.
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field, asdict
+from benchmarks.datasets import DatasetSpec, write_dataset
+from utils.storage import METADATA_SUFFIX
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCHMARKS_DIR)
+BASELINES_FILE = os.path.join(BENCHMARKS_DIR, "baselines.json")
+DATA_DIR = os.path.join(tempfile.gettempdir(), "analysis-benchmarks")
+
+# Allowed relative regression before a check fails, stored with the baselines
+DEFAULT_THRESHOLDS = {
+    "time": 0.25,
+    "memory": 0.20,
+    "throughput": 0.20,
+    # Stages shorter than this are reported but not checked, they are mostly noise
+    "min_stage_seconds": 0.05,
+    # Timings must also be this many seconds slower, a few milliseconds are a large share of a short stage
+    "min_time_delta": 0.1,
+}
+
+
+@dataclass
+class Scenario:
+    description: str
+    spec: DatasetSpec
+    env: dict = field(default_factory=dict)
+    # Analyses of the same file run concurrently in the process
+    tasks: int = 1
+
+
+SCENARIOS = {
+    "small": Scenario("10k rows, 11 columns", DatasetSpec(rows=10000)),
+    "wide": Scenario("20k rows, 80 columns (per-KPI column pruning)",
+                     DatasetSpec(rows=20000, numeric=60, categorical=19, dates=1)),
+    "large": Scenario("500k rows, 16 columns, 1000 categories",
+                      DatasetSpec(rows=500000, numeric=10, categorical=5, dates=1, cardinality=1000)),
+    "high_cardinality": Scenario("200k rows, 50k categories, 5% missing values",
+                                 DatasetSpec(rows=200000, numeric=4, categorical=3, cardinality=50000,
+                                             null_ratio=0.05)),
+    "combined": Scenario("small with the batch combined agent", DatasetSpec(rows=10000),
+                         env={"COMBINED_CODEGEN": "batch"}),
+    "out_of_core": Scenario("300k rows through the out-of-core mode", DatasetSpec(rows=300000, text=1),
+                            env={"OUT_OF_CORE_THRESHOLD_MB": "1"}),
+    "concurrent": Scenario("4 concurrent analyses of 50k rows", DatasetSpec(rows=50000), tasks=4),
+}
+
+
+@dataclass
+class StubSettings:
+    agent_latency: float = 0.2
+    ttft_ratio: float = 0.3
+    jitter: float = 0.0
+    debug_ratio: float = 0.0
+    db_latency: float = 0.0
+    blob_latency: float = 0.0
+    # memory (in-memory stand-in, the CSV is read from its path) or local (the local storage backend)
+    storage: str = "memory"
+
+
+def peak_rss_mb() -> float:
+    """
+    Return the peak resident memory of this process in MB (None where it can't be measured).
+    """
+    # ru_maxrss survives fork + exec on Linux (the child would report the peak of the runner that generated the
+    # datasets), VmHWM belongs to the address space of this process only
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def stored_bytes(storage) -> int:
+    """
+    Total size of the blobs of a benchmark storage (the upload settings files of the local backend excluded).
+    """
+    if hasattr(storage, "uploaded_bytes"):
+        return storage.uploaded_bytes()
+    total = 0
+    for directory, _, files in os.walk(storage.root):
+        total += sum(os.path.getsize(os.path.join(directory, name)) for name in files
+                     if not name.endswith(METADATA_SUFFIX))
+    return total
+
+
+async def run_scenario(scenario: Scenario, settings: StubSettings, data_path: str) -> dict:
+    """
+    This function is used to run the analyses of a scenario against the stand-ins.
+
+    Args:
+        scenario: Scenario - The scenario
+        settings: StubSettings - Latency and failure settings of the stand-ins
+        data_path: str - The CSV
+
+    Returns:
+        dict - The measurements of the run
+    """
+    from benchmarks.stubs import InMemoryMongoClient, InMemoryBlobServiceClient, StubRunner, stub_services
+    from database.repository import insert_task, find_task
+    from utils.file_processor import run_analysis
+    from utils.storage import LocalStorage
+
+    client = InMemoryMongoClient(settings.db_latency)
+    if settings.storage == "local":
+        # The real local backend: the CSV is stored like an upload and read back memory-mapped
+        storage = LocalStorage(root=tempfile.mkdtemp(prefix="analysis-benchmark-storage-"))
+        blob_client = storage.get_blob_client("images-analysis", os.path.basename(data_path))
+        with open(data_path, "rb") as file:
+            blob_client.upload_blob(file, overwrite=True)
+        file_url = blob_client.url
+    else:
+        storage = InMemoryBlobServiceClient(latency=settings.blob_latency)
+        file_url = data_path
+    runner = StubRunner(scenario.spec, settings.agent_latency, settings.ttft_ratio, settings.jitter,
+                        settings.debug_ratio)
+
+    task_ids = [f"benchmark-{index}" for index in range(scenario.tasks)]
+    for task_id in task_ids:
+        await insert_task(client, {"task_id": task_id, "status": "pending", "progress": 0.0})
+
+    rss_before = peak_rss_mb()
+    with stub_services(runner, storage):
+        start = time.perf_counter()
+        await asyncio.gather(*(run_analysis(task_id, file_url, client) for task_id in task_ids))
+        wall_seconds = time.perf_counter() - start
+
+    documents = [await find_task(client, task_id) for task_id in task_ids]
+    stage_totals = {}
+    for document in documents:
+        for stage, seconds in document.get("stage_totals", {}).items():
+            stage_totals.setdefault(stage, []).append(seconds)
+    rows = scenario.spec.rows * len(task_ids)
+    rss_after = peak_rss_mb()
+
+    return {
+        "tasks": len(task_ids),
+        "completed": sum(document.get("status") == "completed" for document in documents),
+        "wall_seconds": round(wall_seconds, 4),
+        "task_seconds": round(statistics.median(document.get("duration", wall_seconds) for document in documents), 4),
+        "rows_per_second": round(rows / wall_seconds, 1),
+        "tasks_per_minute": round(len(task_ids) * 60 / wall_seconds, 2),
+        "peak_rss_mb": rss_after,
+        "rss_growth_mb": round(rss_after - rss_before, 1) if rss_after is not None else None,
+        "uploaded_bytes": stored_bytes(storage) - (os.path.getsize(data_path) if settings.storage == "local" else 0),
+        "llm_tokens": sum(document.get("llm_usage", {}).get("total", {}).get("input_tokens", 0)
+                          + document.get("llm_usage", {}).get("total", {}).get("output_tokens", 0)
+                          for document in documents),
+        "agent_calls": runner.calls,
+        "stage_totals": {stage: round(statistics.median(values), 4) for stage, values in stage_totals.items()},
+    }
+
+
+def run_child(name: str, settings: StubSettings, data_path: str, result_file: str):
+    # Module level settings of the app are read at import time
+    os.environ.update(SCENARIOS[name].env)
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    os.environ.setdefault("BLOB_STORAGE_ACCOUNT_KEY", "benchmark")
+    import utils.file_processor
+    import utils.services
+
+    # The chart code writes its image files in the working directory
+    os.chdir(tempfile.mkdtemp(prefix="analysis-benchmark-"))
+    result = asyncio.run(run_scenario(SCENARIOS[name], settings, data_path))
+    with open(result_file, "w") as file:
+        json.dump(result, file)
+
+
+def run_in_subprocess(name: str, settings: StubSettings, data_path: str, verbose: bool = False) -> dict:
+    """
+    This function is used to run one repeat of a scenario in a fresh process.
+
+    Args:
+        name: str - The scenario
+        settings: StubSettings - Settings of the stand-ins
+        data_path: str - The CSV
+        verbose: bool - Show the output of the app
+
+    Returns:
+        dict - The measurements of the run
+    """
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as file:
+        result_file = file.name
+    command = [sys.executable, "-m", "benchmarks.run", "--child", name, "--data-path", data_path,
+               "--result-file", result_file, "--settings", json.dumps(asdict(settings))]
+    try:
+        completed = subprocess.run(command, cwd=REPO_ROOT, stdout=None if verbose else subprocess.DEVNULL,
+                                   stderr=None if verbose else subprocess.PIPE, text=True)
+        if completed.returncode != 0:
+            raise RuntimeError(f"Scenario {name} failed:\n{completed.stderr or ''}")
+        with open(result_file) as file:
+            return json.load(file)
+    finally:
+        os.remove(result_file)
+
+
+def median_result(results: list) -> dict:
+    """
+    Combine the repeats of a scenario, numeric measurements are the median of the repeats.
+    """
+    combined = dict(results[-1])
+    for key, value in results[-1].items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            values = [result[key] for result in results if result.get(key) is not None]
+            combined[key] = round(statistics.median(values), 4) if values else None
+    stages = {stage for result in results for stage in result["stage_totals"]}
+    combined["stage_totals"] = {
+        stage: round(statistics.median(result["stage_totals"].get(stage, 0) for result in results), 4)
+        for stage in sorted(stages)
+    }
+    combined["repeats"] = len(results)
+    return combined
+
+
+def compare(name: str, result: dict, baseline: dict, thresholds: dict) -> list:
+    """
+    This function is used to check a scenario against its baseline.
+
+    Args:
+        name: str - The scenario
+        result: dict - The measurements
+        baseline: dict - The stored measurements
+        thresholds: dict - Allowed relative regressions
+
+    Returns:
+        list - One message per regression
+    """
+    checks = [
+        ("wall_seconds", "time", True),
+        ("peak_rss_mb", "memory", True),
+        ("rows_per_second", "throughput", False),
+    ]
+    for stage, seconds in baseline.get("stage_totals", {}).items():
+        if seconds >= thresholds["min_stage_seconds"]:
+            checks.append((stage, "time", True))
+
+    regressions = []
+    for metric, kind, lower_is_better in checks:
+        is_stage = metric not in result
+        current = result["stage_totals"].get(metric) if is_stage else result[metric]
+        reference = baseline["stage_totals"].get(metric) if is_stage else baseline.get(metric)
+        if current is None or not reference:
+            continue
+        change = (current - reference) / reference
+        if kind == "time" and current - reference <= thresholds["min_time_delta"]:
+            continue
+        if (lower_is_better and change > thresholds[kind]) or (not lower_is_better and -change > thresholds[kind]):
+            label = f"stage {metric}" if is_stage else metric
+            regressions.append(f"{name}: {label} {reference} -> {current} ({change:+.0%}, threshold {thresholds[kind]:.0%})")
+    return regressions
+
+
+def print_result(name: str, result: dict):
+    print(f"\n{name}: {SCENARIOS[name].description}")
+    print(f"  completed {result['completed']}/{result['tasks']} tasks in {result['wall_seconds']}s "
+          f"(task {result['task_seconds']}s, {result['rows_per_second']} rows/s, "
+          f"{result['tasks_per_minute']} tasks/min)")
+    print(f"  peak RSS {result['peak_rss_mb']} MB (+{result['rss_growth_mb']} MB during the run), "
+          f"uploaded {result['uploaded_bytes']} bytes, {result['llm_tokens']} model tokens")
+    print(f"  model calls: {', '.join(f'{agent} {count}' for agent, count in sorted(result['agent_calls'].items()))}")
+    slowest = sorted(result["stage_totals"].items(), key=lambda item: -item[1])[:8]
+    print(f"  slowest stages: {', '.join(f'{stage} {seconds}s' for stage, seconds in slowest)}")
+
+
+def load_baselines() -> dict:
+    if not os.path.exists(BASELINES_FILE):
+        return {"settings": None, "thresholds": DEFAULT_THRESHOLDS, "scenarios": {}}
+    with open(BASELINES_FILE) as file:
+        return json.load(file)
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmarks of run_analysis")
+    parser.add_argument("--scenario", nargs="+", choices=sorted(SCENARIOS), help="Scenarios to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per scenario, the median is reported")
+    parser.add_argument("--agent-latency", type=float, default=StubSettings.agent_latency,
+                        help="Seconds per model call")
+    parser.add_argument("--ttft-ratio", type=float, default=StubSettings.ttft_ratio,
+                        help="Share of the latency before the first token")
+    parser.add_argument("--jitter", type=float, default=StubSettings.jitter,
+                        help="Random +/- share of the latency")
+    parser.add_argument("--debug-ratio", type=float, default=StubSettings.debug_ratio,
+                        help="Share of the generated code that fails on its first run")
+    parser.add_argument("--db-latency", type=float, default=StubSettings.db_latency,
+                        help="Seconds per database call")
+    parser.add_argument("--blob-latency", type=float, default=StubSettings.blob_latency,
+                        help="Seconds per blob upload")
+    parser.add_argument("--storage", choices=["memory", "local"], default=StubSettings.storage,
+                        help="Storage backend: in-memory stand-in or the local filesystem backend")
+    parser.add_argument("--update-baseline", action="store_true", help="Store the results as the baselines")
+    parser.add_argument("--no-check", action="store_true", help="Don't compare with the baselines")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the app")
+    # Internal: one repeat of a scenario in a fresh process
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--data-path", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    parser.add_argument("--settings", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        run_child(args.child, StubSettings(**json.loads(args.settings)), args.data_path, args.result_file)
+        return 0
+
+    settings = StubSettings(args.agent_latency, args.ttft_ratio, args.jitter, args.debug_ratio, args.db_latency,
+                            args.blob_latency, args.storage)
+    baselines = load_baselines()
+    thresholds = {**DEFAULT_THRESHOLDS, **baselines.get("thresholds", {})}
+    check = not args.no_check and not args.update_baseline
+    if check and baselines.get("settings") != asdict(settings):
+        print("The baselines were recorded with other stub settings, they are not checked")
+        check = False
+
+    results = {}
+    regressions = []
+    for name in args.scenario or list(SCENARIOS):
+        data_path = write_dataset(SCENARIOS[name].spec, DATA_DIR)
+        repeats = [run_in_subprocess(name, settings, data_path, args.verbose) for _ in range(args.repeat)]
+        results[name] = median_result(repeats)
+        print_result(name, results[name])
+        if check and name in baselines["scenarios"]:
+            regressions += compare(name, results[name], baselines["scenarios"][name], thresholds)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"settings": asdict(settings), "scenarios": results}, file, indent=2)
+
+    if args.update_baseline:
+        scenarios = baselines["scenarios"] if baselines.get("settings") == asdict(settings) else {}
+        scenarios.update(results)
+        with open(BASELINES_FILE, "w") as file:
+            json.dump({"settings": asdict(settings), "thresholds": thresholds, "scenarios": scenarios}, file, indent=2)
+            file.write("\n")
+        print(f"\nBaselines written to {BASELINES_FILE}")
+
+    if regressions:
+        print("\nRegressions:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
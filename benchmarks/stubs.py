@@ -0,0 +1,391 @@
+'''
+In-memory stand-ins for MongoDB, Azure Blob Storage and the model calls, so run_analysis runs offline.
+
+Note:
+1. InMemoryMongoClient and InMemoryBlobServiceClient (a storage backend, see utils/storage.py) implement the
+   handful of methods the app uses, with an optional latency per operation to mimic a remote database/storage account.
+2. StubRunner replaces agents.Runner: it answers every agent with canned output (KPI names, analysis and chart code
+   that run on the synthetic datasets of datasets.py), streamed in chunks after a tunable latency, and reports a
+   token usage estimated from the prompt and the output. StubAsyncOpenAI does the same for the Business Analyst.
+3. debug_ratio is the share of generated code that fails on its first run, so the Debug agent path is exercised.
+4. stub_services patches the app modules and sets the storage backend for the duration of a benchmark.
+'''
+
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+from contextlib import ExitStack
+from types import SimpleNamespace
+from unittest import mock
+from agents.stream_events import RawResponsesStreamEvent
+from agents.usage import Usage
+from openai.types.responses import ResponseTextDeltaEvent
+from benchmarks.datasets import DatasetSpec
+from utils.prompt_builder import count_tokens
+from utils.schemas import KPI, KPICode, KPICodeBatch
+from utils.storage import StorageBackend, set_storage
+
+# Line added to the code that fails on purpose, the Debug agent stub removes it
+BROKEN_LINE = "benchmark_result = undefined_benchmark_variable\n"
+
+STREAM_CHUNKS = 8
+
+
+class InMemoryCursor:
+    def __init__(self, documents: list, latency: float = 0.0):
+        self.documents = documents
+        self.latency = latency
+
+    async def to_list(self, length: int = None) -> list:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.documents[:length] if length else self.documents
+
+
+class InMemoryCollection:
+    def __init__(self, full_name: str, latency: float = 0.0):
+        self.full_name = full_name
+        self.name = full_name.split(".", 1)[1]
+        self.latency = latency
+        self.documents = []
+
+    async def _wait(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def _matches(self, document: dict, query: dict) -> bool:
+        return all(document.get(key) in value["$in"] if isinstance(value, dict) and "$in" in value
+                   else document.get(key) == value for key, value in query.items())
+
+    async def insert_one(self, document: dict):
+        await self._wait()
+        # Like the driver, every stored document gets an _id
+        self.documents.append({"_id": uuid.uuid4().hex, **document})
+
+    async def insert_many(self, documents: list, ordered: bool = True):
+        await self._wait()
+        self.documents.extend({"_id": uuid.uuid4().hex, **document} for document in documents)
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False):
+        await self._wait()
+        for document in self.documents:
+            if self._matches(document, query):
+                document.update(update.get("$set", {}))
+                return SimpleNamespace(modified_count=1)
+        if upsert:
+            self.documents.append({**query, **update.get("$set", {})})
+        return SimpleNamespace(modified_count=0)
+
+    async def update_many(self, query: dict, update: dict):
+        await self._wait()
+        matched = [document for document in self.documents if self._matches(document, query)]
+        for document in matched:
+            document.update(update.get("$set", {}))
+        return SimpleNamespace(modified_count=len(matched))
+
+    async def find_one(self, query: dict):
+        await self._wait()
+        return next((dict(document) for document in self.documents if self._matches(document, query)), None)
+
+    def find(self, query: dict, projection: dict = None):
+        documents = [dict(document) for document in self.documents if self._matches(document, query)]
+        if projection:
+            fields = [field for field, include in projection.items() if include]
+            documents = [{field: document[field] for field in fields if field in document} for document in documents]
+        return InMemoryCursor(documents, self.latency)
+
+    async def create_index(self, *args, **kwargs):
+        return kwargs.get("name")
+
+    async def index_information(self) -> dict:
+        return {}
+
+
+class InMemoryDatabase:
+    def __init__(self, name: str, latency: float = 0.0):
+        self.name = name
+        self.latency = latency
+        self.collections = {}
+
+    def __getitem__(self, name: str) -> InMemoryCollection:
+        if name not in self.collections:
+            self.collections[name] = InMemoryCollection(f"{self.name}.{name}", self.latency)
+        return self.collections[name]
+
+    async def command(self, *args, **kwargs):
+        return {"ok": 1}
+
+
+class InMemoryMongoClient:
+    """
+    Stand-in for the motor client, client[database][collection].
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.databases = {}
+
+    def __getitem__(self, name: str) -> InMemoryDatabase:
+        if name not in self.databases:
+            self.databases[name] = InMemoryDatabase(name, self.latency)
+        return self.databases[name]
+
+    @property
+    def admin(self) -> InMemoryDatabase:
+        return self["admin"]
+
+
+class InMemoryBlobClient:
+    def __init__(self, store: dict, container: str, blob: str, latency: float = 0.0):
+        self.store = store
+        self.container = container
+        self.blob = blob
+        self.latency = latency
+        self.url = f"https://benchmark.blob.local/{container}/{blob}"
+
+    def upload_blob(self, data, overwrite: bool = False, content_settings=None, **kwargs):
+        if self.latency:
+            # The SDK calls are blocking, so is the stand-in
+            time.sleep(self.latency)
+        if isinstance(data, (bytes, bytearray)):
+            content = bytes(data)
+        elif hasattr(data, "read"):
+            content = data.read()
+        else:
+            content = b"".join(data)
+        self.store[(self.container, self.blob)] = content
+
+    def exists(self) -> bool:
+        return (self.container, self.blob) in self.store
+
+    def download_blob(self):
+        return SimpleNamespace(readall=lambda: self.store[(self.container, self.blob)])
+
+
+class InMemoryContainerClient:
+    def __init__(self, service, name: str):
+        self.service = service
+        self.name = name
+
+    def get_blob_client(self, blob: str) -> InMemoryBlobClient:
+        return self.service.get_blob_client(container=self.name, blob=blob)
+
+
+class InMemoryBlobServiceClient(StorageBackend):
+    """
+    Stand-in for the Azure storage backend, every client shares the store of the benchmark.
+    """
+
+    name = "memory"
+
+    def __init__(self, store: dict = None, latency: float = 0.0):
+        self.store = store if store is not None else {}
+        self.latency = latency
+
+    def get_container_client(self, container: str) -> InMemoryContainerClient:
+        return InMemoryContainerClient(self, container)
+
+    def get_blob_client(self, container: str, blob: str) -> InMemoryBlobClient:
+        return InMemoryBlobClient(self.store, container, blob, self.latency)
+
+    def uploaded_bytes(self) -> int:
+        return sum(len(content) for content in self.store.values())
+
+
+def benchmark_kpis(spec: DatasetSpec) -> list:
+    """
+    This function is used to pick the KPIs the stub Manager returns for a dataset.
+
+    Args:
+        spec: DatasetSpec - Shape of the dataset
+
+    Returns:
+        list - (kpi name, value column, group column) tuples
+    """
+    values = spec.numeric_columns() or ["amount_0"]
+    groups = spec.categorical_columns() or spec.date_columns()
+    kpis = []
+    for i, template in enumerate(["Total {value} by {group}", "Average {value} by {group}", "{value} by {group}"]):
+        value = values[i % len(values)]
+        # The last KPI groups by the same column as the first one, like real KPI sets do
+        group = groups[0] if i == 2 else groups[i % len(groups)]
+        kpis.append((template.format(value=value, group=group), value, group))
+    return kpis
+
+
+def analysis_code(value: str, group: str) -> str:
+    return (
+        f"result = aggregate('{group}', '{value}', ['sum', 'mean', 'count'])\n"
+        f"result = result.sort_values('sum', ascending=False)\n"
+        f"print(result.head(10).to_string())\n"
+        f"print('Share of the top group:', round(result['sum'].iloc[0] / result['sum'].sum() * 100, 2))\n"
+    )
+
+
+def chart_code(value: str, group: str) -> str:
+    return (
+        "import matplotlib.pyplot as plt\n"
+        f"data = aggregate('{group}', '{value}', 'sum').sort_values('{value}', ascending=False).head(15)\n"
+        "plt.figure(figsize=(10, 6))\n"
+        f"plt.bar(data['{group}'].astype(str), data['{value}'])\n"
+        "plt.xticks(rotation=45, ha='right')\n"
+        f"plt.title('{value} by {group}')\n"
+        "plt.tight_layout()\n"
+        "plt.close()\n"
+    )
+
+
+class StubRunResult:
+    """
+    Stand-in for RunResultStreaming.
+    """
+
+    def __init__(self, output, text: str, prompt: str, latency: float, ttft_ratio: float):
+        self.output = output
+        self.text = text
+        self.latency = latency
+        self.ttft_ratio = ttft_ratio
+        self.final_output = None
+        self.is_complete = False
+        self._cancelled = False
+        self.context_wrapper = SimpleNamespace(usage=Usage(requests=1, input_tokens=count_tokens(prompt)))
+
+    def cancel(self, mode: str = "immediate"):
+        self._cancelled = True
+        self.is_complete = True
+
+    async def stream_events(self):
+        size = max(1, -(-len(self.text) // STREAM_CHUNKS))
+        chunks = [self.text[i:i + size] for i in range(0, len(self.text), size)]
+        await asyncio.sleep(self.latency * self.ttft_ratio)
+        for index, chunk in enumerate(chunks):
+            if self._cancelled:
+                return
+            if index:
+                await asyncio.sleep(self.latency * (1 - self.ttft_ratio) / len(chunks))
+            self.context_wrapper.usage.output_tokens += count_tokens(chunk)
+            self.context_wrapper.usage.total_tokens = (self.context_wrapper.usage.input_tokens
+                                                       + self.context_wrapper.usage.output_tokens)
+            yield RawResponsesStreamEvent(data=ResponseTextDeltaEvent(
+                type="response.output_text.delta", delta=chunk, content_index=0, item_id="benchmark",
+                output_index=0, sequence_number=index, logprobs=[]
+            ))
+        self.final_output = self.output
+        self.is_complete = True
+
+
+class StubRunner:
+    """
+    Stand-in for agents.Runner, answers each agent with canned output.
+    """
+
+    def __init__(self, spec: DatasetSpec, latency: float = 0.5, ttft_ratio: float = 0.3, jitter: float = 0.0,
+                 debug_ratio: float = 0.0, seed: int = 42):
+        self.kpis = benchmark_kpis(spec)
+        self.latency = latency
+        self.ttft_ratio = ttft_ratio
+        self.jitter = jitter
+        self.debug_ratio = debug_ratio
+        self.random = random.Random(seed)
+        self.calls = {}
+
+    def _latency(self) -> float:
+        return max(0.0, self.latency * (1 + self.random.uniform(-self.jitter, self.jitter)))
+
+    def _kpis_in(self, prompt: str) -> list:
+        # KPI names are on their own line in every prompt
+        lines = set(prompt.splitlines())
+        return [kpi for kpi in self.kpis if kpi[0] in lines]
+
+    def _maybe_break(self, code: str) -> str:
+        return BROKEN_LINE + code if self.random.random() < self.debug_ratio else code
+
+    def _answer(self, agent_name: str, prompt: str):
+        kpis = self._kpis_in(prompt) or self.kpis[:1]
+        value, group = kpis[0][1], kpis[0][2]
+        if agent_name == "Manager":
+            output = KPI(kpi_names=[kpi[0] for kpi in self.kpis])
+            return output, output.model_dump_json()
+        if agent_name == "Data Analyst":
+            code = self._maybe_break(analysis_code(value, group))
+            return code, code
+        if agent_name == "Visualization Agent":
+            code = self._maybe_break(chart_code(value, group))
+            return code, code
+        if agent_name == "Debug Agent":
+            match = re.search(r"Current Code:\n(.*?)\n\nCurrent Error:", prompt, re.S)
+            code = match.group(1).replace(BROKEN_LINE, "") if match else analysis_code(value, group)
+            return code, code
+        if agent_name == "Combined Code Agent":
+            codes = [KPICode(kpi_name=name, analysis_code=self._maybe_break(analysis_code(v, g)),
+                             chart_code=self._maybe_break(chart_code(v, g))) for name, v, g in kpis]
+            output = KPICodeBatch(kpis=codes) if "KPIs to analyze" in prompt else codes[0]
+            return output, output.model_dump_json()
+        # Summary Agent
+        text = "Executive summary: " + " ".join(f"{name} is concentrated in a few groups." for name, _, _ in self.kpis)
+        return text, text
+
+    def run_streamed(self, agent, input, **kwargs) -> StubRunResult:
+        self.calls[agent.name] = self.calls.get(agent.name, 0) + 1
+        output, text = self._answer(agent.name, input)
+        return StubRunResult(output, text, input, self._latency(), self.ttft_ratio)
+
+    async def run(self, agent, input, **kwargs) -> StubRunResult:
+        result = self.run_streamed(agent, input, **kwargs)
+        async for _ in result.stream_events():
+            pass
+        return result
+
+
+class StubAsyncOpenAI:
+    """
+    Stand-in for the shared openai.AsyncOpenAI client, only the streamed responses.create of the Business Analyst.
+    """
+
+    def __init__(self, runner: StubRunner):
+        self.runner = runner
+        self.responses = SimpleNamespace(create=self._create)
+
+    async def _create(self, model: str, input: list, stream: bool = False, **kwargs):
+        self.runner.calls["Business Analyst"] = self.runner.calls.get("Business Analyst", 0) + 1
+        prompt = json.dumps([part.get("text", "") for message in input for part in message["content"]])
+        text = "The top groups account for most of the total, the long tail is flat. Focus on the leaders."
+        latency = self.runner._latency()
+        ttft_ratio = self.runner.ttft_ratio
+
+        async def events():
+            await asyncio.sleep(latency * ttft_ratio)
+            for word in text.split(" "):
+                yield SimpleNamespace(type="response.output_text.delta", delta=word + " ")
+            await asyncio.sleep(latency * (1 - ttft_ratio))
+            usage = SimpleNamespace(input_tokens=count_tokens(prompt) + 85, output_tokens=count_tokens(text),
+                                    input_tokens_details=SimpleNamespace(cached_tokens=0))
+            yield SimpleNamespace(type="response.completed", response=SimpleNamespace(
+                output=[text], output_text=text, usage=usage
+            ))
+
+        return events()
+
+
+def stub_services(runner: StubRunner, storage: StorageBackend) -> ExitStack:
+    """
+    This function is used to swap the model clients and the storage backend of the app for the stand-ins.
+
+    Args:
+        runner: StubRunner - The agent runner stand-in
+        storage: StorageBackend - InMemoryBlobServiceClient, or a LocalStorage
+
+    Returns:
+        ExitStack - Undoes the patches when closed (use it as a context manager)
+    """
+    import utils.services
+
+    stack = ExitStack()
+    stack.enter_context(mock.patch.object(utils.services, "Runner", runner))
+    stack.enter_context(mock.patch.object(utils.services, "openai_client", StubAsyncOpenAI(runner)))
+    previous = set_storage(storage)
+    stack.callback(set_storage, previous)
+    return stack
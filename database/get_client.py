@@ -6,16 +6,28 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+# One client (and connection pool) per process, shared by the requests and the analysis tasks
+_client = None
+
 async def get_client():
+    global _client
+    if _client is not None:
+        return _client
+
     uri = os.getenv('uri')
     try:
         if not uri:
             print("Error: MongoDB URI not found in environment variables")
             return
-        
-        client = AsyncIOMotorClient(uri, server_api=ServerApi('1'))
-        return client
+
+        _client = AsyncIOMotorClient(uri, server_api=ServerApi('1'))
+        return _client
     except Exception as e:
         print(f"Failed to connect to MongoDB: {str(e)}")
         return None
 
+def close_client():
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
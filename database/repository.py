@@ -0,0 +1,134 @@
+'''
+Data-access layer for the Python-Data-Analyst database.
+
+Note:
+1. This module owns the collections and their indexes, nothing else should index into the client by name.
+2. ensure_indexes is idempotent and runs on every startup, it also applies the log retention
+   (a TTL index on logs.timestamp, LOG_RETENTION_DAYS, 0 keeps the logs forever).
+'''
+
+import os
+from datetime import datetime
+from pymongo import ASCENDING, DESCENDING #type: ignore
+from pymongo.errors import OperationFailure #type: ignore
+
+DATABASE_NAME = "Python-Data-Analyst"
+TASKS_COLLECTION = "analysis_tasks"
+LOGS_COLLECTION = "logs"
+
+LOG_TTL_INDEX = "timestamp_ttl"
+
+# Error codes of create_index when an index with the same name/keys exists with other options
+INDEX_OPTIONS_CONFLICT = (85, 86)
+
+
+def get_database(client):
+    return client[DATABASE_NAME]
+
+
+def get_tasks_collection(client):
+    return get_database(client)[TASKS_COLLECTION]
+
+
+def get_logs_collection(client):
+    return get_database(client)[LOGS_COLLECTION]
+
+
+async def _ensure_log_retention(client):
+    """
+    Create (or update) the TTL index that expires old logs.
+    """
+    logs_collection = get_logs_collection(client)
+    retention_days = float(os.getenv("LOG_RETENTION_DAYS", "30"))
+
+    if retention_days <= 0:
+        # Retention disabled, drop the TTL index if it was created before
+        indexes = await logs_collection.index_information()
+        if LOG_TTL_INDEX in indexes:
+            await logs_collection.drop_index(LOG_TTL_INDEX)
+        return
+
+    expire_after_seconds = int(retention_days * 24 * 60 * 60)
+    try:
+        await logs_collection.create_index(
+            [("timestamp", ASCENDING)], name=LOG_TTL_INDEX, expireAfterSeconds=expire_after_seconds
+        )
+    except OperationFailure as e:
+        if e.code not in INDEX_OPTIONS_CONFLICT:
+            raise
+        # The retention changed, update the existing index in place
+        await get_database(client).command(
+            "collMod", LOGS_COLLECTION,
+            index={"name": LOG_TTL_INDEX, "expireAfterSeconds": expire_after_seconds}
+        )
+
+
+async def ensure_indexes(client):
+    """
+    This function is used to create the indexes of the collections, safe to call on every startup.
+
+    Args:
+        client: MongoDB client
+    """
+    tasks_collection = get_tasks_collection(client)
+    logs_collection = get_logs_collection(client)
+
+    index_specs = [
+        (tasks_collection, [("task_id", ASCENDING)], {"name": "task_id_unique", "unique": True}),
+        (tasks_collection, [("status", ASCENDING), ("updated_at", DESCENDING)], {"name": "status_updated_at"}),
+        (logs_collection, [("task_id", ASCENDING), ("timestamp", ASCENDING)], {"name": "task_id_timestamp"}),
+    ]
+    for collection, keys, options in index_specs:
+        try:
+            await collection.create_index(keys, **options)
+        except OperationFailure as e:
+            # Don't block the startup on an index that can't be built (e.g. duplicated task_ids)
+            print(f"Could not create index {options['name']} on {collection.name}: {e}")
+
+    try:
+        await _ensure_log_retention(client)
+    except OperationFailure as e:
+        print(f"Could not apply the log retention: {e}")
+
+
+async def insert_task(client, task_document: dict):
+    await get_tasks_collection(client).insert_one(task_document)
+
+
+async def insert_tasks(client, task_documents: list):
+    # One round trip for the parent and the children of a batch
+    await get_tasks_collection(client).insert_many(task_documents, ordered=False)
+
+
+async def find_task(client, task_id: str):
+    return await get_tasks_collection(client).find_one({"task_id": task_id})
+
+
+async def find_tasks_progress(client, task_ids: list) -> list:
+    # One round trip for the children of a batch, only the fields of their progress
+    cursor = get_tasks_collection(client).find(
+        {"task_id": {"$in": task_ids}},
+        projection={"_id": 0, "task_id": 1, "status": 1, "progress": 1}
+    )
+    return await cursor.to_list(length=None)
+
+
+async def recover_interrupted_tasks(client) -> int:
+    """
+    This function is used to fail the tasks that were left in "processing" state by a restart.
+
+    Args:
+        client: MongoDB client
+
+    Returns:
+        int - Number of tasks that were updated
+    """
+    result = await get_tasks_collection(client).update_many(
+        {"status": "processing"},
+        {"$set": {
+            "status": "failed",
+            "message": "Analysis was interrupted due to server resource constraints. Please try again later in 5 minutes.",
+            "updated_at": datetime.now()
+        }}
+    )
+    return result.modified_count
@@ -0,0 +1,41 @@
+import pandas as pd
+from utils.aggregation_cache import AggregationCache
+
+
+def make_namespace():
+    df = pd.DataFrame({"Region": ["N", "S", "N"], "Sales": [1.0, None, 3.0], "Year": [2023, 2023, 2024]})
+    cache = AggregationCache(df)
+    namespace = {"df": df, "pd": pd}
+    namespace.update(cache.namespace(namespace))
+    return cache, namespace
+
+
+def run(cache, namespace, code):
+    with cache.executing(code):
+        exec(code, namespace)
+
+
+def test_repeated_calls_hit_the_cache():
+    cache, namespace = make_namespace()
+    run(cache, namespace, "a = aggregate('Region', 'Sales')")
+    run(cache, namespace, "b = aggregate('Region', 'Sales')")
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert namespace["a"].equals(namespace["b"])
+
+
+def test_helpers_use_the_filtered_df():
+    cache, namespace = make_namespace()
+    run(cache, namespace, "before = aggregate('Region', 'Sales')")
+    run(cache, namespace, "df = df[df.Year == 2023]\nafter = aggregate('Region', 'Sales')")
+    assert namespace["before"]["Sales"].tolist() == [4.0, 0.0]
+    assert namespace["after"]["Sales"].tolist() == [1.0, 0.0]
+
+
+def test_in_place_change_invalidates_results():
+    cache, namespace = make_namespace()
+    run(cache, namespace, "before = aggregate('Region', 'Sales', 'count')")
+    run(cache, namespace, "df['Sales'] = df['Sales'].fillna(0)\nduring = aggregate('Region', 'Sales', 'count')")
+    run(cache, namespace, "after = aggregate('Region', 'Sales', 'count')")
+    assert namespace["before"]["Sales"].tolist() == [2, 0]
+    assert namespace["during"]["Sales"].tolist() == [2, 1]
+    assert namespace["after"]["Sales"].tolist() == [2, 1]
@@ -0,0 +1,83 @@
+from utils.code_validator import validate_code
+
+COLUMNS = ["Region", "Sales", "Year"]
+
+
+def test_fixes_column_casing():
+    code, errors, fixes = validate_code("result = df.groupby('region')['sales'].sum()", COLUMNS)
+    assert code == "result = df.groupby('Region')['Sales'].sum()"
+    assert not errors
+    assert len(fixes) == 2
+
+
+def test_removes_dummy_dataframe():
+    code, errors, fixes = validate_code("df = pd.DataFrame({'a': [1, 2]})\nresult = df['Sales'].sum()", COLUMNS)
+    assert code.startswith("pass\n")
+    assert not errors
+    assert fixes
+
+
+def test_keeps_dataframe_built_from_df():
+    source = "df = pd.DataFrame(df.groupby('Region')['Sales'].sum())\nresult = df"
+    code, errors, fixes = validate_code(source, COLUMNS)
+    assert code == source
+    assert not errors
+    assert not fixes
+
+
+def test_removed_read_csv_is_not_reported():
+    code, errors, fixes = validate_code("df = pd.read_csv('data.csv')\nresult = df['Sales'].sum()", COLUMNS)
+    assert code.startswith("pass\n")
+    assert not errors
+    assert fixes
+
+
+def test_read_csv_outside_df_assignment_is_reported():
+    _, errors, _ = validate_code("other = pd.read_csv('data.csv')", COLUMNS)
+    assert any("read_csv" in error for error in errors)
+
+
+def test_columns_assignment_disables_column_fixes():
+    source = "df.columns = df.columns.str.lower()\nresult = df.groupby('region')['sales'].sum()"
+    code, errors, fixes = validate_code(source, COLUMNS)
+    assert code == source
+    assert not errors
+    assert not fixes
+
+
+def test_inplace_rename_disables_column_fixes():
+    source = "df.rename(columns=str.lower, inplace=True)\nresult = df['sales'].sum()"
+    code, errors, fixes = validate_code(source, COLUMNS)
+    assert code == source
+    assert not errors
+    assert not fixes
+
+
+def test_reset_index_inplace_allows_new_columns():
+    source = "df.reset_index(inplace=True)\nresult = df['index'].max()"
+    code, errors, _ = validate_code(source, COLUMNS)
+    assert code == source
+    assert not errors
+
+
+def test_set_index_inplace_allows_new_columns():
+    _, errors, _ = validate_code("df.set_index('Region', inplace=True)\nresult = df['level_0']", COLUMNS)
+    assert not errors
+
+
+def test_unknown_column_is_reported():
+    _, errors, _ = validate_code("result = df['Profit'].sum()", COLUMNS)
+    assert len(errors) == 1 and "Profit" in errors[0]
+
+
+def test_non_inplace_rename_keeps_column_checks():
+    _, errors, _ = validate_code("renamed = df.rename(columns=str.lower)\nresult = df['Profit']", COLUMNS)
+    assert len(errors) == 1
+
+
+def test_rebound_df_disables_column_fixes():
+    source = "df = df.rename(columns=str.lower)\nr = df.groupby('region')['sales'].sum()"
+    code, errors, fixes = validate_code(source, ["Region", "Sales"])
+    assert code == source
+    assert not errors
+    assert not fixes
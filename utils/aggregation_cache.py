@@ -0,0 +1,169 @@
+'''
+Memoized groupby/pivot helpers that are shared by every KPI of a task.
+
+Note:
+1. The analysis and the visualization code of the three KPIs usually group by the same dimensions,
+   so the same df.groupby(...).agg(...) would otherwise scan the full dataset up to six times.
+2. The cache lives as long as the task (it is created in run_analysis), results are copied on the way out
+   so generated code can modify them freely.
+3. The helpers run on the df of the namespace at call time, so df = df[df.year == 2023] before aggregate() is
+   honoured. Results are keyed on the identity of that frame and on a generation that execute_with_debug bumps after
+   code that may modify a frame in place (df['x'] = df['x'].fillna(0), inplace=True...); while such code runs the
+   cache is bypassed, a shape-preserving change never returns stale aggregates.
+'''
+
+import weakref
+from contextlib import contextmanager
+import pandas as pd
+from utils.code_validator import mutates_frames
+
+# Marker for arguments that cannot be part of a cache key
+_UNHASHABLE = object()
+
+
+def _freeze(value):
+    """
+    Turn column lists / agg specs into a hashable cache key, returns _UNHASHABLE when that is not possible (e.g. lambdas).
+    """
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, (list, tuple)):
+        frozen = tuple(_freeze(v) for v in value)
+        return _UNHASHABLE if any(f is _UNHASHABLE for f in frozen) else ("seq", frozen)
+    if isinstance(value, dict):
+        frozen = tuple((k, _freeze(v)) for k, v in sorted(value.items(), key=lambda item: str(item[0])))
+        return _UNHASHABLE if any(f is _UNHASHABLE for _, f in frozen) else ("map", frozen)
+    return _UNHASHABLE
+
+
+class AggregationCache:
+    """
+    Memoizes groupby and pivot results over the frames of the task.
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._bypass = False
+        self._results = {}
+        # id(frame) -> weakref, the results of a frame are dropped when it is collected (its id can be reused)
+        self._frames = {}
+
+    def _track(self, frame) -> int:
+        frame_id = id(frame)
+        ref = self._frames.get(frame_id)
+        if ref is None or ref() is not frame:
+            self._forget(frame_id)
+            try:
+                self._frames[frame_id] = weakref.ref(frame, lambda _, frame_id=frame_id: self._forget(frame_id))
+            except TypeError:
+                return None
+        return frame_id
+
+    def _forget(self, frame_id: int):
+        self._frames.pop(frame_id, None)
+        for key in [key for key in self._results if key[1] == frame_id]:
+            del self._results[key]
+
+    def _lookup(self, frame, key, compute):
+        cacheable = key is not _UNHASHABLE and not self._bypass
+        if cacheable:
+            frame_id = self._track(frame)
+            cacheable = frame_id is not None
+        if cacheable:
+            key = (self.generation, frame_id, key)
+            if key in self._results:
+                self.hits += 1
+                return self._results[key].copy()
+
+        self.misses += 1
+        result = compute()
+        if cacheable:
+            self._results[key] = result
+            return result.copy()
+        return result
+
+    def invalidate(self):
+        """
+        Forget every result, after code that modified a frame in place.
+        """
+        self.generation += 1
+        self._results.clear()
+
+    @contextmanager
+    def executing(self, code: str):
+        """
+        Run generated code: the cache is bypassed while code that may modify a frame runs, and invalidated after it.
+        """
+        mutates = mutates_frames(code)
+        self._bypass = mutates
+        try:
+            yield
+        finally:
+            self._bypass = False
+            if mutates:
+                self.invalidate()
+
+    def aggregate(self, by, values=None, func="sum", dropna: bool = True, df=None) -> pd.DataFrame:
+        """
+        This function is used to group df and aggregate it, memoized for the lifetime of the task.
+
+        Args:
+            by: str | list - Column(s) to group by
+            values: str | list - Column(s) to aggregate (all columns when None)
+            func: str | list | dict - Aggregation, same as DataFrame.agg (e.g. "sum", ["mean", "count"])
+            dropna: bool - Drop groups whose key is null
+            df: pd.DataFrame - The frame to group (the dataset of the task when None)
+
+        Returns:
+            pd.DataFrame - The aggregated result with the group keys as columns
+        """
+        frame = self.df if df is None else df
+        key = _freeze(("aggregate", by, values, func, dropna))
+
+        def compute():
+            grouped = frame.groupby(by, dropna=dropna)
+            if values is not None:
+                grouped = grouped[values]
+            result = grouped.agg(func)
+            return result.reset_index() if isinstance(result, pd.DataFrame) else result.to_frame().reset_index()
+
+        return self._lookup(frame, key, compute)
+
+    def pivot(self, index, columns, values, func="sum", fill_value=None, df=None) -> pd.DataFrame:
+        """
+        This function is used to build a pivot table of df, memoized for the lifetime of the task.
+
+        Args:
+            index: str | list - Row keys
+            columns: str | list - Column keys
+            values: str | list - Column(s) to aggregate
+            func: str | list | dict - Aggregation, same as pd.pivot_table aggfunc
+            fill_value: Value used for missing combinations
+            df: pd.DataFrame - The frame to pivot (the dataset of the task when None)
+
+        Returns:
+            pd.DataFrame - The pivot table
+        """
+        frame = self.df if df is None else df
+        key = _freeze(("pivot", index, columns, values, func, fill_value))
+
+        def compute():
+            # Method form so out-of-core frames (utils/out_of_core.py) stream their own pivot
+            return frame.pivot_table(index=index, columns=columns, values=values, aggfunc=func, fill_value=fill_value)
+
+        return self._lookup(frame, key, compute)
+
+    def namespace(self, namespace: dict) -> dict:
+        """
+        Return the helpers to expose to the generated code, they run on namespace["df"] as it is when they are called.
+        """
+        def aggregate(by, values=None, func="sum", dropna: bool = True):
+            return self.aggregate(by, values, func, dropna, df=namespace.get("df", self.df))
+
+        def pivot(index, columns, values, func="sum", fill_value=None):
+            return self.pivot(index, columns, values, func, fill_value, df=namespace.get("df", self.df))
+
+        return {"aggregate": aggregate, "pivot": pivot}
@@ -0,0 +1,147 @@
+'''
+Pre-compressed, cache-friendly uploads of the task artifacts (report, raw data and charts).
+
+Note:
+1. Text artifacts (HTML report, JSON data) are stored compressed with ARTIFACT_ENCODING (gzip by default, br when
+   the brotli package is installed, identity to disable it) and served with the matching Content-Encoding, so the
+   blob is smaller and browsers decompress it transparently. The HTML stream is compressed chunk by chunk.
+2. Charts are already compressed images, they are stored as-is under a name derived from the SHA-256 of their
+   bytes (charts/<hash>.png). Identical charts are stored once and, since a name always maps to the same content,
+   they are served with an immutable Cache-Control.
+3. Every artifact name is unique to its content or its task, so all of them can be cached for a year. The partial
+   reports published while a task is running are overwritten, they are uploaded with no-cache instead.
+'''
+
+import hashlib
+import os
+import zlib
+from typing import Iterable, Iterator, Union
+from utils.metrics import record_cache_lookups
+from utils.storage import content_settings
+
+try:
+    import brotli # type: ignore
+except ImportError:
+    brotli = None
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+CHARTS_PREFIX = "charts"
+
+# Image content types by file extension
+CHART_CONTENT_TYPES = {
+    "png": "image/png",
+    "webp": "image/webp",
+    "svg": "image/svg+xml",
+    "jpg": "image/jpeg",
+}
+
+
+def get_artifact_encoding() -> str:
+    """
+    Return the Content-Encoding used for the text artifacts.
+    """
+    encoding = os.getenv("ARTIFACT_ENCODING", "gzip").strip().lower()
+    if encoding == "br" and brotli is None:
+        print("ARTIFACT_ENCODING=br but brotli is not installed, falling back to gzip")
+        return "gzip"
+    if encoding not in ("gzip", "br", "identity"):
+        print(f"Unknown ARTIFACT_ENCODING {encoding}, falling back to gzip")
+        return "gzip"
+    return encoding
+
+
+def compress_chunks(chunks: Iterable[bytes], encoding: str) -> Iterator[bytes]:
+    """
+    This function is used to compress a stream of bytes without holding it in memory.
+
+    Args:
+        chunks: Iterable[bytes] - The uncompressed data
+        encoding: str - gzip, br or identity
+
+    Returns:
+        Iterator[bytes] - The compressed data
+    """
+    if encoding == "identity":
+        yield from chunks
+        return
+
+    if encoding == "br":
+        compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=9)
+        compress, finish = compressor.process, compressor.finish
+    else:
+        # wbits=31 writes a gzip header and trailer
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        compress, finish = compressor.compress, compressor.flush
+
+    for chunk in chunks:
+        compressed = compress(chunk)
+        if compressed:
+            yield compressed
+    yield finish()
+
+
+def upload_artifact(container_client, blob_name: str, data: Union[bytes, Iterable[bytes]], content_type: str,
+                    encoding: str = None, cache_control: str = IMMUTABLE_CACHE_CONTROL) -> str:
+    """
+    This function is used to upload a text artifact pre-compressed with its content settings.
+
+    Args:
+        container_client: Azure container client
+        blob_name: str - Name of the blob (unique per task)
+        data: bytes | Iterable[bytes] - The uncompressed content, or a stream of chunks
+        content_type: str - e.g. "text/html; charset=utf-8"
+        encoding: str - gzip, br or identity (default: ARTIFACT_ENCODING)
+        cache_control: str - Cache-Control of the blob (REVALIDATE_CACHE_CONTROL for content that will be overwritten)
+
+    Returns:
+        str - The URL of the blob
+    """
+    encoding = encoding or get_artifact_encoding()
+    chunks = [data] if isinstance(data, (bytes, bytearray)) else data
+
+    blob_client = container_client.get_blob_client(blob_name)
+    blob_client.upload_blob(
+        compress_chunks(chunks, encoding),
+        overwrite=True,
+        content_settings=content_settings(
+            content_type=content_type,
+            content_encoding=None if encoding == "identity" else encoding,
+            cache_control=cache_control,
+        ),
+    )
+    return blob_client.url
+
+
+def chart_blob_name(image_bytes: bytes, extension: str = "png") -> str:
+    """
+    Return the content-addressed name of a chart.
+    """
+    return f"{CHARTS_PREFIX}/{hashlib.sha256(image_bytes).hexdigest()}.{extension}"
+
+
+def upload_chart(container_client, image_bytes: bytes, extension: str = "png") -> str:
+    """
+    This function is used to upload a chart under its content hash, skipping the upload if it is already stored.
+
+    Args:
+        container_client: Azure container client
+        image_bytes: bytes - The encoded image
+        extension: str - png, webp, svg or jpg
+
+    Returns:
+        str - The URL of the blob
+    """
+    blob_client = container_client.get_blob_client(chart_blob_name(image_bytes, extension))
+    exists = blob_client.exists()
+    record_cache_lookups("chart_blob", int(exists), int(not exists))
+    if not exists:
+        blob_client.upload_blob(
+            image_bytes,
+            overwrite=True,
+            content_settings=content_settings(
+                content_type=CHART_CONTENT_TYPES.get(extension, "application/octet-stream"),
+                cache_control=IMMUTABLE_CACHE_CONTROL,
+            ),
+        )
+    return blob_client.url
@@ -0,0 +1,145 @@
+'''
+State shared by the analyses of a batch (POST /analyze/batch).
+
+Note:
+1. Files with the same schema (column names and types) share a SchemaPlan: the KPI plan of the Manager agent and
+   the analysis and chart code that ran successfully. The first file of a schema runs the agents, the next ones
+   reuse what it produced: the Manager is not called again and the code goes straight to execute_with_debug (it
+   is still validated and debugged against the new file).
+2. Files of the same schema that start together don't all call the Manager: the first one claims the KPI plan,
+   the others wait for it. When the first one fails before its Manager finishes, the plan is released and the
+   next file runs it.
+3. Every profile is computed from its own file (the statistics differ), only what depends on the schema is shared.
+4. The children of every batch of the process run through the same BATCH_CONCURRENCY slots, and share the default
+   executor of the loop, the MongoDB pool and the storage backend.
+'''
+
+import asyncio
+import hashlib
+import os
+from contextvars import ContextVar
+
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "2"))
+
+# Schema plan of the batch analysis being processed (None outside of batches)
+current_schema_plan = ContextVar("current_schema_plan", default=None)
+
+_batch_slots = None
+
+
+def batch_slots() -> asyncio.Semaphore:
+    """
+    Slots shared by the children of every batch of the process (BATCH_CONCURRENCY analyses at a time).
+    """
+    global _batch_slots
+    if _batch_slots is None:
+        _batch_slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+    return _batch_slots
+
+
+def schema_fingerprint(df) -> str:
+    """
+    Hash of the column names and types of a dataset (DataFrame or ChunkedFrame).
+    """
+    signature = [type(df).__name__] + [f"{column}:{dtype}" for column, dtype in df.dtypes.items()]
+    return hashlib.sha256("\n".join(signature).encode("utf-8")).hexdigest()[:16]
+
+
+class SchemaPlan:
+    """
+    KPI plan and verified code of one schema.
+    """
+
+    def __init__(self, fingerprint: str, columns: list):
+        self.fingerprint = fingerprint
+        self.columns = columns
+        self.files = 0
+        self.kpi_names = None
+        self._kpi_plan = None
+        self.code = {"analysis": {}, "chart": {}}
+        self.reused = {"kpi_plans": 0, "analysis": 0, "chart": 0}
+
+    async def kpi_plan(self):
+        """
+        This function is used to get the KPI plan of the schema.
+
+        Returns:
+            list - The KPI names, or None when the caller is the first file and must run the Manager
+                   (it then calls publish_kpis)
+        """
+        while True:
+            if self._kpi_plan is None:
+                self._kpi_plan = asyncio.get_running_loop().create_future()
+                return None
+            # Shielded, a cancelled waiter must not cancel the plan of the others
+            kpi_names = await asyncio.shield(self._kpi_plan)
+            if kpi_names:
+                self.reused["kpi_plans"] += 1
+                return list(kpi_names)
+
+    def publish_kpis(self, kpi_names: list):
+        """
+        Share the KPI plan of the first file, an empty plan releases the claim (the next file runs the Manager).
+        """
+        plan = self._kpi_plan
+        if kpi_names:
+            self.kpi_names = list(kpi_names)
+        else:
+            self._kpi_plan = None
+        if plan is not None and not plan.done():
+            plan.set_result(list(kpi_names))
+
+    def has_code(self, kpi_name: str) -> bool:
+        return kpi_name in self.code["analysis"] and kpi_name in self.code["chart"]
+
+    def verified_code(self, kind: str, kpi_name: str):
+        code = self.code[kind].get(kpi_name)
+        if code is not None:
+            self.reused[kind] += 1
+        return code
+
+    def stats(self) -> dict:
+        return {
+            "columns": len(self.columns),
+            "files": self.files,
+            "kpi_names": self.kpi_names,
+            "verified_code": {kind: len(codes) for kind, codes in self.code.items()},
+            "reused": dict(self.reused),
+        }
+
+
+class BatchContext:
+    """
+    The schema plans of a batch.
+    """
+
+    def __init__(self):
+        self.plans = {}
+
+    def schema_plan(self, df) -> SchemaPlan:
+        fingerprint = schema_fingerprint(df)
+        if fingerprint not in self.plans:
+            self.plans[fingerprint] = SchemaPlan(fingerprint, list(df.columns))
+        plan = self.plans[fingerprint]
+        plan.files += 1
+        return plan
+
+    def stats(self) -> dict:
+        return {fingerprint: plan.stats() for fingerprint, plan in self.plans.items()}
+
+
+def verified_code(kind: str, kpi_name: str):
+    """
+    Return the code of a KPI (kind: analysis or chart) verified on another file of the same schema, None otherwise.
+    """
+    plan = current_schema_plan.get()
+    return plan.verified_code(kind, kpi_name) if plan is not None else None
+
+
+def record_verified_code(kind: str, kpi_name: str, code: str):
+    """
+    Keep the code of a KPI that ran successfully, for the next files of the same schema in the batch.
+    """
+    plan = current_schema_plan.get()
+    if plan is not None and code:
+        plan.code[kind].setdefault(kpi_name, code)
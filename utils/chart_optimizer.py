@@ -0,0 +1,159 @@
+'''
+Post-render optimization of the generated charts.
+
+Note:
+1. The generated code picks its own figsize, so the figure is saved at CHART_DPI and the image is then
+   downscaled to fit CHART_MAX_WIDTH x CHART_MAX_HEIGHT pixels.
+2. The PNG is quantized to a 256 color palette (charts are flat colors and anti-aliased text, this is visually
+   lossless) and re-encoded with optimize. The smallest of PNG, lossless WebP and, when CHART_FORMATS includes it,
+   the SVG rendering of the same figure is kept.
+3. raster is always a PNG/WebP, the vision call in get_analysis_insights can't take an SVG. That call gets it
+   inline, downscaled to INSIGHTS_IMAGE_MAX_SIDE (vision_data_uri).
+'''
+
+import base64
+import os
+from dataclasses import dataclass
+from io import BytesIO
+from PIL import Image # type: ignore
+
+CHART_DPI = int(os.getenv("CHART_DPI", "100"))
+CHART_MAX_WIDTH = int(os.getenv("CHART_MAX_WIDTH", "1200"))
+CHART_MAX_HEIGHT = int(os.getenv("CHART_MAX_HEIGHT", "900"))
+# Candidate formats, png is always produced
+CHART_FORMATS = [f.strip().lower() for f in os.getenv("CHART_FORMATS", "png,webp").split(",") if f.strip()]
+# Image input of the insights call, "low" detail is billed as a single 512px tile
+INSIGHTS_IMAGE_MAX_SIDE = int(os.getenv("INSIGHTS_IMAGE_MAX_SIDE", "512"))
+INSIGHTS_IMAGE_DETAIL = os.getenv("INSIGHTS_IMAGE_DETAIL", "low")
+
+
+@dataclass
+class OptimizedChart:
+    data: bytes
+    extension: str
+    raster: bytes
+    raster_extension: str
+    width: int
+    height: int
+    original_bytes: int
+
+    def stats(self) -> dict:
+        """
+        Return the (JSON serializable) size information of the chart.
+        """
+        return {
+            "format": self.extension,
+            "bytes": len(self.data),
+            "original_bytes": self.original_bytes,
+            "width": self.width,
+            "height": self.height,
+            "dpi": CHART_DPI,
+        }
+
+
+def svg_enabled() -> bool:
+    return "svg" in CHART_FORMATS
+
+
+def savefig_code(file_name: str) -> str:
+    """
+    This function is used to build the code appended to the generated code to save the figure.
+
+    Args:
+        file_name: str - The PNG file, the SVG (when enabled) is saved next to it with the .svg extension
+
+    Returns:
+        str - The code
+    """
+    code = f"\n# Save figure to blob storage\nplt.savefig('{file_name}', dpi={CHART_DPI}, bbox_inches='tight')\n"
+    if svg_enabled():
+        svg_name = os.path.splitext(file_name)[0] + ".svg"
+        code += f"plt.savefig('{svg_name}', format='svg', bbox_inches='tight')\n"
+    return code
+
+
+def _encode_png(image: Image.Image) -> bytes:
+    # Fast octree keeps the alpha channel, 256 colors are plenty for a chart
+    quantized = image.quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+    buffer = BytesIO()
+    quantized.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+def _encode_webp(image: Image.Image) -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, format="WEBP", lossless=True, method=4)
+    return buffer.getvalue()
+
+
+def optimize_chart(png_bytes: bytes, svg_bytes: bytes = None) -> OptimizedChart:
+    """
+    This function is used to downscale and re-encode a chart, keeping the smallest format.
+
+    Args:
+        png_bytes: bytes - The chart as saved by matplotlib
+        svg_bytes: bytes - The SVG rendering of the same figure (optional)
+
+    Returns:
+        OptimizedChart - The chosen encoding, the smallest raster encoding and the size information
+    """
+    image = Image.open(BytesIO(png_bytes))
+    image.load()
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA")
+
+    # Enforce the target pixel dimensions, keeping the aspect ratio
+    if image.width > CHART_MAX_WIDTH or image.height > CHART_MAX_HEIGHT:
+        image.thumbnail((CHART_MAX_WIDTH, CHART_MAX_HEIGHT), Image.Resampling.LANCZOS)
+
+    rasters = [("png", _encode_png(image))]
+    if "webp" in CHART_FORMATS:
+        try:
+            rasters.append(("webp", _encode_webp(image)))
+        except (OSError, KeyError) as e:
+            # Pillow built without WebP support
+            print(f"Could not encode the chart as WebP: {e}")
+    raster_extension, raster = min(rasters, key=lambda candidate: len(candidate[1]))
+
+    extension, data = raster_extension, raster
+    if svg_bytes and svg_enabled() and len(svg_bytes) < len(raster):
+        extension, data = "svg", svg_bytes
+
+    return OptimizedChart(
+        data=data,
+        extension=extension,
+        raster=raster,
+        raster_extension=raster_extension,
+        width=image.width,
+        height=image.height,
+        original_bytes=len(png_bytes),
+    )
+
+
+def vision_data_uri(raster: bytes, max_side: int = None) -> str:
+    """
+    This function is used to downscale a chart for the vision model and encode it as an inline data URI.
+
+    Args:
+        raster: bytes - The chart (PNG/WebP)
+        max_side: int - Longest side in pixels (default: INSIGHTS_IMAGE_MAX_SIDE)
+
+    Returns:
+        str - data:image/...;base64,... URI
+    """
+    max_side = max_side or INSIGHTS_IMAGE_MAX_SIDE
+    image = Image.open(BytesIO(raster))
+    image_format = (image.format or "PNG").upper()
+
+    if max(image.size) > max_side:
+        image.load()
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        if image_format == "WEBP":
+            raster = _encode_webp(image)
+        else:
+            image_format = "PNG"
+            raster = _encode_png(image)
+
+    return f"data:image/{image_format.lower()};base64,{base64.b64encode(raster).decode('ascii')}"
@@ -0,0 +1,322 @@
+'''
+Static checks for the code generated by the agents, run before it is exec'd.
+
+Note:
+1. Trivial mistakes (column name casing, plt.show(), re-creating df) are fixed here without calling the Debug agent.
+2. Anything we cannot fix is returned as an error message, so the Debug agent gets a precise hint instead of a traceback.
+'''
+
+import ast
+import difflib
+
+# Imports that have no business in analysis/chart code
+BANNED_IMPORTS = {"subprocess", "socket", "requests", "urllib", "http", "shutil", "pickle"}
+
+# Builtins that read files or run arbitrary code
+BANNED_CALLS = {"open", "eval", "exec", "compile", "input", "__import__"}
+
+# pandas readers, the data is always already available as df
+FILE_READERS = {
+    "read_csv", "read_excel", "read_json", "read_parquet", "read_table", "read_sql",
+    "read_pickle", "read_feather", "read_html", "read_fwf", "read_clipboard"
+}
+
+# DataFrame methods that take column names: method -> (positional indexes, keyword names)
+COLUMN_ARGUMENTS = {
+    "groupby": ((0,), ("by",)),
+    "sort_values": ((0,), ("by",)),
+    "set_index": ((0,), ("keys",)),
+    "pivot_table": ((0,), ("values", "index", "columns")),
+    "pivot": ((), ("index", "columns", "values")),
+    "drop_duplicates": ((0,), ("subset",)),
+    "dropna": ((), ("subset",)),
+    "nlargest": ((1,), ("columns",)),
+    "nsmallest": ((1,), ("columns",)),
+    "value_counts": ((0,), ("subset",)),
+    "melt": ((), ("id_vars", "value_vars")),
+}
+
+# Helpers from the execution namespace (utils/aggregation_cache.py) that take column names
+HELPER_COLUMN_ARGUMENTS = {
+    "aggregate": ((0, 1), ("by", "values")),
+    "pivot": ((0, 1, 2), ("index", "columns", "values")),
+}
+
+# Methods that return a frame with the same columns as the one they are called on
+PASSTHROUGH_METHODS = {"copy", "dropna", "fillna", "query", "head", "tail", "sample"}
+
+# Methods that change the column names of df when called with inplace=True
+INPLACE_COLUMN_METHODS = {"rename", "reset_index", "set_index"}
+
+# Methods that modify the object they are called on (besides the inplace=True ones)
+MUTATING_METHODS = {"insert", "update", "pop"}
+
+
+class CodeValidationError(Exception):
+    """Raised when generated code fails static validation and could not be fixed automatically."""
+
+
+def _is_df(node) -> bool:
+    """
+    Check whether an expression evaluates to df (or a row subset of it), so its column references can be checked.
+    """
+    if isinstance(node, ast.Name):
+        return node.id == "df"
+    if isinstance(node, ast.Subscript):
+        # df[mask] keeps the columns, df['col'] / df[['a', 'b']] does not
+        return _is_df(node.value) and not _string_literals(node.slice)
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+        return node.func.attr in PASSTHROUGH_METHODS and _is_df(node.func.value)
+    return False
+
+
+def _string_literals(node) -> list:
+    """
+    Return the string constants of a 'col' or ['a', 'b'] expression, empty list for anything else.
+    """
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return [node]
+    if isinstance(node, (ast.List, ast.Tuple)):
+        elements = [e for e in node.elts if isinstance(e, ast.Constant) and isinstance(e.value, str)]
+        if elements and len(elements) == len(node.elts):
+            return elements
+    return []
+
+
+def _call_name(node) -> str:
+    """
+    Return a dotted name for the function being called, e.g. 'plt.show' or 'pd.read_csv'.
+    """
+    parts = []
+    func = node.func
+    while isinstance(func, ast.Attribute):
+        parts.append(func.attr)
+        func = func.value
+    if isinstance(func, ast.Name):
+        parts.append(func.id)
+    return ".".join(reversed(parts))
+
+
+def _created_columns(tree) -> set:
+    """
+    Collect the column names the code itself adds to df, so they are not reported as missing.
+    """
+    created = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Subscript) and isinstance(node.ctx, ast.Store) and _is_df(node.value):
+            created.update(c.value for c in _string_literals(node.slice))
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and _is_df(node.func.value):
+            if node.func.attr == "assign":
+                created.update(k.arg for k in node.keywords if k.arg)
+            elif node.func.attr == "insert" and len(node.args) > 1:
+                created.update(c.value for c in _string_literals(node.args[1]))
+            elif node.func.attr == "rename":
+                for keyword in node.keywords:
+                    if keyword.arg == "columns" and isinstance(keyword.value, ast.Dict):
+                        created.update(v.value for v in keyword.value.values if isinstance(v, ast.Constant))
+    return created
+
+
+def _references_df(node) -> bool:
+    """
+    Check whether an expression uses df anywhere (pd.DataFrame(df.groupby(...).sum()) is built from the dataset).
+    """
+    return any(isinstance(n, ast.Name) and n.id == "df" for n in ast.walk(node))
+
+
+def _renames_columns(tree) -> bool:
+    """
+    Check whether the code changes the column names of df in place (df.columns = ..., df.rename(..., inplace=True),
+    df.reset_index(inplace=True), df.set_index(..., inplace=True)), after which the profiled columns are stale.
+    """
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Assign, ast.AugAssign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            if any(isinstance(t, ast.Attribute) and t.attr == "columns" and _is_df(t.value) for t in targets):
+                return True
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) \
+                and node.func.attr in INPLACE_COLUMN_METHODS and _is_df(node.func.value):
+            if any(k.arg == "inplace" and not (isinstance(k.value, ast.Constant) and not k.value.value)
+                   for k in node.keywords):
+                return True
+    return False
+
+
+def _rebinds_df(tree, ignored: set) -> bool:
+    """
+    Check whether the code assigns a new frame to df (df = df.merge(...) etc.) or renames its columns in place,
+    after which its columns are unknown.
+    """
+    for node in ast.walk(tree):
+        if id(node) in ignored:
+            continue
+        if isinstance(node, (ast.Assign, ast.AugAssign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            if any(isinstance(t, ast.Name) and t.id == "df" for t in targets):
+                return True
+    return _renames_columns(tree)
+
+
+def _column_references(tree) -> list:
+    """
+    Collect the string constants that are used as column names of df.
+    """
+    references = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Subscript) and isinstance(node.ctx, ast.Load):
+            # df['col'] and df.groupby('x')['col']
+            value = node.value
+            if _is_df(value):
+                references.extend(_string_literals(node.slice))
+            elif isinstance(value, ast.Call) and isinstance(value.func, ast.Attribute) \
+                    and value.func.attr == "groupby" and _is_df(value.func.value):
+                references.extend(_string_literals(node.slice))
+        elif isinstance(node, ast.Call):
+            if isinstance(node.func, ast.Attribute) and node.func.attr in COLUMN_ARGUMENTS and _is_df(node.func.value):
+                positions, keywords = COLUMN_ARGUMENTS[node.func.attr]
+            elif isinstance(node.func, ast.Name) and node.func.id in HELPER_COLUMN_ARGUMENTS:
+                positions, keywords = HELPER_COLUMN_ARGUMENTS[node.func.id]
+            else:
+                continue
+            for position in positions:
+                if position < len(node.args):
+                    references.extend(_string_literals(node.args[position]))
+            for keyword in node.keywords:
+                if keyword.arg in keywords:
+                    references.extend(_string_literals(keyword.value))
+    return references
+
+
+def mutates_frames(code: str) -> bool:
+    """
+    Check whether the code may modify a frame in place: item or attribute assignment (df['x'] = ..., df.loc[...] = ...),
+    del, inplace=True, insert/update/pop. Any object counts, not only df, since the frame may be aliased.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return False
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Subscript, ast.Attribute)) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            return True
+        if isinstance(node, ast.Call):
+            if any(k.arg == "inplace" for k in node.keywords):
+                return True
+            if isinstance(node.func, ast.Attribute) and node.func.attr in MUTATING_METHODS:
+                return True
+    return False
+
+
+def _match_column(name: str, columns: list):
+    """
+    Find the real column for a name that only differs in case or surrounding whitespace.
+    """
+    normalized = name.strip().casefold()
+    matches = [c for c in columns if isinstance(c, str) and c.strip().casefold() == normalized]
+    return matches[0] if len(matches) == 1 else None
+
+
+def _apply_edits(code: str, edits: list) -> str:
+    """
+    Apply (node, replacement) edits to the source. ast offsets are utf-8 byte offsets, so work on bytes.
+    """
+    source = code.encode("utf-8")
+    line_starts = [0]
+    for line in source.splitlines(keepends=True):
+        line_starts.append(line_starts[-1] + len(line))
+
+    spans = []
+    for node, replacement in edits:
+        start = line_starts[node.lineno - 1] + node.col_offset
+        end = line_starts[node.end_lineno - 1] + node.end_col_offset
+        spans.append((start, end, replacement.encode("utf-8")))
+
+    # Apply from the end so earlier offsets stay valid, skip anything overlapping an applied edit
+    last_start = len(source) + 1
+    for start, end, replacement in sorted(spans, key=lambda span: span[0], reverse=True):
+        if end > last_start:
+            continue
+        source = source[:start] + replacement + source[end:]
+        last_start = start
+    return source.decode("utf-8")
+
+
+def validate_code(code: str, columns: list) -> tuple:
+    """
+    This function is used to statically validate generated code before it is executed.
+
+    Args:
+        code: str - The generated Python code
+        columns: list - The columns of df (from the profiled dataset)
+
+    Returns:
+        code: str - The code with the trivial issues fixed
+        errors: list - Problems that could not be fixed and need the Debug agent
+        fixes: list - Descriptions of the fixes applied
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        return code, [f"SyntaxError: {e.msg} (line {e.lineno})"], []
+
+    edits = []
+    errors = []
+    fixes = []
+    # Nodes of the statements removed by a fix, their calls are gone and must not be reported
+    removed = set()
+
+    for node in ast.walk(tree):
+        if id(node) in removed:
+            continue
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            modules = [alias.name for alias in node.names] if isinstance(node, ast.Import) else [node.module or ""]
+            for module in modules:
+                if module.split(".")[0] in BANNED_IMPORTS:
+                    errors.append(f"Import of '{module}' is not allowed (line {node.lineno})")
+
+        elif isinstance(node, ast.Expr) and isinstance(node.value, ast.Call) \
+                and _call_name(node.value) in ("plt.show", "matplotlib.pyplot.show"):
+            # plt.show() blocks the backend, drop it
+            edits.append((node, "pass"))
+            fixes.append(f"Removed plt.show() (line {node.lineno})")
+
+        elif isinstance(node, ast.Assign) and isinstance(node.value, ast.Call) \
+                and any(isinstance(t, ast.Name) and t.id == "df" for t in node.targets):
+            # df = pd.DataFrame({...}) / df = pd.read_csv(...) replaces the real dataset with dummy data
+            # pd.DataFrame(df.groupby(...).sum()) is derived from the dataset, keep it
+            name = _call_name(node.value)
+            if (name.split(".")[-1] == "DataFrame" or name.split(".")[-1] in FILE_READERS) \
+                    and not _references_df(node.value):
+                edits.append((node, "pass"))
+                fixes.append(f"Removed re-creation of df with {name}() (line {node.lineno})")
+                removed.update(id(n) for n in ast.walk(node))
+
+        elif isinstance(node, ast.Call):
+            name = _call_name(node)
+            if name in BANNED_CALLS:
+                errors.append(f"Call to {name}() is not allowed (line {node.lineno})")
+            elif name.split(".")[-1] in FILE_READERS and name.split(".")[0] in ("pd", "pandas"):
+                errors.append(f"Reading files with {name}() is not allowed, df is already loaded (line {node.lineno})")
+
+    # Column references are only checked while we still know what df looks like
+    df_rebound = _rebinds_df(tree, {id(node) for node, _ in edits})
+    known_columns = set(columns) | _created_columns(tree)
+
+    for reference in _column_references(tree):
+        name = reference.value
+        if name in known_columns or df_rebound:
+            # After df = df.rename(columns=str.lower) or df.columns = ... 'region' may be right and 'Region' the KeyError
+            continue
+        match = _match_column(name, columns)
+        if match is not None:
+            edits.append((reference, repr(match)))
+            fixes.append(f"Replaced column '{name}' with '{match}' (line {reference.lineno})")
+        else:
+            suggestions = difflib.get_close_matches(name, [str(c) for c in columns], n=3)
+            hint = f", did you mean {suggestions}?" if suggestions else f", available columns: {list(columns)}"
+            errors.append(f"Column '{name}' not found in df (line {reference.lineno}){hint}")
+
+    if edits:
+        code = _apply_edits(code, edits)
+
+    return code, errors, fixes
@@ -0,0 +1,148 @@
+'''
+Per-KPI pruning of the dataset description for wide datasets.
+
+Note:
+1. The Manager agent sees every column, but a KPI usually needs two or three of them. For datasets with more than
+   KPI_PRUNE_MIN_COLUMNS columns the analysis, visualization and debug agents get the description of the columns
+   that match the KPI name, plus the bare names of the other columns (so the code can still use them).
+2. Matching is lexical and runs locally: the KPI and column names are split into words (snake_case, camelCase,
+   punctuation), lightly stemmed and compared exactly, through a small table of business synonyms and with fuzzy
+   matching for typos/abbreviations. Date columns are added for KPIs about time (trend, monthly, growth...).
+3. When nothing matches, the full description is sent, pruning must never leave an agent without the data it needs.
+'''
+
+import os
+import re
+from difflib import SequenceMatcher
+from utils.profiler import DatasetProfile
+
+KPI_PRUNE_MIN_COLUMNS = int(os.getenv("KPI_PRUNE_MIN_COLUMNS", "30"))
+KPI_MAX_COLUMNS = int(os.getenv("KPI_MAX_COLUMNS", "8"))
+
+# Groups of words that refer to the same business concept
+SYNONYM_GROUPS = [
+    {"revenue", "sale", "amount", "income", "turnover", "gmv", "price"},
+    {"profit", "margin", "earning", "net", "gain"},
+    {"cost", "expense", "spend", "spending", "cogs", "fee"},
+    {"quantity", "qty", "unit", "volume"},
+    {"customer", "client", "user", "buyer", "account", "member"},
+    {"product", "item", "sku", "category", "brand"},
+    {"region", "country", "city", "state", "area", "location", "territory", "market", "zone"},
+    {"order", "transaction", "purchase", "invoice"},
+    {"employee", "staff", "rep", "agent", "salesperson"},
+    {"discount", "promotion", "promo", "coupon"},
+    {"rating", "score", "review", "satisfaction", "nps"},
+    {"churn", "retention", "cancel", "cancellation"},
+    {"age", "gender", "segment", "demographic"},
+]
+
+TIME_WORDS = {"date", "time", "day", "week", "month", "year", "quarter", "period", "timestamp", "datetime"}
+TREND_WORDS = {"trend", "growth", "over", "monthly", "daily", "weekly", "yearly", "annual", "quarterly",
+               "seasonal", "seasonality", "yoy", "mom", "time", "change", "forecast"}
+
+# Words of a KPI name that say nothing about the columns
+STOP_WORDS = {"the", "of", "by", "per", "and", "or", "to", "in", "for", "a", "an", "on", "vs", "with", "across",
+              "average", "avg", "mean", "median", "sum", "max", "min", "rate", "ratio", "distribution",
+              "analysis", "top", "kpi", "percentage", "pct", "share", "each", "between",
+              "total", "number", "count", "value", "overall"}
+
+_SYNONYMS = {word: group for group in SYNONYM_GROUPS for word in group}
+
+
+def _stem(word: str) -> str:
+    # Plurals only, anything more aggressive merges unrelated words
+    if word.endswith("ies") and len(word) > 4:
+        return word[:-3] + "y"
+    if word.endswith("s") and not word.endswith("ss") and len(word) > 3:
+        return word[:-1]
+    return word
+
+
+def tokenize(text: str) -> set:
+    """
+    Split a KPI or column name into lowercase, stemmed words.
+    """
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", str(text))
+    return {_stem(word) for word in re.split(r"[^a-z0-9]+", text.lower()) if word}
+
+
+def _word_score(kpi_word: str, column_words: set) -> float:
+    if kpi_word in column_words:
+        return 2.0
+    group = _SYNONYMS.get(kpi_word)
+    if group and column_words & group:
+        return 1.0
+    for column_word in column_words:
+        # Abbreviations (qty / quantity, rev / revenue) and typos
+        if len(column_word) >= 3 and len(kpi_word) >= 3 and (
+                kpi_word.startswith(column_word) or column_word.startswith(kpi_word)
+                or SequenceMatcher(None, kpi_word, column_word).ratio() >= 0.85):
+            return 1.0
+    return 0.0
+
+
+def score_columns(kpi_name: str, columns: list) -> dict:
+    """
+    This function is used to score how relevant each column is to a KPI.
+
+    Args:
+        kpi_name: str - The KPI
+        columns: list - The column names
+
+    Returns:
+        dict - Column -> score (0 when unrelated)
+    """
+    kpi_words = tokenize(kpi_name) - STOP_WORDS
+    scores = {}
+    for column in columns:
+        column_words = tokenize(column)
+        scores[column] = sum(_word_score(word, column_words) for word in kpi_words)
+    return scores
+
+
+def select_columns(kpi_name: str, profile: DatasetProfile) -> list:
+    """
+    This function is used to pick the columns to describe in full for a KPI.
+
+    Args:
+        kpi_name: str - The KPI
+        profile: DatasetProfile - The full dataset description
+
+    Returns:
+        list - The selected columns, in dataset order (empty when nothing matched)
+    """
+    scores = score_columns(kpi_name, list(profile.columns))
+    ranked = sorted((column for column in scores if scores[column] > 0), key=lambda column: -scores[column])
+    selected = set(ranked[:KPI_MAX_COLUMNS])
+    if not selected:
+        return []
+
+    # Time based KPIs need the date columns even when the KPI name doesn't mention them
+    if tokenize(kpi_name) & TREND_WORDS:
+        for column in profile.columns:
+            if tokenize(column) & TIME_WORDS or str(profile.dtype(column)).startswith("datetime"):
+                selected.add(column)
+
+    return [column for column in profile.columns if column in selected]
+
+
+def prune_dataset_prompt(kpi_name: str, profile: DatasetProfile) -> tuple:
+    """
+    This function is used to build the dataset description sent to the agents working on a KPI.
+
+    Args:
+        kpi_name: str - The KPI
+        profile: DatasetProfile - The full dataset description
+
+    Returns:
+        profile: DatasetProfile - The description of the relevant columns and the names of the others
+        selected: list - The columns described in full (empty when the full description is returned)
+    """
+    if len(profile.columns) <= KPI_PRUNE_MIN_COLUMNS:
+        return profile, []
+
+    selected = select_columns(kpi_name, profile)
+    if not selected:
+        return profile, []
+
+    return profile.select(selected), selected
@@ -1,12 +1,22 @@
 from fastapi import UploadFile, HTTPException, BackgroundTasks
 from database.get_client import get_client
-from azure.storage.blob import BlobServiceClient # type: ignore
+from database.repository import get_tasks_collection, insert_task, insert_tasks, find_task, find_tasks_progress
+from utils.log_sink import buffered_logs, progress_writer, flush_writers, current_task_id
+from utils.metrics import span, current_spans, summarize_spans, record_cache_lookups, record_task
+from utils.llm_telemetry import current_llm_calls, summarize_llm_calls
+from utils.memory_budget import MemoryBudget, current_memory_budget, summarize_memory
+from utils.storage import get_storage
+from utils.health import analysis_queued, analysis_started, analysis_finished
+from utils.batch import BatchContext, batch_slots, current_schema_plan
+import asyncio
 import os
+import time
 import uuid
 from datetime import datetime
 from dotenv import load_dotenv
 import traceback
 import json
+import zipfile
 import matplotlib
 # Set matplotlib to use Agg backend to avoid Tkinter threading issues
 matplotlib.use('Agg')
@@ -22,20 +32,13 @@ async def process_uploaded_file(file: UploadFile, background_tasks: BackgroundTa
         if not file_content:
             raise ValueError("Uploaded file is empty")
             
-        # Check if environment variable exists
-        connection_string = os.getenv("BLOB_STORAGE_ACCOUNT_KEY")
-        if not connection_string:
-            raise ValueError("BLOB_STORAGE_ACCOUNT_KEY environment variable is not set")
-            
-        # Create a blob client and MongoDB client
+        # Storage backend (STORAGE_BACKEND, raises when Azure is not configured) and MongoDB client
+        storage = get_storage()
         client = await get_client() 
-        db = client["Python-Data-Analyst"]
-        logs_collection = db["logs"]
-        tasks_collection = db["analysis_tasks"]  # Collection for tracking tasks
+        logs_collection = buffered_logs(client)
         
         # Connect to blob storage
-        blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-        container_client = blob_service_client.get_container_client("images-analysis")
+        container_client = storage.get_container_client("images-analysis")
         
         # Create a unique filename
         file_id = str(uuid.uuid4())
@@ -43,7 +46,8 @@ async def process_uploaded_file(file: UploadFile, background_tasks: BackgroundTa
     
         # Upload the file to blob storage
         blob_client = container_client.get_blob_client(unique_filename)
-        blob_client.upload_blob(file_content)
+        with span("upload"):
+            blob_client.upload_blob(file_content)
         
         # Create metadata
         file_metadata = {
@@ -52,7 +56,8 @@ async def process_uploaded_file(file: UploadFile, background_tasks: BackgroundTa
             "file_size": len(file_content),
             "upload_date": datetime.now().isoformat(),
             "blob_url": blob_client.url,
-            "type": "File Information"
+            "type": "File Information",
+            "timestamp": datetime.now()
         }
         
         # Log file upload
@@ -76,10 +81,11 @@ async def process_uploaded_file(file: UploadFile, background_tasks: BackgroundTa
         }
         
         # Insert task document
-        await tasks_collection.insert_one(task_document)
+        await insert_task(client, task_document)
         
         # Add the analysis task to background tasks
         if background_tasks is not None:
+            analysis_queued(task_id)
             background_tasks.add_task(
                 run_analysis,
                 task_id=task_id,
@@ -98,7 +104,264 @@ async def process_uploaded_file(file: UploadFile, background_tasks: BackgroundTa
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing file: {str(e)}")
 
-async def run_analysis(task_id: str, file_url: str, client):
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "100"))
+BATCH_PROGRESS_INTERVAL = float(os.getenv("BATCH_PROGRESS_INTERVAL", "2"))
+
+def _csv_members(archive: zipfile.ZipFile) -> list:
+    """
+    Return the CSV members of an archive, without the folders and the metadata files of macOS archives.
+    """
+    members = []
+    for member in archive.infolist():
+        name = os.path.basename(member.filename)
+        if member.is_dir() or not name.lower().endswith(".csv") or name.startswith(("._", ".")):
+            continue
+        members.append(member)
+    return members
+
+def upload_batch_files(files: list, container_client) -> list:
+    """
+    Upload the CSVs of a batch to blob storage, zip archives are extracted member by member.
+
+    Args:
+        files: list - The uploaded files (CSVs or zip archives of CSVs)
+        container_client: Container client of the storage backend
+
+    Returns:
+        list - One dict per CSV: filename, file_id, file_size and blob_url
+
+    Raises:
+        HTTPException - 400 for an invalid zip archive or a batch over BATCH_MAX_FILES, before anything is uploaded
+    """
+    # Counted first, a batch over the limit must not leave the files uploaded before it was reached
+    plan = []
+    for file in files:
+        file.file.seek(0)
+        if (file.filename or "").lower().endswith(".zip") or zipfile.is_zipfile(file.file):
+            file.file.seek(0)
+            try:
+                with zipfile.ZipFile(file.file) as archive:
+                    plan.append((file, len(_csv_members(archive))))
+            except zipfile.BadZipFile:
+                raise HTTPException(status_code=400, detail=f"{file.filename} is not a valid zip archive")
+        else:
+            file.file.seek(0, os.SEEK_END)
+            plan.append((file, 1 if file.file.tell() else 0))
+    if sum(count for _, count in plan) > BATCH_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"A batch is limited to {BATCH_MAX_FILES} files")
+
+    uploaded = []
+
+    def upload(filename, stream, size):
+        file_id = str(uuid.uuid4())
+        blob_client = container_client.get_blob_client(file_id)
+        # Streamed, neither the archive nor its members are read into memory
+        with span("upload"):
+            blob_client.upload_blob(stream)
+        uploaded.append({"filename": filename, "file_id": file_id, "blob_url": blob_client.url, "file_size": size})
+
+    for file, count in plan:
+        if not count:
+            continue
+        file.file.seek(0)
+        if (file.filename or "").lower().endswith(".zip") or zipfile.is_zipfile(file.file):
+            file.file.seek(0)
+            with zipfile.ZipFile(file.file) as archive:
+                for member in _csv_members(archive):
+                    with archive.open(member) as stream:
+                        upload(os.path.basename(member.filename), stream, member.file_size)
+        else:
+            file.file.seek(0, os.SEEK_END)
+            size = file.file.tell()
+            file.file.seek(0)
+            upload(file.filename, file.file, size)
+    return uploaded
+
+async def process_batch_upload(files: list, background_tasks: BackgroundTasks = None):
+    """
+    Upload several CSV files (or zip archives of CSVs) and analyze them as one batch in the background
+    """
+    try:
+        # One storage connection, one MongoDB client and one insert for the whole batch
+        storage = get_storage()
+        client = await get_client()
+        logs_collection = buffered_logs(client)
+        container_client = storage.get_container_client("images-analysis")
+
+        uploaded = await asyncio.to_thread(upload_batch_files, files, container_client)
+        if not uploaded:
+            raise HTTPException(status_code=400, detail="No CSV files found in the upload")
+
+        parent_task_id = str(uuid.uuid4())
+        now = datetime.now()
+        children = []
+        for file_metadata in uploaded:
+            children.append({
+                "task_id": str(uuid.uuid4()),
+                "parent_task_id": parent_task_id,
+                "filename": file_metadata["filename"],
+                "file_id": file_metadata["file_id"],
+                "file_url": file_metadata["blob_url"],
+                "status": "pending",
+                "progress": 0.0,
+                "message": "Analysis queued",
+                "created_at": now,
+                "updated_at": now,
+                "report_url": None,
+                "raw_data_url": None
+            })
+            await logs_collection.insert_one({
+                **file_metadata,
+                "unique_filename": file_metadata["file_id"],
+                "upload_date": now.isoformat(),
+                "parent_task_id": parent_task_id,
+                "type": "File Information",
+                "timestamp": now
+            })
+
+        parent_document = {
+            "task_id": parent_task_id,
+            "type": "batch",
+            "status": "pending",
+            "progress": 0.0,
+            "message": f"Batch of {len(children)} files queued",
+            "children": [{"task_id": child["task_id"], "filename": child["filename"]} for child in children],
+            "children_status": {"pending": len(children)},
+            "created_at": now,
+            "updated_at": now
+        }
+        await insert_tasks(client, [parent_document, *children])
+
+        if background_tasks is not None:
+            for child in children:
+                analysis_queued(child["task_id"])
+            background_tasks.add_task(run_batch, parent_task_id=parent_task_id, children=children, client=client)
+
+        return {
+            "message": f"{len(children)} files uploaded successfully. Batch analysis started.",
+            "task_id": parent_task_id,
+            "status": "pending",
+            "children": parent_document["children"]
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error processing batch: {str(e)}")
+
+async def run_batch(parent_task_id: str, children: list, client):
+    """
+    Run the analyses of a batch through the shared slots and keep the progress of the parent task up to date
+
+    Args:
+        parent_task_id: The batch task
+        children: The child task documents (task_id, file_url)
+        client: MongoDB client
+    """
+    task_token = current_task_id.set(parent_task_id)
+    tasks_collection = get_tasks_collection(client)
+    # KPI plans and verified code shared by the files with the same schema
+    batch_context = BatchContext()
+
+    async def report_progress(final: bool = False):
+        found = {document["task_id"]: document
+                 for document in await find_tasks_progress(client, [child["task_id"] for child in children])}
+        documents = [found.get(child["task_id"], {}) for child in children]
+        children_status = {}
+        for document in documents:
+            status = document.get("status", "pending")
+            children_status[status] = children_status.get(status, 0) + 1
+        finished = children_status.get("completed", 0) + children_status.get("failed", 0)
+        update = {
+            "progress": round(sum(document.get("progress", 0.0) for document in documents) / len(children), 4),
+            "children_status": children_status,
+            "message": f"{finished}/{len(children)} files analyzed",
+            "schemas": batch_context.stats(),
+            "updated_at": datetime.now()
+        }
+        if final:
+            completed = children_status.get("completed", 0)
+            update["status"] = "completed" if completed else "failed"
+            update["message"] = (f"Batch finished: {completed}/{len(children)} files analyzed, "
+                                 f"{len(children) - completed} failed")
+        await progress_writer.update(tasks_collection, parent_task_id, update, flush=final)
+
+    async def run_child(child: dict):
+        async with batch_slots():
+            await run_analysis(child["task_id"], child["file_url"], client, batch_context)
+
+    workers = []
+    try:
+        await progress_writer.update(tasks_collection, parent_task_id, {
+            "status": "processing",
+            "message": f"Analyzing {len(children)} files...",
+            "updated_at": datetime.now()
+        }, flush=True)
+
+        workers = [asyncio.create_task(run_child(child)) for child in children]
+        pending = set(workers)
+        while pending:
+            _, pending = await asyncio.wait(pending, timeout=BATCH_PROGRESS_INTERVAL)
+            await report_progress()
+        await report_progress(final=True)
+    except Exception as e:
+        await progress_writer.update(tasks_collection, parent_task_id, {
+            "status": "failed",
+            "message": f"Batch failed: {str(e)}",
+            "error_detail": str(e),
+            "error_traceback": traceback.format_exc(),
+            "updated_at": datetime.now()
+        }, flush=True)
+    finally:
+        for worker in workers:
+            if not worker.done():
+                worker.cancel()
+        await flush_writers(parent_task_id)
+        current_task_id.reset(task_token)
+
+def publish_report(container_client, task_id: str, master_data_dictionary: dict, chart_images: dict = None,
+                   pending_kpis: list = None):
+    """
+    Render and upload the HTML report and the JSON data of a task.
+
+    Args:
+        container_client: Azure container client
+        task_id: The task
+        master_data_dictionary: The finished KPIs (and the summary)
+        chart_images: Chart bytes by KPI, embedded in the final report when SELF_CONTAINED_REPORTS is enabled
+        pending_kpis: KPIs still being analyzed, given for the partial reports published while the task runs
+
+    Returns:
+        tuple - (report_url, json_data_url)
+    """
+    from utils.html_report_generator import iter_html_report_bytes
+    from utils.artifact_store import upload_artifact, IMMUTABLE_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL
+
+    # The partial versions are overwritten by the next one, caches must revalidate them
+    cache_control = REVALIDATE_CACHE_CONTROL if pending_kpis is not None else IMMUTABLE_CACHE_CONTROL
+
+    # Upload JSON data directly to blob storage
+    json_data_url = upload_artifact(
+        container_client, f"data_{task_id}.json",
+        json.dumps(master_data_dictionary).encode('utf-8'), "application/json",
+        cache_control=cache_control
+    )
+
+    # Stream the rendered HTML chunks directly into blob storage (compressed on the fly)
+    # SELF_CONTAINED_REPORTS embeds the charts as data URIs so the report is a single file. Only in the final
+    # version: the partial ones are re-uploaded on every KPI and link the chart URLs instead
+    self_contained = (pending_kpis is None
+                      and os.getenv("SELF_CONTAINED_REPORTS", "false").lower() in ("1", "true", "yes"))
+    report_url = upload_artifact(
+        container_client, f"report_{task_id}.html",
+        iter_html_report_bytes(master_data_dictionary, self_contained=self_contained, chart_images=chart_images,
+                               pending_kpis=pending_kpis),
+        "text/html; charset=utf-8",
+        cache_control=cache_control
+    )
+    return report_url, json_data_url
+
+async def run_analysis(task_id: str, file_url: str, client, batch_context: BatchContext = None):
     """
     Run the data analysis process in the background
     
@@ -106,117 +369,176 @@ async def run_analysis(task_id: str, file_url: str, client):
         task_id: The unique identifier for this analysis task
         file_url: URL to the uploaded file in blob storage
         client: MongoDB client
+        batch_context: State shared with the other files of the batch (KPI plans and verified code per schema)
     """
+    query_engine = None
+    result = None
+    manager_task = None
+    aggregation_cache = None
+    task_status = "failed"
+    # Tag every log written while processing this task with its task_id
+    task_token = current_task_id.set(task_id)
+    # Collect the timing spans of every stage of the task
+    spans = []
+    spans_token = current_spans.set(spans)
+    # Collect the tokens, latency and retries of every model call of the task
+    llm_calls = []
+    llm_calls_token = current_llm_calls.set(llm_calls)
+    # Account the memory of the task and enforce its budget
+    memory_budget = MemoryBudget()
+    memory_budget_token = current_memory_budget.set(memory_budget)
+    schema_plan = None
+    schema_plan_token = current_schema_plan.set(None)
+    task_start = time.perf_counter()
+    analysis_started(task_id)
+    tasks_collection = get_tasks_collection(client)
     try:
-        # Get the database and collections
-        db = client["Python-Data-Analyst"]
-        tasks_collection = db["analysis_tasks"]
         
         # Update task status to "processing"
-        await tasks_collection.update_one(
-            {"task_id": task_id},
-            {"$set": {
-                "status": "processing",
-                "progress": 0.1,
-                "message": "Starting analysis...",
-                "updated_at": datetime.now()
-            }}
-        )
-        
-        # Download the file from blob storage
-        # We need to download it since our analysis code expects a local file
-        connection_string = os.getenv("BLOB_STORAGE_ACCOUNT_KEY")
-        blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-        
-        # Extract the container name and blob name from the URL
-        from urllib.parse import urlparse
-        parsed_url = urlparse(file_url)
-        path_parts = parsed_url.path.strip('/').split('/')
-        container_name = path_parts[0]
-        blob_name = '/'.join(path_parts[1:])
-        
-        # Get the blob client
-        blob_client = blob_service_client.get_blob_client(
-            container=container_name,
-            blob=blob_name
-        )
-        
-        # # Create a temporary directory if it doesn't exist
-        # os.makedirs("temp", exist_ok=True)
-        # local_file_path = f"temp/{blob_name.split('/')[-1]}"
+        await progress_writer.update(tasks_collection, task_id, {
+            "status": "processing",
+            "progress": 0.1,
+            "message": "Starting analysis...",
+            "updated_at": datetime.now()
+        }, flush=True)
         
-        # # Download the blob
-        # with open(local_file_path, "wb") as file:
-        #     file.write(blob_client.download_blob().readall())
+        # Storage backend of the uploaded file and the artifacts, load_data reads the file through it
+        # (memory-mapped from disk with the local backend, over HTTP with Azure)
+        storage = get_storage()
         
         # Update task status
-        await tasks_collection.update_one(
-            {"task_id": task_id},
-            {"$set": {
-                "progress": 0.2,
-                "message": "File downloaded, loading data...",
-                "updated_at": datetime.now()
-            }}
-        )
+        await progress_writer.update(tasks_collection, task_id, {
+            "progress": 0.2,
+            "message": "File downloaded, loading data...",
+            "updated_at": datetime.now()
+        })
         
         # Import our analysis functions
         from utils.services import (
             load_data, 
-            get_kpi, 
             get_analysis, 
             get_analysis_insights, 
             get_visualization,
-            get_insights_from_openai
+            get_insights_from_openai,
+            get_kpi_dataset_prompt,
+            get_combined_code,
+            get_combined_codegen_mode,
+            stream_kpis,
+            MAX_KPIS
         )
-        from utils.html_report_generator import create_html_report
+        from utils.aggregation_cache import AggregationCache
+        from utils.query_engine import QueryEngine, is_duckdb_enabled
+        from utils.out_of_core import ChunkedFrame
         
         # Load data
         result, columns, prompt = await load_data(file_url, client)
+
+        # Files of a batch with the same schema share the KPI plan and the code that ran successfully
+        if batch_context is not None:
+            schema_plan = batch_context.schema_plan(result)
+            current_schema_plan.set(schema_plan)
+            await progress_writer.update(tasks_collection, task_id, {"schema": schema_plan.fingerprint})
+
+        # Groupby/pivot results shared by the analysis and visualization code of every KPI
+        aggregation_cache = AggregationCache(result)
+
+        # Opt-in DuckDB engine (QUERY_ENGINE=duckdb) exposing sql() over the same dataframe,
+        # out-of-core datasets are registered as the on-disk Arrow dataset so DuckDB streams them too
+        if is_duckdb_enabled():
+            query_engine = QueryEngine(result.dataset if isinstance(result, ChunkedFrame) else result)
         
         # Update task status
-        await tasks_collection.update_one(
-            {"task_id": task_id},
-            {"$set": {
-                "progress": 0.3,
-                "message": "Data loaded, identifying KPIs...",
-                "updated_at": datetime.now()
-            }}
-        )
-        
-        # Get KPIs
-        kpi_names = await get_kpi(prompt, client)
-        
-        # Update task with identified KPIs
-        await tasks_collection.update_one(
-            {"task_id": task_id},
-            {"$set": {
-                "identified_kpis": kpi_names,
-                "updated_at": datetime.now()
-            }}
-        )
+        await progress_writer.update(tasks_collection, task_id, {
+            "progress": 0.3,
+            "message": "Data loaded, identifying KPIs...",
+            "updated_at": datetime.now()
+        })
+        
+        # Get KPIs, streamed: each KPI is queued as soon as the Manager agent has written its name,
+        # so the first KPI is analyzed while the Manager is still working on the others
+        kpi_names = []
+        kpi_queue = asyncio.Queue()
+
+        async def iterate(names):
+            for name in names:
+                yield name
+
+        async def discover_kpis():
+            # In a batch, the Manager only runs for the first file of each schema
+            planned_kpis = await schema_plan.kpi_plan() if schema_plan is not None else None
+            completed = False
+            try:
+                source = iterate(planned_kpis) if planned_kpis is not None else stream_kpis(prompt, client)
+                async for kpi_name in source:
+                    kpi_names.append(kpi_name)
+                    # Update task with identified KPIs
+                    await progress_writer.update(tasks_collection, task_id, {
+                        "identified_kpis": list(kpi_names),
+                        "updated_at": datetime.now()
+                    })
+                    await kpi_queue.put(kpi_name)
+                completed = True
+            finally:
+                # Share the plan with the files waiting for it (an unfinished one releases the claim)
+                if schema_plan is not None and planned_kpis is None:
+                    schema_plan.publish_kpis(kpi_names if completed else [])
+                # End of the KPIs
+                await kpi_queue.put(None)
+
+        manager_task = asyncio.create_task(discover_kpis())
         
         # Initialize master data dictionary
         master_data_dictionary = {}
         insights_master = ""
-        
-        # Process each KPI
-        total_kpis = len(kpi_names)
-        for index, kpi_name in enumerate(kpi_names):
+        # Chart bytes from the visualization stage, kept out of the (JSON serialized) master data dictionary
+        chart_images = {}
+        container_client = storage.get_container_client("images-analysis")
+        # The report is re-published after every KPI, the version is bumped each time
+        report_version = 0
+        
+        # Optional combined agent (COMBINED_CODEGEN) writing the analysis and chart code together,
+        # in batch mode a single call covers every KPI
+        codegen_mode = get_combined_codegen_mode()
+        kpi_code = {}
+        if codegen_mode == "batch":
+            # The batch needs every KPI name, wait for the Manager
+            await manager_task
+            # KPIs whose code was verified on another file of the schema don't need it
+            missing_kpis = [name for name in kpi_names if schema_plan is None or not schema_plan.has_code(name)]
+            if missing_kpis:
+                kpi_code = await get_combined_code(missing_kpis, prompt, client, result, query_engine)
+        
+        # Process each KPI as it arrives (one at a time, the generated code runs in this process)
+        index = 0
+        while True:
+            kpi_name = await kpi_queue.get()
+            if kpi_name is None:
+                break
+            # Until the Manager is done the number of KPIs is only known to be at most MAX_KPIS
+            total_kpis = len(kpi_names) if manager_task.done() else MAX_KPIS
             current_progress = 0.3 + (0.6 * (index / total_kpis))
+            index += 1
             
             # Update task status when starting KPI
-            await tasks_collection.update_one(
-                {"task_id": task_id},
-                {"$set": {
-                    "progress": current_progress,
-                    "message": f"Analyzing KPI: {kpi_name}",
-                    "current_kpi": kpi_name,
-                    "updated_at": datetime.now()
-                }}
-            )
+            await progress_writer.update(tasks_collection, task_id, {
+                "progress": current_progress,
+                "message": f"Analyzing KPI: {kpi_name}",
+                "current_kpi": kpi_name,
+                "updated_at": datetime.now()
+            })
+            
+            # Describe only the columns relevant to the KPI (wide datasets)
+            kpi_prompt = await get_kpi_dataset_prompt(kpi_name, prompt, client)
             
-            # Get analysis for the KPI
-            analysis = await get_analysis(kpi_name, prompt, client, result)
+            if codegen_mode == "kpi" and (schema_plan is None or not schema_plan.has_code(kpi_name)):
+                kpi_code.update(await get_combined_code([kpi_name], kpi_prompt, client, result, query_engine))
+            code = kpi_code.get(kpi_name)
+            
+            # Get analysis for the KPI (KPIs without combined code use the separate agents)
+            analysis = await get_analysis(kpi_name, kpi_prompt, client, result, aggregation_cache, query_engine,
+                                          code.analysis_code if code else None)
+            # The agents report failed KPIs in their result, a task over its memory budget is stopped here
+            memory_budget.raise_if_exceeded()
             
             # Initialize the dictionary entry for this KPI
             if kpi_name not in master_data_dictionary:
@@ -225,60 +547,77 @@ async def run_analysis(task_id: str, file_url: str, client):
             master_data_dictionary[kpi_name]["raw_response"] = analysis
             
             # Get visualization for the KPI
-            visualization = await get_visualization(kpi_name, prompt, client, result, blob_service_client)
+            visualization = await get_visualization(kpi_name, kpi_prompt, client, result, storage, aggregation_cache, query_engine,
+                                                    code.chart_code if code else None)
+            memory_budget.raise_if_exceeded()
+            image_bytes = visualization.pop("image_bytes", None)
+            raster_bytes = visualization.pop("raster_bytes", None)
+            if image_bytes:
+                chart_images[kpi_name] = image_bytes
             master_data_dictionary[kpi_name]["visualization"] = visualization
             
             # Update task with visualization URL
             if visualization["status"] == "success" and "visualization_url" in visualization:
-                await tasks_collection.update_one(
-                    {"task_id": task_id},
-                    {"$set": {
-                        "progress": current_progress + 0.3 * (1/total_kpis),
-                        "message": f"Generated visualization for: {kpi_name}",
-                        "updated_at": datetime.now(),
-                        f"partial_results.{kpi_name}.visualization_url": visualization["visualization_url"]
-                    }}
-                )
+                await progress_writer.update(tasks_collection, task_id, {
+                    "progress": current_progress + 0.3 * (1/total_kpis),
+                    "message": f"Generated visualization for: {kpi_name}",
+                    "updated_at": datetime.now(),
+                    f"partial_results.{kpi_name}.visualization_url": visualization["visualization_url"]
+                })
             
             # Generate insights for the KPI
-            insights = await get_analysis_insights(kpi_name, client, analysis, visualization["visualization_url"])
+            with span("insights", kpi_name):
+                insights = await get_analysis_insights(kpi_name, client, analysis, visualization["visualization_url"], raster_bytes)
             master_data_dictionary[kpi_name]["insights"] = insights
             insights_master += insights
             
             # Update task with insights
-            await tasks_collection.update_one(
-                {"task_id": task_id},
-                {"$set": {
-                    "progress": current_progress + 0.6 * (1/total_kpis),
-                    "message": f"Generated business insights for: {kpi_name}",
-                    "updated_at": datetime.now(),
-                    f"partial_results.{kpi_name}.insights": insights
-                }}
-            )
-        
-        # Generate summary of insights
-        await tasks_collection.update_one(
-            {"task_id": task_id},
-            {"$set": {
-                "progress": 0.9,
-                "message": "Generating summary...",
+            await progress_writer.update(tasks_collection, task_id, {
+                "progress": current_progress + 0.6 * (1/total_kpis),
+                "message": f"Generated business insights for: {kpi_name}",
+                "updated_at": datetime.now(),
+                f"partial_results.{kpi_name}.insights": insights
+            })
+            
+            # Publish the report with the KPIs done so far, the others and the summary as placeholders
+            # (kpi_names also holds the KPIs the Manager has named but that are not processed yet)
+            pending_kpis = [name for name in kpi_names if name not in master_data_dictionary]
+            with span("report:publish", kpi_name):
+                report_url, json_data_url = await asyncio.to_thread(
+                    publish_report, container_client, task_id, master_data_dictionary, chart_images, pending_kpis
+                )
+            report_version += 1
+            await progress_writer.update(tasks_collection, task_id, {
+                "report_url": report_url,
+                "raw_data_url": json_data_url,
+                "report_version": report_version,
+                "report_status": "partial",
                 "updated_at": datetime.now()
-            }}
-        )
+            })
         
-        summary = await get_insights_from_openai(insights_master, client)
+        # Raise the Manager's errors, if any
+        await manager_task
+        if not kpi_names:
+            raise Exception("No KPIs could be identified for this dataset")
+        
+        # Generate summary of insights
+        await progress_writer.update(tasks_collection, task_id, {
+            "progress": 0.9,
+            "message": "Generating summary...",
+            "updated_at": datetime.now()
+        })
+        
+        with span("summary"):
+            summary = await get_insights_from_openai(insights_master, client)
         master_data_dictionary["summary"] = summary
         
         # Update with summary
-        await tasks_collection.update_one(
-            {"task_id": task_id},
-            {"$set": {
-                "progress": 0.95,
-                "message": "Summary generated, creating final report...",
-                "updated_at": datetime.now(),
-                "summary": summary
-            }}
-        )
+        await progress_writer.update(tasks_collection, task_id, {
+            "progress": 0.95,
+            "message": "Summary generated, creating final report...",
+            "updated_at": datetime.now(),
+            "summary": summary
+        })
         
         # Save the master data dictionary to a json file
         os.makedirs("reports", exist_ok=True)
@@ -286,34 +625,25 @@ async def run_analysis(task_id: str, file_url: str, client):
         # with open(data_file_path, "w") as f:
         #     json.dump(master_data_dictionary, f)
         # Write master data dictionary to blob storage(directly)
-        # Save the master data dictionary to blob storage directly (no local file needed)
-        container_client = blob_service_client.get_container_client("images-analysis")
-
-        # Upload JSON data directly to blob storage
-        json_blob_client = container_client.get_blob_client(f"data_{task_id}.json")
-        json_blob_client.upload_blob(json.dumps(master_data_dictionary).encode('utf-8'), overwrite=True)
-        json_data_url = json_blob_client.url
-
-        # Generate HTML content in memory
-        html_content = create_html_report(master_data_dictionary)
-
-        # Upload HTML content directly to blob storage
-        html_blob_client = container_client.get_blob_client(f"report_{task_id}.html")
-        html_blob_client.upload_blob(html_content.encode('utf-8'), overwrite=True)
-        report_url = html_blob_client.url
+        # Save the master data dictionary and the final report to blob storage directly (no local file needed)
+        with span("report:publish"):
+            report_url, json_data_url = await asyncio.to_thread(
+                publish_report, container_client, task_id, master_data_dictionary, chart_images
+            )
+        report_version += 1
 
         # Update task status to completed with URLs to both files
-        await tasks_collection.update_one(
-            {"task_id": task_id},
-            {"$set": {
-                "status": "completed",
-                "progress": 1.0,
-                "message": "Analysis completed successfully",
-                "report_url": report_url,
-                "raw_data_url": json_data_url,  # Now this is a blob URL, not a local path
-                "updated_at": datetime.now()
-            }}
-        )
+        await progress_writer.update(tasks_collection, task_id, {
+            "status": "completed",
+            "progress": 1.0,
+            "message": "Analysis completed successfully",
+            "report_url": report_url,
+            "raw_data_url": json_data_url,  # Now this is a blob URL, not a local path
+            "report_version": report_version,
+            "report_status": "final",
+            "updated_at": datetime.now()
+        }, flush=True)
+        task_status = "completed"
 
         # Clean up the master data dictionary file
         if os.path.exists(data_file_path):
@@ -330,16 +660,50 @@ async def run_analysis(task_id: str, file_url: str, client):
         error_traceback = traceback.format_exc()
         
         # Update task status to failed
-        await tasks_collection.update_one(
-            {"task_id": task_id},
-            {"$set": {
-                "status": "failed",
-                "message": f"Analysis failed: {error_detail}",
-                "error_detail": error_detail,
-                "error_traceback": error_traceback,
-                "updated_at": datetime.now()
-            }}
-        )
+        await progress_writer.update(tasks_collection, task_id, {
+            "status": "failed",
+            "message": f"Analysis failed: {error_detail}",
+            "error_detail": error_detail,
+            "error_traceback": error_traceback,
+            "updated_at": datetime.now()
+        }, flush=True)
+    finally:
+        analysis_finished(task_id)
+
+        # Stop the KPI discovery if the analysis failed while it was still running
+        if manager_task is not None and not manager_task.done():
+            manager_task.cancel()
+
+        # Release the DuckDB connection (and the reference it holds to the dataframe)
+        if query_engine is not None:
+            query_engine.close()
+
+        # Remove the on-disk parquet dataset of out-of-core tasks
+        if hasattr(result, "close"):
+            result.close()
+
+        # Store where the time and the tokens went (and the cache statistics) in the task document
+        task_duration = time.perf_counter() - task_start
+        record_task(task_status, task_duration)
+        cache_stats = {}
+        if aggregation_cache is not None:
+            record_cache_lookups("aggregation", aggregation_cache.hits, aggregation_cache.misses)
+            cache_stats["aggregation"] = {"hits": aggregation_cache.hits, "misses": aggregation_cache.misses}
+        await progress_writer.update(tasks_collection, task_id, {
+            **summarize_spans(spans),
+            "duration": round(task_duration, 4),
+            "cache_stats": cache_stats,
+            "llm_usage": summarize_llm_calls(llm_calls),
+            "memory": summarize_memory(memory_budget, spans)
+        })
+
+        # Write the coalesced progress updates and the buffered logs of the task
+        await flush_writers(task_id)
+        current_spans.reset(spans_token)
+        current_llm_calls.reset(llm_calls_token)
+        current_memory_budget.reset(memory_budget_token)
+        current_schema_plan.reset(schema_plan_token)
+        current_task_id.reset(task_token)
 
 async def get_task_status_from_db(task_id: str):
     """
@@ -347,10 +711,8 @@ async def get_task_status_from_db(task_id: str):
     """
     try:
         client = await get_client()
-        db = client["Python-Data-Analyst"]
-        tasks_collection = db["analysis_tasks"]
         
-        task = await tasks_collection.find_one({"task_id": task_id})
+        task = await find_task(client, task_id)
         
         if not task:
             raise HTTPException(status_code=404, detail="Task not found")
@@ -0,0 +1,245 @@
+'''
+Liveness and readiness of a worker, for the load balancer and the autoscaler.
+
+Note:
+1. Everything is kept up to date in memory, a probe only reads counters: no database query, no blocking call.
+   - event-loop lag: monitor_event_loop (started by the lifespan) measures how late a periodic timer fires, a
+     loop blocked by exec or a synchronous blob call shows up here,
+   - analyses: process_uploaded_file marks a task queued, run_analysis running then finished (this worker only),
+   - executor: the default executor of the loop (asyncio.to_thread) counts its running and waiting jobs, AnyIO's
+     limiter those of the sync endpoints,
+   - memory: RSS against MEMORY_LIMIT_MB or the cgroup limit (see memory_budget.py).
+2. Liveness fails only when the loop is stuck (no timer tick for LIVENESS_MAX_STALL_SECONDS), a busy worker is
+   alive. Readiness also fails while warming up, when the loop lag p95, the running analyses (READY_MAX_ANALYSES,
+   0: no limit) or the memory headroom are over their limit, so new traffic goes to the other workers.
+3. The same figures are Prometheus gauges (event_loop_lag_seconds, analyses_in_flight, analyses_queued,
+   oldest_pending_analysis_age_seconds, executor_saturation, memory_headroom_bytes) for the scale-out rules.
+'''
+
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from utils.memory_budget import memory_limit, process_memory, MB
+from utils.metrics import metrics_enabled
+
+try:
+    from prometheus_client import Gauge # type: ignore
+except ImportError:
+    Gauge = None
+
+try:
+    import anyio.to_thread # type: ignore
+except ImportError:
+    anyio = None
+
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.25"))
+LIVENESS_MAX_STALL_SECONDS = float(os.getenv("LIVENESS_MAX_STALL_SECONDS", "30"))
+READY_MAX_LOOP_LAG_MS = float(os.getenv("READY_MAX_LOOP_LAG_MS", "500"))
+READY_MAX_ANALYSES = int(os.getenv("READY_MAX_ANALYSES", "0"))
+READY_MIN_MEMORY_HEADROOM_MB = float(os.getenv("READY_MIN_MEMORY_HEADROOM_MB", "256"))
+
+# Lag samples of the last minute or so
+_lag_samples = deque(maxlen=max(1, int(60 / LOOP_LAG_INTERVAL)))
+_last_tick = None
+
+# task_id -> time.monotonic() when it was queued / started, on this worker
+_queued = {}
+_running = {}
+
+_executor = None
+_memory_limit = None
+
+
+class MonitoredExecutor(ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor that counts its running and waiting jobs (the stdlib one doesn't expose them).
+    """
+
+    def __init__(self, max_workers: int = None, **kwargs):
+        super().__init__(max_workers=max_workers, **kwargs)
+        self.max_workers = self._max_workers
+        self._lock = threading.Lock()
+        self.active = 0
+        self.waiting = 0
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self._lock:
+            self.waiting += 1
+
+        def run():
+            with self._lock:
+                self.waiting -= 1
+                self.active += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.active -= 1
+
+        return super().submit(run)
+
+
+def install_executor(loop: asyncio.AbstractEventLoop = None) -> MonitoredExecutor:
+    """
+    Make a MonitoredExecutor the default executor of the loop (same size as the stdlib default, EXECUTOR_MAX_WORKERS).
+    """
+    global _executor
+    max_workers = int(os.getenv("EXECUTOR_MAX_WORKERS", "0")) or min(32, (os.cpu_count() or 1) + 4)
+    _executor = MonitoredExecutor(max_workers=max_workers, thread_name_prefix="analysis-executor")
+    (loop or asyncio.get_running_loop()).set_default_executor(_executor)
+    return _executor
+
+
+async def monitor_event_loop(interval: float = LOOP_LAG_INTERVAL):
+    """
+    This function is used to sample the event-loop lag until cancelled.
+    """
+    global _last_tick
+    _last_tick = time.monotonic()
+    while True:
+        expected = time.monotonic() + interval
+        await asyncio.sleep(interval)
+        _last_tick = time.monotonic()
+        lag = max(0.0, _last_tick - expected)
+        _lag_samples.append(lag)
+        if metrics_enabled() and Gauge is not None:
+            EVENT_LOOP_LAG.set(lag)
+
+
+def analysis_queued(task_id: str):
+    _queued[task_id] = time.monotonic()
+
+
+def analysis_started(task_id: str):
+    _queued.pop(task_id, None)
+    _running[task_id] = time.monotonic()
+
+
+def analysis_finished(task_id: str):
+    _queued.pop(task_id, None)
+    _running.pop(task_id, None)
+
+
+def _oldest_age(started: dict) -> float:
+    return round(time.monotonic() - min(started.values()), 3) if started else 0.0
+
+
+def loop_status() -> dict:
+    samples = sorted(_lag_samples)
+    return {
+        "lag_ms": round(_lag_samples[-1] * 1000, 1) if _lag_samples else None,
+        "p95_lag_ms": round(samples[int(0.95 * (len(samples) - 1))] * 1000, 1) if samples else None,
+        "max_lag_ms": round(samples[-1] * 1000, 1) if samples else None,
+        "seconds_since_tick": round(time.monotonic() - _last_tick, 3) if _last_tick is not None else None,
+    }
+
+
+def analyses_status() -> dict:
+    return {
+        "in_flight": len(_running),
+        "queued": len(_queued),
+        "oldest_pending_age_seconds": _oldest_age(_queued),
+        "oldest_running_age_seconds": _oldest_age(_running),
+    }
+
+
+def executor_status() -> dict:
+    status = {}
+    if _executor is not None:
+        status["default"] = {
+            "max_workers": _executor.max_workers,
+            "active": _executor.active,
+            "waiting": _executor.waiting,
+            "saturation": round(_executor.active / _executor.max_workers, 3),
+        }
+    if anyio is not None:
+        try:
+            limiter = anyio.to_thread.current_default_thread_limiter()
+            status["sync_endpoints"] = {
+                "max_workers": int(limiter.total_tokens),
+                "active": limiter.borrowed_tokens,
+                "saturation": round(limiter.borrowed_tokens / limiter.total_tokens, 3),
+            }
+        except RuntimeError:
+            # Outside of the event loop (no limiter yet)
+            pass
+    return status
+
+
+def memory_status() -> dict:
+    global _memory_limit
+    if _memory_limit is None:
+        # The limit doesn't change while the process runs, a probe reads only the RSS
+        _memory_limit = memory_limit() or 0
+    rss, _ = process_memory()
+    return {
+        "rss_mb": round(rss / MB, 1) if rss is not None else None,
+        "limit_mb": round(_memory_limit / MB, 1) if _memory_limit else None,
+        "headroom_mb": round((_memory_limit - rss) / MB, 1) if _memory_limit and rss is not None else None,
+    }
+
+
+def _headroom_bytes() -> float:
+    headroom_mb = memory_status()["headroom_mb"]
+    return headroom_mb * MB if headroom_mb is not None else -1
+
+
+def liveness() -> tuple:
+    """
+    This function is used to answer the liveness probe.
+
+    Returns:
+        tuple - (alive, body)
+    """
+    loop = loop_status()
+    alive = loop["seconds_since_tick"] is None or loop["seconds_since_tick"] < LIVENESS_MAX_STALL_SECONDS
+    return alive, {"status": "healthy" if alive else "unhealthy", "event_loop": loop}
+
+
+def readiness(warmup_status: str) -> tuple:
+    """
+    This function is used to answer the readiness probe.
+
+    Args:
+        warmup_status: str - Status of the warm-up (see warmup.py)
+
+    Returns:
+        tuple - (ready, body), the body lists the reasons when the worker is not ready
+    """
+    loop = loop_status()
+    analyses = analyses_status()
+    memory = memory_status()
+    reasons = []
+    if warmup_status not in ("ready", "degraded"):
+        reasons.append(f"warm-up {warmup_status}")
+    if loop["p95_lag_ms"] is not None and loop["p95_lag_ms"] > READY_MAX_LOOP_LAG_MS:
+        reasons.append(f"event-loop lag p95 {loop['p95_lag_ms']} ms over {READY_MAX_LOOP_LAG_MS:.0f} ms")
+    if READY_MAX_ANALYSES and analyses["in_flight"] >= READY_MAX_ANALYSES:
+        reasons.append(f"{analyses['in_flight']} analyses running, limit {READY_MAX_ANALYSES}")
+    if memory["headroom_mb"] is not None and memory["headroom_mb"] < READY_MIN_MEMORY_HEADROOM_MB:
+        reasons.append(f"memory headroom {memory['headroom_mb']} MB under {READY_MIN_MEMORY_HEADROOM_MB:.0f} MB")
+
+    return not reasons, {
+        "status": "ready" if not reasons else "not_ready",
+        "reasons": reasons,
+        "warmup": warmup_status,
+        "event_loop": loop,
+        "analyses": analyses,
+        "executor": executor_status(),
+        "memory": memory,
+    }
+
+
+if metrics_enabled() and Gauge is not None:
+    EVENT_LOOP_LAG = Gauge("event_loop_lag_seconds", "Lag of the last event-loop timer tick")
+    Gauge("analyses_in_flight", "Analyses running on this worker").set_function(lambda: len(_running))
+    Gauge("analyses_queued", "Analyses accepted but not started on this worker").set_function(lambda: len(_queued))
+    Gauge("oldest_pending_analysis_age_seconds", "Age of the oldest queued analysis").set_function(
+        lambda: _oldest_age(_queued))
+    Gauge("executor_saturation", "Share of the default executor's threads in use").set_function(
+        lambda: _executor.active / _executor.max_workers if _executor is not None else 0)
+    Gauge("memory_headroom_bytes", "Memory left before the worker's limit (-1 without a limit)").set_function(
+        _headroom_bytes)
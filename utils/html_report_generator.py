@@ -1,37 +1,146 @@
+'''
+HTML report generation.
+
+Note:
+1. The report template is compiled once at import time into literal chunks and fields, rendering is a generator
+   of chunks, so a report with many KPIs never exists as several full copies in memory. iter_html_report_bytes
+   can be passed straight to the blob upload.
+2. Every value coming from the pipeline (KPI names, analysis output, insights, summary, URLs) is HTML escaped.
+3. While a task is running the report is published after every KPI (pending_kpis): the KPIs that are not done yet
+   and the summary are rendered as placeholders and the page reloads itself every PARTIAL_REPORT_REFRESH seconds.
+'''
+
 import os
 import json
+import html
+import string
 from datetime import datetime
 import base64
 import re
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, Iterator, List, Optional
 import requests
+from utils.storage import get_storage
 
-def create_html_report(master_data_dict: Dict[str, Any], 
-                      visualization_urls: Dict[str, str] = None,
-                      output_filename: str = "data_analysis_report.html") -> str:
+_FORMATTER = string.Formatter()
+
+# Seconds between reloads of a partial report
+PARTIAL_REPORT_REFRESH = 20
+
+
+def _compile(template: str) -> list:
     """
-    Generate a beautiful HTML report from KPI analysis data, business insights, and visualization URLs.
-    
+    Split a str.format template into (literal, field) pairs once, so rendering is only a walk over the pairs.
+    """
+    return [(literal, field) for literal, field, _, _ in _FORMATTER.parse(template)]
+
+
+def _render(compiled: list, values: dict) -> Iterator[str]:
+    """
+    Yield the chunks of a compiled template, values must already be escaped.
+    """
+    for literal, field in compiled:
+        if literal:
+            yield literal
+        if field is not None:
+            yield str(values[field])
+
+
+def _paragraphs(text) -> str:
+    """
+    Escape free text (insights, summary) and keep its paragraphs and line breaks.
+    """
+    paragraphs = [p.strip() for p in re.split(r"\n\s*\n", str(text)) if p.strip()]
+    return "".join("<p>" + html.escape(p).replace("\n", "<br>") + "</p>" for p in paragraphs)
+
+
+def _image_content_type(data: bytes) -> str:
+    """
+    Detect the image type from its first bytes.
+    """
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data.lstrip()[:5] in (b"<?xml", b"<svg ") or b"<svg" in data[:512]:
+        return "image/svg+xml"
+    return "image/png"
+
+
+def _data_uri(data: bytes, content_type: str = None) -> str:
+    return f"data:{content_type or _image_content_type(data)};base64,{base64.b64encode(data).decode('ascii')}"
+
+
+def _fetch_image(url: str, timeout: float):
+    # Charts of the local storage backend are read from disk
+    local_path = get_storage().local_path(url)
+    if local_path is not None:
+        with open(local_path, "rb") as file:
+            return file.read(), None
+    response = requests.get(url, timeout=timeout)
+    response.raise_for_status()
+    return response.content, response.headers.get('Content-Type')
+
+
+def embed_chart_images(master_data_dict: Dict[str, Any],
+                       chart_images: Dict[str, bytes] = None,
+                       timeout: float = 10,
+                       max_workers: int = 8) -> Dict[str, str]:
+    """
+    Build data URIs for the charts of the report, so it is self-contained.
+
     Parameters:
-    - master_data_dict: Dictionary with KPI data including raw_response and insights
-    - visualization_urls: Dictionary with KPI names as keys and visualization URLs as values 
-                         (optional, will use URLs from master_data_dict if not provided)
-    - output_filename: Output HTML file name
-    
+    - master_data_dict: Dictionary with KPI data including visualization URLs
+    - chart_images: Dictionary with KPI names as keys and the chart bytes from the visualization stage as values
+    - timeout: Timeout (seconds) of each download for the charts that have no bytes
+    - max_workers: Number of concurrent downloads
+
     Returns:
-    - Path to the generated HTML file
+    - Dictionary with KPI names as keys and data URIs as values (KPIs whose chart is unavailable are left out)
     """
-    # Get current timestamp for the report
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    
-    # Start building HTML content
-    html_content = f"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    chart_images = chart_images or {}
+    embedded = {}
+    missing = {}
+    for kpi_name, kpi_data in master_data_dict.items():
+        if kpi_name == "summary" or not isinstance(kpi_data, dict):
+            continue
+        if chart_images.get(kpi_name):
+            # The bytes are encoded once, straight from the pipeline
+            embedded[kpi_name] = _data_uri(chart_images[kpi_name])
+            continue
+        url = (kpi_data.get("visualization") or {}).get("visualization_url")
+        if url and not url.startswith("data:"):
+            missing[kpi_name] = url
+
+    if missing:
+        # Only charts we don't have bytes for are downloaded, concurrently and with a timeout
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(missing))) as executor:
+            futures = {kpi_name: executor.submit(_fetch_image, url, timeout) for kpi_name, url in missing.items()}
+            for kpi_name, future in futures.items():
+                try:
+                    content, content_type = future.result()
+                    embedded[kpi_name] = _data_uri(content, content_type)
+                except Exception as e:
+                    print(f"Error downloading image for {kpi_name}: {e}")
+
+    return embedded
+
+
+def _kpi_id(kpi_name: str) -> str:
+    # Create a valid ID from KPI name
+    return re.sub(r'[^a-zA-Z0-9_-]', '_', kpi_name)
+
+
+REPORT_START = _compile("""
     <!DOCTYPE html>
     <html lang="en">
     <head>
         <meta charset="UTF-8">
         <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>Deep Analysis Report</title>
+        <title>Deep Analysis Report</title>{head_extra}
         <style>
             :root {{
                 --primary-color: #1a73e8;
@@ -374,66 +483,62 @@ def create_html_report(master_data_dict: Dict[str, Any],
         <section id="summary" class="container">
             <div class="summary-section">
                 <h2>Executive Summary</h2>
-                <p>This report presents a comprehensive deep analysis of {len(master_data_dict) - 1 if "summary" in master_data_dict else len(master_data_dict)} key performance indicators derived from the dataset. Each KPI is analyzed with detailed metrics, visualizations, and business insights to support data-driven decision making.</p>
+                <p>This report presents a comprehensive deep analysis of {kpi_count} key performance indicators derived from the dataset. Each KPI is analyzed with detailed metrics, visualizations, and business insights to support data-driven decision making.</p>
                 
-                {f'<div class="executive-insights-container"><h3 style="margin-top: 20px; color: var(--primary-color);">AI-Generated Summary</h3><div class="executive-insights-content">{master_data_dict.get("summary", "")}</div></div>' if "summary" in master_data_dict else ""}
+                {summary_block}
                 
                 <h3 style="margin-top: 20px; color: var(--primary-color);">Analyzed KPIs</h3>
                 <div class="kpi-list">
-    """
-    
-    # Add KPI tags
-    for kpi_name in master_data_dict.keys():
-        html_content += f'<span class="kpi-tag">{kpi_name}</span>\n'
-    
-    html_content += """
+    """)
+
+KPI_TAG = _compile("""<span class="kpi-tag">{kpi_name}</span>
+""")
+
+KPI_CARDS_START = _compile("""
                 </div>
                 
                 <h3 style="margin-top: 25px; color: var(--primary-color);">Quick Navigation</h3>
                 <div class="kpi-cards">
-    """
-    
-    # Add quick navigation cards
-    for kpi_name in master_data_dict.keys():
-        # Create a valid ID from KPI name
-        kpi_id = re.sub(r'[^a-zA-Z0-9_-]', '_', kpi_name)
-        html_content += f"""
+    """)
+
+KPI_CARD = _compile("""
                     <div class="kpi-card" onclick="document.getElementById('{kpi_id}').scrollIntoView({{behavior: 'smooth'}})">
                         <h3>{kpi_name}</h3>
                         <p>View analysis and insights</p>
                     </div>
-        """
-    
-    html_content += """
+        """)
+
+KPI_SECTIONS_START = _compile("""
                 </div>
             </div>
         </section>
         
         <!-- KPIs Section -->
         <section id="kpis" class="container">
-    """
-    
-    # Add each KPI section
-    for kpi_name, kpi_data in master_data_dict.items():
-        # Skip the summary key as it's handled separately
-        if kpi_name == "summary":
-            continue
-            
-        # Create a valid ID from KPI name
-        kpi_id = re.sub(r'[^a-zA-Z0-9_-]', '_', kpi_name)
-        
-        # Get visualization URL
-        visualization_url = ""
-        if visualization_urls and kpi_name in visualization_urls:
-            visualization_url = visualization_urls[kpi_name]
-        elif "visualization" in kpi_data and "visualization_url" in kpi_data["visualization"]:
-            visualization_url = kpi_data["visualization"]["visualization_url"]
-        
-        # Get raw analysis and insights
-        raw_analysis = kpi_data.get("raw_response", "No analysis available")
-        insights = kpi_data.get("insights", "No insights available")
-        
-        html_content += f"""
+    """)
+
+SUMMARY_BLOCK = _compile('''<div class="executive-insights-container"><h3 style="margin-top: 20px; color: var(--primary-color);">AI-Generated Summary</h3><div class="executive-insights-content">{summary}</div></div>''')
+
+VISUALIZATION_IMAGE = _compile('''<img src="{visualization_url}" alt="Visualization for {kpi_name}">''')
+
+NO_VISUALIZATION = '<p style="padding: 40px; color: var(--light-text);">No visualization available</p>'
+
+PARTIAL_REPORT_HEAD = f'\n        <meta http-equiv="refresh" content="{PARTIAL_REPORT_REFRESH}">'
+
+SUMMARY_PENDING = '<div class="executive-insights-container"><h3 style="margin-top: 20px; color: var(--primary-color);">AI-Generated Summary</h3><div class="executive-insights-content"><p style="color: var(--light-text);">The summary will be available when every KPI has been analyzed. This page refreshes automatically.</p></div></div>'
+
+PENDING_KPI_SECTION = _compile("""
+            <div id="{kpi_id}" class="kpi-section">
+                <div class="kpi-header">
+                    <h2>{kpi_name}</h2>
+                </div>
+                <div class="kpi-content">
+                    <p style="padding: 40px; color: var(--light-text);">Analysis in progress...</p>
+                </div>
+            </div>
+        """)
+
+KPI_SECTION = _compile("""
             <div id="{kpi_id}" class="kpi-section">
                 <div class="kpi-header">
                     <h2>{kpi_name}</h2>
@@ -441,14 +546,7 @@ def create_html_report(master_data_dict: Dict[str, Any],
                 <div class="kpi-content">
                     <!-- Visualization -->
                     <div class="visualization">
-        """
-        
-        if visualization_url:
-            html_content += f'<img src="{visualization_url}" alt="Visualization for {kpi_name}">'
-        else:
-            html_content += '<p style="padding: 40px; color: var(--light-text);">No visualization available</p>'
-        
-        html_content += f"""
+        {visualization}
                     </div>
                     
                     <!-- Analysis Results -->
@@ -468,10 +566,9 @@ def create_html_report(master_data_dict: Dict[str, Any],
                     </div>
                 </div>
             </div>
-        """
-    
-    # Close the HTML structure
-    html_content += """
+        """)
+
+REPORT_END = _compile("""
         </section>
         
         <!-- Footer -->
@@ -482,31 +579,169 @@ def create_html_report(master_data_dict: Dict[str, Any],
         
         <script>
             // JavaScript for interactive elements
-            document.addEventListener('DOMContentLoaded', function() {
+            document.addEventListener('DOMContentLoaded', function() {{
                 // Show/hide back to top button based on scroll position
-                window.addEventListener('scroll', function() {
+                window.addEventListener('scroll', function() {{
                     const backToTopButton = document.querySelector('.back-to-top');
-                    if (window.scrollY > 300) {
+                    if (window.scrollY > 300) {{
                         backToTopButton.style.display = 'flex';
-                    } else {
+                    }} else {{
                         backToTopButton.style.display = 'none';
-                    }
-                });
+                    }}
+                }});
                 
                 // Initially hide the button
                 document.querySelector('.back-to-top').style.display = 'none';
-            });
+            }});
         </script>
     </body>
     </html>
+    """)
+
+
+def iter_html_report(master_data_dict: Dict[str, Any],
+                     visualization_urls: Dict[str, str] = None,
+                     self_contained: bool = False,
+                     chart_images: Dict[str, bytes] = None,
+                     pending_kpis: List[str] = None) -> Iterator[str]:
+    """
+    Render the HTML report as a generator of chunks.
+
+    Parameters:
+    - master_data_dict: Dictionary with KPI data including raw_response and insights
+    - visualization_urls: Dictionary with KPI names as keys and visualization URLs as values
+                         (optional, will use URLs from master_data_dict if not provided)
+    - self_contained: Embed the charts as base64 data URIs instead of linking them
+    - chart_images: Dictionary with KPI names as keys and chart bytes as values, used by self_contained
+    - pending_kpis: KPIs that are still being analyzed, given only for a partial report (placeholders are rendered
+                    for them and for the summary)
+
+    Returns:
+    - Iterator over the chunks of the HTML document
     """
+    # Get current timestamp for the report
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    if self_contained:
+        visualization_urls = {**(visualization_urls or {}), **embed_chart_images(master_data_dict, chart_images)}
+
+    # Walk the dictionary once, the KPIs are listed three times (tags, cards, sections)
+    kpis = []
+    for kpi_name, kpi_data in master_data_dict.items():
+        # Skip the summary key as it's handled separately
+        if kpi_name == "summary":
+            continue
+
+        # Get visualization URL
+        visualization_url = ""
+        if visualization_urls and kpi_name in visualization_urls:
+            visualization_url = visualization_urls[kpi_name]
+        elif isinstance(kpi_data.get("visualization"), dict):
+            visualization_url = kpi_data["visualization"].get("visualization_url") or ""
+
+        kpis.append({
+            "kpi_id": _kpi_id(kpi_name),
+            "kpi_name": html.escape(kpi_name),
+            "visualization_url": html.escape(visualization_url, quote=True),
+            "kpi_data": kpi_data,
+        })
+
+    partial = pending_kpis is not None
+    for kpi_name in pending_kpis or []:
+        if kpi_name not in master_data_dict:
+            kpis.append({"kpi_id": _kpi_id(kpi_name), "kpi_name": html.escape(kpi_name), "pending": True})
+
+    summary_block = ""
+    if "summary" in master_data_dict:
+        summary_block = "".join(_render(SUMMARY_BLOCK, {"summary": _paragraphs(master_data_dict["summary"])}))
+    elif partial:
+        summary_block = SUMMARY_PENDING
+
+    yield from _render(REPORT_START, {
+        "timestamp": timestamp,
+        "kpi_count": len(kpis),
+        "summary_block": summary_block,
+        "head_extra": PARTIAL_REPORT_HEAD if partial else "",
+    })
+
+    # Add KPI tags
+    for kpi in kpis:
+        yield from _render(KPI_TAG, kpi)
+
+    # Add quick navigation cards
+    yield from _render(KPI_CARDS_START, {})
+    for kpi in kpis:
+        yield from _render(KPI_CARD, kpi)
+
+    # Add each KPI section
+    yield from _render(KPI_SECTIONS_START, {})
+    for kpi in kpis:
+        if kpi.get("pending"):
+            yield from _render(PENDING_KPI_SECTION, kpi)
+            continue
+        kpi_data = kpi["kpi_data"]
+        if kpi["visualization_url"]:
+            visualization = "".join(_render(VISUALIZATION_IMAGE, kpi))
+        else:
+            visualization = NO_VISUALIZATION
+
+        yield from _render(KPI_SECTION, {
+            "kpi_id": kpi["kpi_id"],
+            "kpi_name": kpi["kpi_name"],
+            "visualization": visualization,
+            "raw_analysis": html.escape(str(kpi_data.get("raw_response", "No analysis available"))),
+            "insights": _paragraphs(kpi_data.get("insights", "No insights available")),
+        })
+
+    # Close the HTML structure
+    yield from _render(REPORT_END, {})
+
+
+def iter_html_report_bytes(master_data_dict: Dict[str, Any],
+                           visualization_urls: Dict[str, str] = None,
+                           self_contained: bool = False,
+                           chart_images: Dict[str, bytes] = None,
+                           pending_kpis: List[str] = None,
+                           chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    """
+    Render the HTML report as utf-8 encoded chunks of about chunk_size bytes, ready to stream into a blob upload.
+    """
+    buffer = []
+    buffered = 0
+    for chunk in iter_html_report(master_data_dict, visualization_urls, self_contained, chart_images, pending_kpis):
+        encoded = chunk.encode('utf-8')
+        buffer.append(encoded)
+        buffered += len(encoded)
+        if buffered >= chunk_size:
+            yield b"".join(buffer)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+def create_html_report(master_data_dict: Dict[str, Any], 
+                      visualization_urls: Dict[str, str] = None,
+                      output_filename: str = "data_analysis_report.html",
+                      self_contained: bool = False,
+                      chart_images: Dict[str, bytes] = None,
+                      pending_kpis: List[str] = None) -> str:
+    """
+    Generate a beautiful HTML report from KPI analysis data, business insights, and visualization URLs.
     
-    # # Write the HTML file
-    # with open(output_filename, 'w', encoding='utf-8') as f:
-    #     f.write(html_content)
+    Parameters:
+    - master_data_dict: Dictionary with KPI data including raw_response and insights
+    - visualization_urls: Dictionary with KPI names as keys and visualization URLs as values 
+                         (optional, will use URLs from master_data_dict if not provided)
+    - output_filename: Output HTML file name
+    - self_contained: Embed the charts as base64 data URIs (single-file report)
+    - chart_images: Dictionary with KPI names as keys and chart bytes as values, used by self_contained
+    - pending_kpis: KPIs still being analyzed, renders a partial report with placeholders
     
-    # print(f"HTML report created successfully: {output_filename}")
-    return html_content
+    Returns:
+    - The HTML content (use iter_html_report / iter_html_report_bytes to stream it instead)
+    """
+    return "".join(iter_html_report(master_data_dict, visualization_urls, self_contained, chart_images, pending_kpis))
 
 
 def generate_html_report(json_path="master_data_dictionary.json", output_filename="data_analysis_report.html"):
@@ -536,6 +771,9 @@ def download_local_images_as_base64(master_data_dict):
     """
     Download images from URLs in master_data_dict and replace with base64 encoded images.
     This makes the HTML report self-contained.
+
+    Prefer create_html_report(..., self_contained=True, chart_images=...), which reuses the chart bytes
+    from the pipeline and only downloads what is missing.
     
     Parameters:
     - master_data_dict: Dictionary with KPI data including visualization URLs
@@ -544,22 +782,10 @@ def download_local_images_as_base64(master_data_dict):
     - Updated master_data_dict with base64 encoded images
     """
     updated_dict = master_data_dict.copy()
-    
-    for kpi_name, kpi_data in updated_dict.items():
-        if "visualization" in kpi_data and "visualization_url" in kpi_data["visualization"]:
-            url = kpi_data["visualization"]["visualization_url"]
-            try:
-                # Download the image
-                response = requests.get(url)
-                if response.status_code == 200:
-                    # Convert to base64
-                    image_data = base64.b64encode(response.content).decode('utf-8')
-                    # Determine the image type
-                    content_type = response.headers.get('Content-Type', 'image/png')
-                    # Replace the URL with base64 data
-                    updated_dict[kpi_name]["visualization"]["visualization_url"] = f"data:{content_type};base64,{image_data}"
-            except Exception as e:
-                print(f"Error downloading image for {kpi_name}: {e}")
+
+    # Downloads run concurrently with a timeout
+    for kpi_name, data_uri in embed_chart_images(master_data_dict).items():
+        updated_dict[kpi_name]["visualization"]["visualization_url"] = data_uri
     
     return updated_dict
 
@@ -576,8 +802,7 @@ if __name__ == "__main__":
             data_dict = json.load(f)
         
         # Embed images as base64 (optional)
-        # data_dict_with_embedded_images = download_local_images_as_base64(data_dict)
-        # report_path = create_html_report(data_dict_with_embedded_images, output_filename="self_contained_report.html")
+        # report_path = create_html_report(data_dict, output_filename="self_contained_report.html", self_contained=True)
         
         report_path = create_html_report(data_dict, output_filename="data_analysis_report.html")
         print(f"Self-contained report generated at: {report_path}")
@@ -0,0 +1,151 @@
+'''
+Telemetry of the model calls: tokens, latency, time to first token and retries, per agent and per task.
+
+Note:
+1. Every model call goes through run_agent (services.py) or is recorded by hand (streamed Manager, Business Analyst)
+   with record_llm_call. The calls of a task are collected in a ContextVar, like the timing spans of metrics.py.
+2. run_analysis stores the per-agent rollup (summarize_llm_calls) in the task document as llm_usage, and every
+   call is also written to the logs with its task_id and kpi_name.
+3. cached_tokens is the part of the input served from the provider's prompt cache (see prompt_builder.py).
+4. Transient provider errors (rate limits, timeouts, 5xx) are retried LLM_MAX_RETRIES times with exponential backoff.
+   The shared OpenAI client (agents and Business Analyst) is created with max_retries=0 (services.py), so these are
+   the only retries.
+'''
+
+import os
+from contextvars import ContextVar
+from datetime import datetime
+from utils.metrics import metrics_enabled
+
+try:
+    from prometheus_client import Counter, Histogram # type: ignore
+except ImportError:
+    Counter = Histogram = None
+
+try:
+    from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+    RETRYABLE_ERRORS = (APIConnectionError, APITimeoutError, InternalServerError, RateLimitError)
+except ImportError:
+    RETRYABLE_ERRORS = ()
+
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BACKOFF = float(os.getenv("LLM_RETRY_BACKOFF", "1.0"))
+
+# Model calls of the task being processed
+current_llm_calls = ContextVar("current_llm_calls", default=None)
+
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+
+if metrics_enabled():
+    LLM_TOKENS = Counter("llm_tokens_total", "Tokens of the model calls", ["agent", "model", "kind"])
+    LLM_LATENCY = Histogram("llm_call_duration_seconds", "Latency of the model calls", ["agent", "model"],
+                            buckets=LATENCY_BUCKETS)
+    LLM_TTFT = Histogram("llm_time_to_first_token_seconds", "Time to the first output token", ["agent", "model"],
+                         buckets=LATENCY_BUCKETS)
+    LLM_RETRIES = Counter("llm_retries_total", "Retried model calls", ["agent", "model"])
+    LLM_CALLS = Counter("llm_calls_total", "Model calls", ["agent", "model", "status"])
+
+
+def usage_fields(usage) -> dict:
+    """
+    This function is used to read the token counts of an agents Usage or an OpenAI ResponseUsage.
+
+    Args:
+        usage: The usage object (None when the call failed)
+
+    Returns:
+        dict - input_tokens, output_tokens and cached_tokens
+    """
+    if usage is None:
+        return {"input_tokens": 0, "output_tokens": 0, "cached_tokens": 0}
+    details = getattr(usage, "input_tokens_details", None)
+    return {
+        "input_tokens": getattr(usage, "input_tokens", 0) or 0,
+        "output_tokens": getattr(usage, "output_tokens", 0) or 0,
+        "cached_tokens": (getattr(details, "cached_tokens", 0) or 0) if details is not None else 0,
+    }
+
+
+def record_llm_call(agent: str, model: str, started_at: datetime, latency: float, ttft: float = None,
+                    usage=None, retries: int = 0, status: str = "success", kpi_name: str = None) -> dict:
+    """
+    This function is used to record a model call of the current task.
+
+    Args:
+        agent: str - The agent name (Manager, Data Analyst, Debug Agent...)
+        model: str - The model
+        started_at: datetime - When the call started
+        latency: float - Seconds until the call completed (retries included)
+        ttft: float - Seconds until the first output token (None when it was not streamed or nothing came)
+        usage: The usage object of the call
+        retries: int - Number of retries
+        status: str - success or error
+        kpi_name: str - The KPI the call is for (optional)
+
+    Returns:
+        dict - The recorded call
+    """
+    call = {
+        "agent": agent,
+        "model": model,
+        "kpi_name": kpi_name,
+        "started_at": started_at,
+        "latency": round(latency, 4),
+        "ttft": round(ttft, 4) if ttft is not None else None,
+        "retries": retries,
+        "status": status,
+        **usage_fields(usage),
+    }
+
+    if metrics_enabled():
+        LLM_CALLS.labels(agent=agent, model=model, status=status).inc()
+        LLM_LATENCY.labels(agent=agent, model=model).observe(latency)
+        if ttft is not None:
+            LLM_TTFT.labels(agent=agent, model=model).observe(ttft)
+        if retries:
+            LLM_RETRIES.labels(agent=agent, model=model).inc(retries)
+        for kind in ("input_tokens", "output_tokens", "cached_tokens"):
+            if call[kind]:
+                LLM_TOKENS.labels(agent=agent, model=model, kind=kind).inc(call[kind])
+
+    calls = current_llm_calls.get()
+    if calls is not None:
+        calls.append(call)
+    return call
+
+
+def summarize_llm_calls(calls: list) -> dict:
+    """
+    This function is used to build the per-task rollup of the model calls.
+
+    Args:
+        calls: list - The recorded calls of the task
+
+    Returns:
+        dict - Totals per agent and for the whole task
+    """
+    def empty():
+        return {"calls": 0, "errors": 0, "retries": 0, "input_tokens": 0, "output_tokens": 0, "cached_tokens": 0,
+                "latency": 0.0, "ttft_total": 0.0, "ttft_calls": 0}
+
+    agents = {}
+    total = empty()
+    for call in calls:
+        for rollup in (agents.setdefault(call["agent"], {**empty(), "model": call["model"]}), total):
+            rollup["calls"] += 1
+            rollup["errors"] += call["status"] != "success"
+            rollup["retries"] += call["retries"]
+            rollup["input_tokens"] += call["input_tokens"]
+            rollup["output_tokens"] += call["output_tokens"]
+            rollup["cached_tokens"] += call["cached_tokens"]
+            rollup["latency"] += call["latency"]
+            if call["ttft"] is not None:
+                rollup["ttft_total"] += call["ttft"]
+                rollup["ttft_calls"] += 1
+
+    for rollup in list(agents.values()) + [total]:
+        ttft_total, ttft_calls = rollup.pop("ttft_total"), rollup.pop("ttft_calls")
+        rollup["latency"] = round(rollup["latency"], 4)
+        rollup["avg_ttft"] = round(ttft_total / ttft_calls, 4) if ttft_calls else None
+
+    return {"agents": agents, "total": total}
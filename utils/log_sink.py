@@ -0,0 +1,223 @@
+'''
+Buffered, asynchronous writers for the logs and the task progress.
+
+Note:
+1. A task makes dozens of single insert_one calls to the logs collection, each one waiting for a round trip on the
+   critical path. LogSink queues them (bounded, so a slow database applies backpressure instead of growing memory)
+   and a background worker writes them with unordered insert_many batches.
+2. ProgressWriter merges the rapid $set progress updates of a task into one update_one. Status changes
+   (processing/completed/failed) are written right away with flush=True.
+3. Both are flushed at the end of every task and on shutdown (app.py). The end of a task waits only for its own
+   documents (counted per task_id), not for the logs the other tasks keep queueing.
+'''
+
+import asyncio
+import os
+from contextvars import ContextVar
+from database.repository import get_logs_collection
+
+# The task being processed, added to every log document so the logs of a task can be queried by task_id
+current_task_id = ContextVar("current_task_id", default=None)
+
+
+class LogSink:
+    """
+    Background writer that batches log documents into insert_many calls.
+    """
+
+    def __init__(self, max_queue: int = None, batch_size: int = None, flush_interval: float = None):
+        self.max_queue = max_queue or int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+        self.batch_size = batch_size or int(os.getenv("LOG_BATCH_SIZE", "200"))
+        self.flush_interval = flush_interval or float(os.getenv("LOG_FLUSH_INTERVAL", "0.5"))
+        self._queue = None
+        self._worker = None
+        # task_id -> [queued documents not written yet, event set when it reaches 0]
+        self._pending = {}
+
+    def _ensure_worker(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def insert_one(self, collection, document: dict):
+        """
+        Queue a document for the collection, waits only when the queue is full.
+        """
+        self._ensure_worker()
+        task_id = document.get("task_id")
+        if task_id is not None:
+            entry = self._pending.setdefault(task_id, [0, asyncio.Event()])
+            entry[0] += 1
+        try:
+            await self._queue.put((collection, document))
+        except BaseException:
+            self._written(task_id)
+            raise
+
+    def _written(self, task_id):
+        entry = self._pending.get(task_id)
+        if entry is None:
+            return
+        entry[0] -= 1
+        if entry[0] <= 0:
+            entry[1].set()
+            del self._pending[task_id]
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+
+            # Collect whatever arrives within flush_interval, up to batch_size documents
+            deadline = asyncio.get_running_loop().time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await self._write(batch)
+            for _, document in batch:
+                self._written(document.get("task_id"))
+                self._queue.task_done()
+
+    async def _write(self, batch: list):
+        # Group the documents by target collection
+        groups = {}
+        for collection, document in batch:
+            groups.setdefault(collection.full_name, (collection, []))[1].append(document)
+
+        for collection, documents in groups.values():
+            try:
+                await collection.insert_many(documents, ordered=False)
+            except Exception as e:
+                print(f"Error writing {len(documents)} log documents to {collection.full_name}: {e}")
+
+    async def flush(self, task_id: str = None):
+        """
+        Wait until the queued documents (of one task, or every queued document) have been written.
+        """
+        if self._queue is None or self._worker is None or self._worker.done():
+            return
+        if task_id is None:
+            await self._queue.join()
+        elif task_id in self._pending:
+            await self._pending[task_id][1].wait()
+
+    async def close(self):
+        await self.flush()
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+
+class BufferedCollection:
+    """
+    Drop-in for a motor collection that is only used with insert_one, the writes go through the LogSink.
+    """
+
+    def __init__(self, collection, sink: LogSink):
+        self.collection = collection
+        self.sink = sink
+
+    async def insert_one(self, document: dict):
+        task_id = current_task_id.get()
+        if task_id is not None:
+            document.setdefault("task_id", task_id)
+        await self.sink.insert_one(self.collection, document)
+
+
+class ProgressWriter:
+    """
+    Coalesces $set updates to the same task document into a single update_one.
+    """
+
+    def __init__(self, flush_interval: float = None):
+        self.flush_interval = flush_interval or float(os.getenv("PROGRESS_FLUSH_INTERVAL", "1.0"))
+        self._pending = {}
+        self._timers = {}
+        self._lock = None
+
+    def _get_lock(self) -> asyncio.Lock:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def update(self, collection, task_id: str, fields: dict, flush: bool = False):
+        """
+        This function is used to update the task document.
+
+        Args:
+            collection: The analysis_tasks collection
+            task_id: str - The task to update
+            fields: dict - The fields to $set
+            flush: bool - Write right away (together with everything pending for the task)
+        """
+        key = (collection.full_name, task_id)
+        _, pending = self._pending.setdefault(key, (collection, {}))
+        pending.update(fields)
+
+        if flush:
+            await self._write(key)
+        elif key not in self._timers:
+            self._timers[key] = asyncio.get_running_loop().create_task(self._delayed_write(key))
+
+    async def _delayed_write(self, key):
+        try:
+            await asyncio.sleep(self.flush_interval)
+            await self._write(key)
+        except asyncio.CancelledError:
+            pass
+
+    async def _write(self, key):
+        async with self._get_lock():
+            timer = self._timers.pop(key, None)
+            if timer is not None and timer is not asyncio.current_task():
+                timer.cancel()
+            entry = self._pending.pop(key, None)
+            if entry is None:
+                return
+            collection, fields = entry
+            try:
+                await collection.update_one({"task_id": key[1]}, {"$set": fields})
+            except Exception as e:
+                print(f"Error updating task {key[1]}: {e}")
+
+    async def flush(self, task_id: str = None):
+        """
+        Write the pending updates (of one task, or of every task).
+        """
+        for key in list(self._pending):
+            if task_id is None or key[1] == task_id:
+                await self._write(key)
+
+
+# Process wide writers
+log_sink = LogSink()
+progress_writer = ProgressWriter()
+
+
+def buffered_logs(client) -> BufferedCollection:
+    """
+    Return the logs collection of the client, with its writes going through the LogSink.
+    """
+    return BufferedCollection(get_logs_collection(client), log_sink)
+
+
+async def flush_writers(task_id: str = None):
+    """
+    Flush the pending progress updates and the queued logs, called at the end of a task.
+    """
+    await progress_writer.flush(task_id)
+    await log_sink.flush(task_id)
+
+
+async def shutdown_writers():
+    """
+    Flush everything and stop the background worker, called on shutdown.
+    """
+    await progress_writer.flush()
+    await log_sink.close()
@@ -0,0 +1,277 @@
+'''
+Per-task memory accounting and budget.
+
+Note:
+1. Every task gets a MemoryBudget of TASK_MEMORY_BUDGET_MB (0 disables the enforcement, the figures are still
+   reported). It is kept in a ContextVar, like the spans of metrics.py.
+2. Before loading, the in-memory size of the dataset is estimated from the file size (TASK_MEMORY_CSV_FACTOR).
+   Above the budget the file is analyzed out-of-core, or read as a random sample chunk by chunk when pyarrow is
+   missing (blobs are streamed to a temporary file first). After
+   loading, df.memory_usage(deep=True) is measured and a dataset above TASK_MEMORY_DATASET_SHARE of the budget is
+   downsampled, so the generated code has room for its intermediate frames.
+3. After each execution of generated code, the frames it left in its namespace are measured (executor memory per
+   KPI): their objects are estimated from the first rows, the exact deep size is only measured once the task
+   reaches TASK_MEMORY_DEEP_CHECK_SHARE of its budget. When the dataset and those frames are over the budget, or the process is close to its memory limit
+   (MEMORY_LIMIT_MB or the cgroup limit), the task is failed cleanly instead of letting the worker be killed.
+4. The RSS of the process is sampled at the start and end of every span (metrics.py), summarize_memory turns it
+   into the peak RSS per stage for the task document. The RSS is per process, with concurrent tasks a stage's
+   figures include what the other tasks allocated meanwhile.
+'''
+
+import os
+import sys
+from contextvars import ContextVar
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+MB = 1024 * 1024
+
+# Budget of the task being processed
+current_memory_budget = ContextVar("current_memory_budget", default=None)
+
+
+class MemoryBudgetExceeded(Exception):
+    pass
+
+
+def process_memory() -> tuple:
+    """
+    Return the current and the peak RSS of the process in bytes (None when they can't be read).
+    """
+    try:
+        rss = peak = None
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith("VmHWM:"):
+                    peak = int(line.split()[1]) * 1024
+        return rss, peak
+    except OSError:
+        pass
+    if resource is None:
+        return None, None
+    # Only the peak is available, in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return None, peak if sys.platform == "darwin" else peak * 1024
+
+
+def memory_limit() -> int:
+    """
+    Return the memory limit of the process in bytes: MEMORY_LIMIT_MB, else the cgroup (container) limit, else None.
+    """
+    if os.getenv("MEMORY_LIMIT_MB"):
+        return int(float(os.getenv("MEMORY_LIMIT_MB")) * MB)
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as file:
+                value = file.read().strip()
+        except OSError:
+            continue
+        # "max" or a huge number when there is no limit
+        if value.isdigit() and int(value) < 1 << 60:
+            return int(value)
+    return None
+
+
+def frame_bytes(value, deep: bool = True) -> int:
+    """
+    Size of a DataFrame/Series (0 for anything else). The shallow size counts 8 bytes per object (string) value,
+    the deep one walks every value and costs seconds on large object columns.
+    """
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=deep).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=deep))
+    return 0
+
+
+def estimated_frame_bytes(value, sample_rows: int = 1000) -> int:
+    """
+    Size of a DataFrame/Series with the objects (strings) estimated from the first sample_rows rows: close to the
+    deep size at the cost of the shallow one.
+    """
+    if not isinstance(value, (pd.DataFrame, pd.Series)) or len(value) <= sample_rows:
+        return frame_bytes(value)
+    head = value.iloc[:sample_rows]
+    objects = frame_bytes(head) - frame_bytes(head, deep=False)
+    return frame_bytes(value, deep=False) + int(objects * len(value) / sample_rows)
+
+
+class MemoryBudget:
+    """
+    Memory figures and limit of one task.
+    """
+
+    def __init__(self, budget_mb: float = None):
+        if budget_mb is None:
+            budget_mb = float(os.getenv("TASK_MEMORY_BUDGET_MB", "2048"))
+        self.budget = int(budget_mb * MB) if budget_mb > 0 else None
+        self.csv_factor = float(os.getenv("TASK_MEMORY_CSV_FACTOR", "4"))
+        self.dataset_share = float(os.getenv("TASK_MEMORY_DATASET_SHARE", "0.5"))
+        # Share of the process limit above which the running tasks are failed
+        self.process_share = float(os.getenv("PROCESS_MEMORY_SHARE", "0.9"))
+        # Share of the budget above which the estimated size of the executor frames is replaced by their deep size
+        self.deep_check_share = float(os.getenv("TASK_MEMORY_DEEP_CHECK_SHARE", "0.8"))
+        self.mode = "in_memory"
+        self.estimated_bytes = None
+        self.dataset_bytes = None
+        self.rows = None
+        self.sampled_rows = None
+        self.kpi_bytes = {}
+        self.exceeded = None
+
+    def plan(self, file_size: int, out_of_core_available: bool) -> str:
+        """
+        This function is used to pick how a file is loaded from its estimated in-memory size.
+
+        Args:
+            file_size: int - Size of the CSV in bytes (None when unknown)
+            out_of_core_available: bool - Whether the out-of-core mode can be used (pyarrow)
+
+        Returns:
+            str - in_memory, out_of_core or sampled
+        """
+        if file_size is None:
+            return self.mode
+        self.estimated_bytes = int(file_size * self.csv_factor)
+        if self.budget is not None and self.estimated_bytes > self.budget:
+            self.mode = "out_of_core" if out_of_core_available else "sampled"
+        return self.mode
+
+    def sample_fraction(self) -> float:
+        """
+        Share of the rows to read in the sampled mode, so the estimated dataset fits its share of the budget.
+        """
+        if self.budget is None or not self.estimated_bytes:
+            return 1.0
+        return min(1.0, self.budget * self.dataset_share / self.estimated_bytes)
+
+    def fit_dataframe(self, df: pd.DataFrame, total_rows: int = None) -> pd.DataFrame:
+        """
+        This function is used to measure the loaded dataset and downsample it when it is over its share of the budget.
+
+        Args:
+            df: pd.DataFrame - The loaded dataset
+            total_rows: int - Rows of the file when df is already a sample
+
+        Returns:
+            pd.DataFrame - df, or a random sample of it
+        """
+        self.rows = total_rows or len(df)
+        self.dataset_bytes = frame_bytes(df)
+        limit = self.budget * self.dataset_share if self.budget is not None else None
+        if limit is not None and self.dataset_bytes > limit and len(df) > 1:
+            keep = max(1, int(len(df) * limit / self.dataset_bytes))
+            df = df.sample(n=keep, random_state=42).sort_index().reset_index(drop=True)
+            self.dataset_bytes = frame_bytes(df)
+            self.mode = "sampled"
+        if self.mode == "sampled":
+            self.sampled_rows = len(df)
+        return df
+
+    def sample_note(self) -> str:
+        """
+        Return the note added to the dataset description of a sampled dataset ("" otherwise).
+        """
+        if self.mode != "sampled":
+            return ""
+        return (f"\nNote: the dataset has {self.rows} rows, the analysis runs on a random sample of "
+                f"{self.sampled_rows} rows to stay within the memory budget. Totals and counts are for the sample.\n")
+
+    def check(self, kpi_name: str, namespace: dict):
+        """
+        This function is used to account the frames left by generated code and enforce the budget.
+
+        Args:
+            kpi_name: str - The KPI the code is for
+            namespace: dict - The namespace the code ran in
+
+        Raises:
+            MemoryBudgetExceeded - When the task or the process is over its limit
+        """
+        dataset = namespace.get("df")
+        frames = [value for name, value in namespace.items()
+                  if isinstance(value, (pd.DataFrame, pd.Series)) and value is not dataset and not name.startswith("__")]
+        # Estimated first, the deep size is only worth its cost when the task may be close to its budget
+        executor_bytes = sum(estimated_frame_bytes(value) for value in frames)
+        if self.budget is not None and (self.dataset_bytes or 0) + executor_bytes > self.budget * self.deep_check_share:
+            executor_bytes = sum(frame_bytes(value) for value in frames)
+        self.kpi_bytes[kpi_name] = max(self.kpi_bytes.get(kpi_name, 0), executor_bytes)
+
+        task_bytes = (self.dataset_bytes or 0) + executor_bytes
+        if self.budget is not None and task_bytes > self.budget:
+            self.exceeded = (f"The task needs {task_bytes / MB:.0f} MB for KPI '{kpi_name}', over its memory budget "
+                             f"of {self.budget / MB:.0f} MB")
+        else:
+            limit = memory_limit()
+            rss, _ = process_memory()
+            if limit is not None and rss is not None and rss > limit * self.process_share:
+                self.exceeded = (f"The worker is using {rss / MB:.0f} MB of its {limit / MB:.0f} MB limit, "
+                                 f"the task was stopped at KPI '{kpi_name}' to protect the other tasks")
+        if self.exceeded:
+            raise MemoryBudgetExceeded(self.exceeded)
+
+    def raise_if_exceeded(self):
+        if self.exceeded:
+            raise MemoryBudgetExceeded(self.exceeded)
+
+
+def read_csv_sampled(path: str, encoding: str, fraction: float, chunk_rows: int = 250000) -> tuple:
+    """
+    This function is used to read a random sample of a CSV chunk by chunk, the whole file is never in memory.
+
+    Args:
+        path: str - Local CSV
+        encoding: str - Its encoding
+        fraction: float - Share of the rows to keep
+        chunk_rows: int - Rows per chunk
+
+    Returns:
+        df: pd.DataFrame - The sample
+        total_rows: int - Rows of the file
+    """
+    parts = []
+    total_rows = 0
+    for index, chunk in enumerate(pd.read_csv(path, encoding=encoding, memory_map=True, chunksize=chunk_rows)):
+        total_rows += len(chunk)
+        parts.append(chunk.sample(frac=fraction, random_state=index))
+    df = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
+    return df, total_rows
+
+
+def summarize_memory(budget: MemoryBudget, spans: list) -> dict:
+    """
+    This function is used to build the memory fields of the task document.
+
+    Args:
+        budget: MemoryBudget - The budget of the task
+        spans: list - The spans of the task, with their RSS samples
+
+    Returns:
+        dict - Budget, dataset size and execution mode, peak RSS per stage and executor memory per KPI
+    """
+    def to_mb(value):
+        return round(value / MB, 1) if value is not None else None
+
+    stage_peaks = {}
+    for entry in spans:
+        if entry.get("peak_rss_mb") is not None:
+            stage_peaks[entry["stage"]] = max(stage_peaks.get(entry["stage"], 0), entry["peak_rss_mb"])
+
+    return {
+        "budget_mb": to_mb(budget.budget),
+        "execution_mode": budget.mode,
+        "estimated_mb": to_mb(budget.estimated_bytes),
+        "dataset_mb": to_mb(budget.dataset_bytes),
+        "rows": budget.rows,
+        "sampled_rows": budget.sampled_rows,
+        "peak_rss_mb": max(stage_peaks.values()) if stage_peaks else None,
+        "stage_peak_rss_mb": stage_peaks,
+        "kpi_executor_mb": {kpi_name: to_mb(size) for kpi_name, size in budget.kpi_bytes.items()},
+        "exceeded": budget.exceeded,
+    }
@@ -0,0 +1,163 @@
+'''
+Per-stage timing spans and Prometheus metrics.
+
+Note:
+1. span(stage) times a block: the duration goes to the analysis_stage_duration_seconds histogram and to the spans
+   of the current task, which run_analysis stores in the task document (timings + stage_totals).
+2. The spans of a task are kept in a ContextVar, so the helpers don't need the task passed around. Tasks created
+   with asyncio.create_task inherit it.
+3. KPI names are only stored in the task document, the Prometheus labels are bounded (stage, agent, cache, status).
+4. Each span also samples the RSS of the process at its start and end (peak RSS per stage, see memory_budget.py).
+5. prometheus_client is optional, without it the spans are still stored and /metrics answers 503.
+'''
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from utils.memory_budget import process_memory, MB
+
+try:
+    from prometheus_client import Counter, Histogram, CONTENT_TYPE_LATEST, generate_latest # type: ignore
+except ImportError:
+    Counter = Histogram = None
+
+# Spans of the task being processed
+current_spans = ContextVar("current_spans", default=None)
+
+# Agent calls take seconds to minutes, the rest milliseconds to seconds
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+if Histogram is not None:
+    STAGE_DURATION = Histogram(
+        "analysis_stage_duration_seconds", "Duration of the stages of an analysis task", ["stage"],
+        buckets=STAGE_BUCKETS
+    )
+    TASK_DURATION = Histogram(
+        "analysis_task_duration_seconds", "Duration of a whole analysis task", ["status"], buckets=STAGE_BUCKETS
+    )
+    STAGE_FAILURES = Counter("analysis_stage_failures_total", "Stages that raised an exception", ["stage"])
+    TASKS = Counter("analysis_tasks_total", "Finished analysis tasks", ["status"])
+    DEBUG_ATTEMPTS = Counter("analysis_debug_attempts_total", "Debug agent attempts to fix generated code")
+    CACHE_LOOKUPS = Counter("analysis_cache_lookups_total", "Cache lookups", ["cache", "result"])
+
+
+def metrics_enabled() -> bool:
+    return Histogram is not None
+
+
+def record_span(stage: str, started_at: datetime, duration: float, status: str = "success", kpi_name: str = None,
+                memory: dict = None):
+    """
+    This function is used to record a timed stage of the current task.
+
+    Args:
+        stage: str - The stage, e.g. "load_data:parse" or "agent:Data Analyst"
+        started_at: datetime - When the stage started
+        duration: float - Seconds
+        status: str - success or error
+        kpi_name: str - The KPI the stage is working on (optional)
+        memory: dict - RSS samples of the stage, from stage_memory (optional)
+    """
+    if metrics_enabled():
+        STAGE_DURATION.labels(stage=stage).observe(duration)
+        if status == "error":
+            STAGE_FAILURES.labels(stage=stage).inc()
+
+    spans = current_spans.get()
+    if spans is not None:
+        entry = {"stage": stage, "started_at": started_at, "duration": round(duration, 4), "status": status}
+        if kpi_name is not None:
+            entry["kpi_name"] = kpi_name
+        if memory:
+            entry.update(memory)
+        spans.append(entry)
+
+
+@contextmanager
+def span(stage: str, kpi_name: str = None):
+    """
+    Time the enclosed block as a stage of the current task (see record_span).
+    """
+    started_at = datetime.now()
+    start = time.perf_counter()
+    rss_start, peak_start = process_memory()
+    status = "success"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        record_span(stage, started_at, time.perf_counter() - start, status, kpi_name,
+                    stage_memory(rss_start, peak_start))
+
+
+def stage_memory(rss_start: int, peak_start: int) -> dict:
+    """
+    This function is used to turn the RSS samples taken around a stage into its memory fields.
+
+    Args:
+        rss_start: int - RSS at the start of the stage (bytes)
+        peak_start: int - Peak RSS of the process at the start of the stage (bytes)
+
+    Returns:
+        dict - rss_mb (at the end), rss_delta_mb and peak_rss_mb of the stage, empty when RSS can't be read
+    """
+    rss_end, peak_end = process_memory()
+    if rss_start is None or rss_end is None:
+        return {}
+    # A new process peak was reached during the stage, otherwise its peak is at least its start/end RSS
+    peak = peak_end if peak_end is not None and peak_start is not None and peak_end > peak_start else max(rss_start, rss_end)
+    return {
+        "rss_mb": round(rss_end / MB, 1),
+        "rss_delta_mb": round((rss_end - rss_start) / MB, 1),
+        "peak_rss_mb": round(peak / MB, 1),
+    }
+
+
+def record_debug_attempt():
+    if metrics_enabled():
+        DEBUG_ATTEMPTS.inc()
+
+
+def record_cache_lookups(cache: str, hits: int, misses: int):
+    """
+    Add the hits and misses of a cache to the counters.
+    """
+    if metrics_enabled():
+        if hits:
+            CACHE_LOOKUPS.labels(cache=cache, result="hit").inc(hits)
+        if misses:
+            CACHE_LOOKUPS.labels(cache=cache, result="miss").inc(misses)
+
+
+def record_task(status: str, duration: float):
+    if metrics_enabled():
+        TASKS.labels(status=status).inc()
+        TASK_DURATION.labels(status=status).observe(duration)
+
+
+def summarize_spans(spans: list) -> dict:
+    """
+    This function is used to build the timing fields of the task document.
+
+    Args:
+        spans: list - The spans of the task
+
+    Returns:
+        dict - timings (every span) and stage_totals (seconds per stage)
+    """
+    stage_totals = {}
+    for entry in spans:
+        stage_totals[entry["stage"]] = round(stage_totals.get(entry["stage"], 0) + entry["duration"], 4)
+    return {"timings": spans, "stage_totals": stage_totals}
+
+
+def render_metrics() -> tuple:
+    """
+    Return the body and content type of the /metrics response (None when prometheus_client is missing).
+    """
+    if not metrics_enabled():
+        return None, None
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,560 @@
+'''
+Out-of-core mode for datasets that are larger than the worker's memory.
+
+Note:
+1. load_data picks this mode from the file size (OUT_OF_CORE_THRESHOLD_MB). The CSV is streamed to disk and
+   converted block by block into a Parquet dataset, it is never materialized as a whole.
+2. The profile is computed with streaming aggregation over the row groups, unique values are tracked up to
+   OUT_OF_CORE_UNIQUE_LIMIT per column so memory stays bounded.
+3. Generated code gets a ChunkedFrame as df. Its aggregations (groupby/agg, pivot_table, value_counts, sum...)
+   stream over the row groups and only keep the (small) partial results in memory.
+'''
+
+import os
+import shutil
+import tempfile
+import uuid
+import pandas as pd
+from utils.profiler import DatasetProfile
+
+try:
+    import pyarrow as pa # type: ignore
+    import pyarrow.csv as pa_csv # type: ignore
+    import pyarrow.dataset as pa_dataset # type: ignore
+    import pyarrow.parquet as pa_parquet # type: ignore
+except ImportError:
+    pa = None
+
+# Aggregations that can be computed per chunk and combined afterwards: partial -> how partials are combined
+COMBINE_FUNCTIONS = {"sum": "sum", "count": "sum", "min": "min", "max": "max"}
+SUPPORTED_FUNCTIONS = set(COMBINE_FUNCTIONS) | {"mean", "size"}
+
+# Every NaN read from a chunk is a new float object, map them to one so the unique value tracking sees a single NaN
+_NAN = float("nan")
+
+
+def _threshold_bytes() -> int:
+    return int(float(os.getenv("OUT_OF_CORE_THRESHOLD_MB", "512")) * 1024 * 1024)
+
+
+def _batch_rows() -> int:
+    return int(os.getenv("OUT_OF_CORE_BATCH_ROWS", "250000"))
+
+
+def get_file_size(file_path_or_url: str):
+    """
+    Return the size of a local file or a blob URL in bytes, None when it is unknown.
+    """
+    if file_path_or_url.startswith('http'):
+        import requests
+        try:
+            response = requests.head(file_path_or_url, allow_redirects=True, timeout=30)
+            response.raise_for_status()
+            return int(response.headers.get("Content-Length", 0)) or None
+        except Exception as e:
+            print(f"Could not get the size of {file_path_or_url}: {e}")
+            return None
+    try:
+        return os.path.getsize(file_path_or_url)
+    except OSError:
+        return None
+
+
+def out_of_core_available() -> bool:
+    return pa is not None
+
+
+def is_out_of_core(file_size) -> bool:
+    """
+    Check whether a file of the given size should be processed out-of-core.
+    """
+    if file_size is None or file_size < _threshold_bytes():
+        return False
+    if pa is None:
+        print("File is above OUT_OF_CORE_THRESHOLD_MB but pyarrow is not installed, loading it in memory")
+        return False
+    return True
+
+
+def _work_directory() -> str:
+    directory = os.path.join(os.getenv("OUT_OF_CORE_DIR", tempfile.gettempdir()), f"deep-analysis-{uuid.uuid4()}")
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def download(url: str, path: str):
+    """
+    Stream a blob to disk in chunks, without holding it in memory.
+    """
+    import requests
+    with requests.get(url, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        with open(path, "wb") as file:
+            for chunk in response.iter_content(chunk_size=8 * 1024 * 1024):
+                file.write(chunk)
+
+
+def _csv_to_parquet(csv_path: str, parquet_path: str):
+    """
+    Convert a CSV to Parquet block by block. Column types are inferred from the first block, if a later block
+    does not fit them (or the file is not utf-8) the conversion is retried with every column read as text.
+    """
+    attempts = [
+        ("utf8", None),
+        ("utf8", "string"),
+        ("latin1", None),
+        ("latin1", "string"),
+    ]
+    last_error = None
+    for encoding, forced_type in attempts:
+        read_options = pa_csv.ReadOptions(encoding=encoding, block_size=64 * 1024 * 1024)
+        # Empty strings are nulls, like in pd.read_csv
+        convert_options = pa_csv.ConvertOptions(strings_can_be_null=True)
+        try:
+            if forced_type is not None:
+                with pa.memory_map(csv_path) as source, pa_csv.open_csv(source, read_options=read_options) as header:
+                    names = header.schema.names
+                convert_options = pa_csv.ConvertOptions(
+                    strings_can_be_null=True,
+                    column_types={name: pa.string() for name in names}
+                )
+
+            # Memory-mapped, Arrow parses the blocks straight from the page cache. Closed on every attempt, a failed
+            # one must not keep the mapping and its file handle open
+            with pa.memory_map(csv_path) as source, \
+                    pa_csv.open_csv(source, read_options=read_options, convert_options=convert_options) as reader, \
+                    pa_parquet.ParquetWriter(parquet_path, reader.schema) as writer:
+                for batch in reader:
+                    writer.write_table(pa.Table.from_batches([batch]), row_group_size=_batch_rows())
+            return encoding
+        except (pa.ArrowInvalid, UnicodeDecodeError) as e:
+            last_error = e
+            continue
+    raise ValueError(f"Could not convert the file to parquet: {last_error}")
+
+
+def open_chunked_frame(file_path_or_url: str):
+    """
+    This function is used to turn a CSV (local path or blob URL) into an on-disk Parquet dataset.
+
+    Args:
+        file_path_or_url: str - Either a local file path or a blob URL
+
+    Returns:
+        ChunkedFrame - A lazy frame over the dataset
+    """
+    directory = _work_directory()
+    try:
+        csv_path = file_path_or_url
+        if file_path_or_url.startswith('http'):
+            csv_path = os.path.join(directory, "source.csv")
+            download(file_path_or_url, csv_path)
+
+        parquet_path = os.path.join(directory, "data.parquet")
+        encoding = _csv_to_parquet(csv_path, parquet_path)
+
+        # The downloaded CSV is no longer needed, only the parquet dataset is kept
+        if csv_path != file_path_or_url:
+            os.remove(csv_path)
+
+        frame = ChunkedFrame(parquet_path, directory=directory)
+        frame.encoding = encoding
+        return frame
+    except Exception:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+
+
+def profile_chunked_frame(frame) -> tuple:
+    """
+    This function is used to build the dataset description with streaming aggregation.
+
+    Args:
+        frame: ChunkedFrame
+
+    Returns:
+        columns: list
+        profile: DatasetProfile
+    """
+    unique_limit = int(os.getenv("OUT_OF_CORE_UNIQUE_LIMIT", "10000"))
+    columns = list(frame.columns)
+    null_counts = {column: 0 for column in columns}
+    # dicts keep the order of first appearance, like Series.unique()
+    unique_values = {column: {} for column in columns}
+    capped = set()
+
+    for chunk in frame.iter_chunks():
+        nulls = chunk.isnull().sum()
+        for column in columns:
+            null_counts[column] += int(nulls[column])
+            if column in capped:
+                continue
+            seen = unique_values[column]
+            for value in chunk[column].unique().tolist():
+                if value != value:
+                    value = _NAN
+                seen.setdefault(value, None)
+                if len(seen) > unique_limit:
+                    capped.add(column)
+                    break
+
+    dtypes = frame.dtypes
+    profile = DatasetProfile(footer=f"Number of Rows: {len(frame)}\n")
+    for column in columns:
+        values = list(unique_values[column])
+        unique_count = f"more than {unique_limit}" if column in capped else len(values)
+        profile.add_column(column, null_counts[column], dtypes[column], values, unique_count)
+    return columns, profile
+
+
+def _normalize_spec(func, values) -> list:
+    """
+    Turn an agg spec into a list of (column, function) pairs.
+    """
+    if isinstance(func, dict):
+        pairs = []
+        for column, functions in func.items():
+            for f in ([functions] if isinstance(functions, str) else functions):
+                pairs.append((column, f))
+        return pairs
+    functions = [func] if isinstance(func, str) else list(func)
+    columns = [values] if isinstance(values, str) else list(values)
+    return [(column, f) for column in columns for f in functions]
+
+
+class ChunkedGroupBy:
+    """
+    A groupby over a ChunkedFrame, aggregations are computed per chunk and combined.
+    """
+
+    def __init__(self, frame, by, values=None, dropna: bool = True):
+        self.frame = frame
+        self.by = by
+        self.values = values
+        self.dropna = dropna
+
+    def __getitem__(self, values):
+        return ChunkedGroupBy(self.frame, self.by, values, self.dropna)
+
+    def _by_columns(self) -> list:
+        return [self.by] if isinstance(self.by, str) else list(self.by)
+
+    def _default_values(self) -> list:
+        by_columns = self._by_columns()
+        return [c for c in self.frame.numeric_columns() if c not in by_columns]
+
+    def _aggregate(self, pairs: list) -> pd.DataFrame:
+        """
+        Stream the partial aggregates of (column, function) pairs, returns a frame with one column per pair.
+        """
+        for column, f in pairs:
+            if f not in SUPPORTED_FUNCTIONS:
+                raise NotImplementedError(
+                    f"'{f}' can not be computed out-of-core, use one of {sorted(SUPPORTED_FUNCTIONS)}"
+                )
+
+        # Partial columns are named p0, p1... to keep the combine step flat
+        partials = []
+        for column, f in pairs:
+            if f == "mean":
+                partials.extend([(column, "sum"), (column, "count")])
+            elif f != "size":
+                partials.append((column, f))
+        partials = list(dict.fromkeys(partials))
+        names = {pair: f"p{i}" for i, pair in enumerate(partials)}
+        combine = {names[pair]: COMBINE_FUNCTIONS[pair[1]] for pair in partials}
+        combine["size"] = "sum"
+
+        by_columns = self._by_columns()
+        needed = list(dict.fromkeys(by_columns + [column for column, _ in partials]))
+        running = None
+        for chunk in self.frame.iter_chunks(columns=needed):
+            grouped = chunk.groupby(self.by, dropna=self.dropna)
+            part = pd.DataFrame({names[(column, f)]: grouped[column].agg(f) for column, f in partials})
+            part["size"] = grouped.size()
+            if running is None:
+                running = part
+            else:
+                levels = list(range(running.index.nlevels))
+                running = pd.concat([running, part]).groupby(level=levels, dropna=self.dropna).agg(combine)
+
+        if running is None:
+            running = pd.DataFrame(columns=list(combine))
+
+        result = {}
+        for column, f in pairs:
+            if f == "size":
+                result[(column, f)] = running["size"]
+            elif f == "mean":
+                result[(column, f)] = running[names[(column, "sum")]] / running[names[(column, "count")]]
+            else:
+                result[(column, f)] = running[names[(column, f)]]
+        return pd.DataFrame(result, index=running.index)
+
+    def agg(self, func=None, **named):
+        """
+        Aggregate like DataFrameGroupBy.agg, supports sum, count, min, max, mean and size,
+        including named aggregation (agg(total=('Sales', 'sum'))).
+        """
+        if named:
+            pairs = list(named.values())
+            result = self._aggregate(pairs)
+            result.columns = list(named)
+            return result
+
+        values = self.values if self.values is not None else self._default_values()
+        pairs = _normalize_spec(func, values)
+        result = self._aggregate(pairs)
+
+        if isinstance(func, str) and isinstance(values, str):
+            series = result.iloc[:, 0]
+            series.name = values
+            return series
+        if isinstance(func, str):
+            result.columns = [column for column, _ in pairs]
+        elif not isinstance(func, dict) and isinstance(values, str):
+            result.columns = [f for _, f in pairs]
+        else:
+            result.columns = pd.MultiIndex.from_tuples(pairs)
+        return result
+
+    aggregate = agg
+
+    def sum(self):
+        return self.agg("sum")
+
+    def mean(self):
+        return self.agg("mean")
+
+    def count(self):
+        return self.agg("count")
+
+    def min(self):
+        return self.agg("min")
+
+    def max(self):
+        return self.agg("max")
+
+    def size(self) -> pd.Series:
+        column = self._by_columns()[0]
+        series = self._aggregate([(column, "size")]).iloc[:, 0]
+        series.name = None
+        return series
+
+
+class ChunkedSeries:
+    """
+    A single column of a ChunkedFrame with streaming reductions.
+    """
+
+    def __init__(self, frame, column):
+        self.frame = frame
+        self.name = column
+
+    def _reduce(self, reduce, combine):
+        partials = [reduce(chunk[self.name]) for chunk in self.frame.iter_chunks(columns=[self.name])]
+        partials = [p for p in partials if not pd.isna(p)]
+        return combine(partials) if partials else float("nan")
+
+    def sum(self):
+        return self._reduce(lambda s: s.sum(), sum)
+
+    def count(self):
+        return self._reduce(lambda s: s.count(), sum)
+
+    def min(self):
+        return self._reduce(lambda s: s.min(), min)
+
+    def max(self):
+        return self._reduce(lambda s: s.max(), max)
+
+    def mean(self):
+        total, count = 0, 0
+        for chunk in self.frame.iter_chunks(columns=[self.name]):
+            total += chunk[self.name].sum()
+            count += chunk[self.name].count()
+        return total / count if count else float("nan")
+
+    def value_counts(self, dropna: bool = True) -> pd.Series:
+        return self.frame.value_counts(self.name, dropna=dropna)
+
+    def nunique(self) -> int:
+        return len(self.value_counts())
+
+    def unique(self):
+        return self.value_counts().index.to_numpy()
+
+    def head(self, n: int = 5) -> pd.Series:
+        return self.frame.head(n)[self.name]
+
+    def __len__(self):
+        return len(self.frame)
+
+
+class ChunkedFrame:
+    """
+    A lazy, read-only frame over an on-disk Parquet dataset. Aggregations stream over the row groups,
+    everything that would need the whole dataset in memory (to_pandas) is capped.
+    """
+
+    def __init__(self, path: str, directory: str = None, transforms: list = None, columns: list = None, dataset=None):
+        self.path = path
+        # Only the frame returned by open_chunked_frame owns (and removes) the files
+        self.directory = directory
+        self.dataset = dataset if dataset is not None else pa_dataset.dataset(path, format="parquet")
+        self.transforms = transforms or []
+        self.encoding = None
+        self._columns = columns
+        self._row_count = None
+
+    def _derive(self, transform=None, columns=None):
+        """
+        Return a new frame over the same dataset with one more per-chunk transform (e.g. a filter).
+        """
+        transforms = self.transforms + ([transform] if transform is not None else [])
+        columns = columns if columns is not None else self._columns
+        return ChunkedFrame(self.path, transforms=transforms, columns=columns, dataset=self.dataset)
+
+    @property
+    def columns(self) -> pd.Index:
+        return pd.Index(self._columns if self._columns is not None else self.dataset.schema.names)
+
+    @property
+    def dtypes(self) -> pd.Series:
+        return self.dataset.schema.empty_table().to_pandas().dtypes[list(self.columns)]
+
+    @property
+    def shape(self) -> tuple:
+        return (len(self), len(self.columns))
+
+    def __len__(self):
+        if self._row_count is None:
+            if self.transforms:
+                self._row_count = sum(len(chunk) for chunk in self.iter_chunks(columns=[self.columns[0]]))
+            else:
+                # Read from the parquet metadata, no scan needed
+                self._row_count = self.dataset.count_rows()
+        return self._row_count
+
+    def numeric_columns(self) -> list:
+        dtypes = self.dtypes
+        return [c for c in self.columns if pd.api.types.is_numeric_dtype(dtypes[c])]
+
+    def iter_chunks(self, columns: list = None):
+        """
+        Yield the dataset as pandas DataFrames, one batch of OUT_OF_CORE_BATCH_ROWS rows at a time.
+        """
+        columns = list(columns) if columns is not None else list(self.columns)
+        # Filters may reference columns that are not selected, so read everything when there are transforms
+        read_columns = None if self.transforms else columns
+        for batch in self.dataset.to_batches(columns=read_columns, batch_size=_batch_rows()):
+            chunk = batch.to_pandas()
+            for transform in self.transforms:
+                chunk = transform(chunk)
+            yield chunk[columns]
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return ChunkedSeries(self, key)
+        if isinstance(key, (list, tuple)):
+            return self._derive(columns=list(key))
+        raise TypeError("Out-of-core frames only support df['col'] and df[['a', 'b']], use df.query() to filter rows")
+
+    def query(self, expr: str, **kwargs):
+        """
+        Filter the rows lazily, same syntax as DataFrame.query.
+        """
+        return self._derive(transform=lambda chunk: chunk.query(expr, **kwargs))
+
+    def groupby(self, by, dropna: bool = True) -> ChunkedGroupBy:
+        return ChunkedGroupBy(self, by, dropna=dropna)
+
+    def pivot_table(self, index, columns, values, aggfunc="mean", fill_value=None) -> pd.DataFrame:
+        """
+        Build a pivot table with a streamed groupby on index + columns.
+        """
+        index = [index] if isinstance(index, str) else list(index)
+        pivot_columns = [columns] if isinstance(columns, str) else list(columns)
+        result = self.groupby(index + pivot_columns)[values].agg(aggfunc)
+        table = result.unstack(level=pivot_columns)
+        return table.fillna(fill_value) if fill_value is not None else table
+
+    def value_counts(self, subset=None, dropna: bool = True) -> pd.Series:
+        subset = subset if subset is not None else list(self.columns)
+        counts = self.groupby(subset, dropna=dropna).size().sort_values(ascending=False)
+        counts.name = "count"
+        return counts
+
+    def sum(self, numeric_only: bool = True) -> pd.Series:
+        return pd.Series({c: self[c].sum() for c in self.numeric_columns()})
+
+    def mean(self, numeric_only: bool = True) -> pd.Series:
+        return pd.Series({c: self[c].mean() for c in self.numeric_columns()})
+
+    def describe(self) -> pd.DataFrame:
+        """
+        count / mean / min / max of the numeric columns in one streaming pass.
+        """
+        numeric = self.numeric_columns()
+        stats = {c: {"count": 0, "sum": 0.0, "min": None, "max": None} for c in numeric}
+        for chunk in self.iter_chunks(columns=numeric):
+            for column in numeric:
+                series = chunk[column]
+                stat = stats[column]
+                stat["count"] += int(series.count())
+                stat["sum"] += float(series.sum())
+                if series.count():
+                    stat["min"] = series.min() if stat["min"] is None else min(stat["min"], series.min())
+                    stat["max"] = series.max() if stat["max"] is None else max(stat["max"], series.max())
+        return pd.DataFrame({
+            c: {
+                "count": s["count"],
+                "mean": s["sum"] / s["count"] if s["count"] else float("nan"),
+                "min": s["min"],
+                "max": s["max"],
+            }
+            for c, s in stats.items()
+        })
+
+    def head(self, n: int = 5) -> pd.DataFrame:
+        collected = []
+        remaining = n
+        for chunk in self.iter_chunks():
+            collected.append(chunk.head(remaining))
+            remaining -= len(collected[-1])
+            if remaining <= 0:
+                break
+        return pd.concat(collected) if collected else pd.DataFrame(columns=self.columns)
+
+    def sample(self, n: int = 10000, random_state: int = 42) -> pd.DataFrame:
+        """
+        Return a uniform sample of about n rows as a pandas DataFrame (e.g. for scatter plots).
+        """
+        fraction = min(1.0, n / max(len(self), 1))
+        # One seed per chunk, the same seed would pick the same positions in every chunk
+        parts = [
+            chunk.sample(frac=fraction, random_state=None if random_state is None else random_state + i)
+            for i, chunk in enumerate(self.iter_chunks())
+        ]
+        return pd.concat(parts).head(n) if parts else pd.DataFrame(columns=self.columns)
+
+    def to_pandas(self, max_rows: int = None) -> pd.DataFrame:
+        """
+        Materialize the frame, only allowed below OUT_OF_CORE_MAX_ROWS rows (e.g. after a selective query()).
+        """
+        max_rows = max_rows or int(os.getenv("OUT_OF_CORE_MAX_ROWS", "1000000"))
+        if len(self) > max_rows:
+            raise MemoryError(
+                f"The dataset has {len(self)} rows, aggregate it (groupby/agg, pivot_table, value_counts) "
+                f"or use sample() instead of materializing more than {max_rows} rows"
+            )
+        parts = list(self.iter_chunks())
+        return pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=self.columns)
+
+    def close(self):
+        """
+        Remove the on-disk dataset.
+        """
+        if self.directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
@@ -0,0 +1,137 @@
+'''
+Dataset description (profile) that is sent to the agents.
+
+Note:
+1. Shared by the in-memory path of load_data and the streaming profile of the out-of-core mode, so both
+   produce exactly the same prompt format.
+2. The description is a DatasetProfile (per-column figures), rendered to text only when a prompt is assembled.
+'''
+
+import pandas as pd
+from utils.prompt_builder import count_tokens
+
+# Number of unique values shown per column
+UNIQUE_VALUES_TO_SHOW = 20
+
+# Unique values shown per column when the description is over its prompt budget
+COMPACT_VALUES_TO_SHOW = (5, 0)
+
+
+def describe_column(column, null_count: int, dtype, unique_values: list, unique_count,
+                    values_to_show: int = UNIQUE_VALUES_TO_SHOW) -> str:
+    """
+    This function is used to describe a single column of the dataset.
+
+    Args:
+        column: The column name
+        null_count: int - Number of null values
+        dtype: The pandas dtype of the column
+        unique_values: list - Unique values in order of appearance (at least the first UNIQUE_VALUES_TO_SHOW)
+        unique_count: int | str - Number of unique values (a string like "more than 10000" when it was capped)
+        values_to_show: int - Number of unique values to show (0 leaves the line out)
+
+    Returns:
+        str - The column description
+    """
+    num_to_show = min(values_to_show, len(unique_values))
+    description = f"Column Name: {column}\n"
+    description += f"Null Values: {null_count}\n"
+    description += f"Data Type: {dtype}\n"
+    if num_to_show:
+        description += f"Top {num_to_show} Unique Values: {unique_values[:num_to_show]}\n"
+    description += f"Number of Unique Values: {unique_count}\n"
+    return description
+
+
+class DatasetProfile:
+    """
+    The dataset description of a task, kept per column so it can be pruned for a KPI (column_selector.py) without
+    parsing the rendered text back.
+    """
+
+    def __init__(self, header: str = "Here is the dataset description:\n", footer: str = ""):
+        self.header = header
+        self.footer = footer
+        # Column -> (null_count, dtype, unique_values, unique_count), in dataset order
+        self.columns = {}
+        # Columns listed by name only (the columns left out by select)
+        self.other_columns = []
+
+    def add_column(self, column, null_count: int, dtype, unique_values: list, unique_count):
+        self.columns[column] = (null_count, dtype, unique_values[:UNIQUE_VALUES_TO_SHOW], unique_count)
+
+    def dtype(self, column):
+        return self.columns[column][1]
+
+    def select(self, columns: list) -> "DatasetProfile":
+        """
+        Return the profile describing only the given columns, the other ones are listed by name.
+        """
+        selected = DatasetProfile(self.header, self.footer)
+        selected.columns = {column: self.columns[column] for column in columns}
+        selected.other_columns = [column for column in self.columns if column not in selected.columns]
+        return selected
+
+    def render(self, values_to_show: int = UNIQUE_VALUES_TO_SHOW, compact: bool = False) -> str:
+        """
+        This function is used to render the description sent to the agents.
+
+        Args:
+            values_to_show: int - Number of unique values shown per column
+            compact: bool - One line per column (name, type, nulls and number of unique values)
+
+        Returns:
+            str - The header, the description of each column, the footer and the names of the other columns
+        """
+        prompt = self.header
+        for column, (null_count, dtype, unique_values, unique_count) in self.columns.items():
+            if compact:
+                prompt += f"{column}: {dtype}, {null_count} nulls, {unique_count} unique values\n"
+            else:
+                prompt += describe_column(column, null_count, dtype, unique_values, unique_count, values_to_show)
+        prompt += self.footer
+        if self.other_columns:
+            other_columns = ", ".join(str(column) for column in self.other_columns)
+            prompt += f"Other columns (not described, use them only if needed): {other_columns}\n"
+        return prompt
+
+    def fit(self, max_tokens: int) -> tuple:
+        """
+        This function is used to render the description within a token budget without leaving any column out.
+
+        Args:
+            max_tokens: int - The token budget of the description
+
+        Returns:
+            text: str - The full description, or one with fewer unique values per column, or one line per column
+                        (sent even when it is still over the budget, the agents need every column)
+            trimmed: bool - Whether detail was left out
+        """
+        text = self.render()
+        if count_tokens(text) <= max_tokens:
+            return text, False
+        for values_to_show in COMPACT_VALUES_TO_SHOW:
+            text = self.render(values_to_show)
+            if count_tokens(text) <= max_tokens:
+                return text, True
+        return self.render(compact=True), True
+
+    def __str__(self) -> str:
+        return self.render()
+
+
+def build_dataset_profile(df: pd.DataFrame) -> DatasetProfile:
+    """
+    This function is used to build the dataset description of an in-memory dataframe.
+
+    Args:
+        df: pd.DataFrame
+
+    Returns:
+        DatasetProfile - The dataset description
+    """
+    profile = DatasetProfile()
+    for column in df.columns:
+        unique_values = df[column].unique().tolist()
+        profile.add_column(column, df[column].isnull().sum(), df[column].dtype, unique_values, len(unique_values))
+    return profile
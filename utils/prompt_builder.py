@@ -0,0 +1,168 @@
+'''
+Assembly of the user prompts sent to the agents.
+
+Note:
+1. Every prompt is built as sections in a fixed order: the dataset description (the schema, identical for every
+   call of a task) comes first and the per-call parts (KPI, code, errors) after it. Together with the agent
+   instructions this gives a stable prefix that the provider's prompt caching can reuse across calls.
+2. Each stage has a token budget (PROMPT_BUDGET_<STAGE>). When a prompt is over it, the trimmable sections are cut
+   at line boundaries, the per-call sections are never cut. The dataset description is trimmable but keeps every
+   column: it shows fewer unique values per column, then one line per column (DatasetProfile.fit).
+3. The debug history is compacted: the last attempt is sent in full, the earlier ones as one line each.
+4. Tokens are counted with tiktoken when it is installed, otherwise estimated from the length.
+'''
+
+import os
+from dataclasses import dataclass
+from typing import List, Tuple
+
+try:
+    import tiktoken # type: ignore
+except ImportError:
+    tiktoken = None
+
+# Default token budget of the user prompt per stage
+STAGE_BUDGETS = {
+    "manager": 16000,
+    "analysis": 8000,
+    "visualization": 8000,
+    "combined": 16000,
+    "debug": 10000,
+    "summary": 12000,
+}
+
+# Length of a compacted (earlier) error in the debug history
+ERROR_SUMMARY_CHARS = 200
+
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """
+    Count (or estimate, without tiktoken) the tokens of a text.
+    """
+    global _encoding
+    if tiktoken is None:
+        return len(text) // 4 + 1
+    if _encoding is None:
+        # Encoding of the gpt-4.1 / gpt-4o family
+        _encoding = tiktoken.get_encoding("o200k_base")
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+def get_budget(stage: str) -> int:
+    return int(os.getenv(f"PROMPT_BUDGET_{stage.upper()}", STAGE_BUDGETS.get(stage, 8000)))
+
+
+def truncate_to_budget(text: str, max_tokens: int) -> str:
+    """
+    This function is used to cut a text at a line boundary so it fits in max_tokens.
+
+    Args:
+        text: str - The text to cut
+        max_tokens: int - The token budget
+
+    Returns:
+        str - The text, with a note on how many lines were left out when it was cut
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+
+    lines = text.splitlines()
+    kept = []
+    used = 0
+    for line in lines:
+        line_tokens = count_tokens(line) + 1
+        if used + line_tokens > max_tokens:
+            break
+        kept.append(line)
+        used += line_tokens
+    kept.append(f"... ({len(lines) - len(kept)} more lines left out to fit the prompt budget)")
+    return "\n".join(kept)
+
+
+@dataclass
+class Prompt:
+    stage: str
+    text: str
+    tokens: int
+    budget: int
+    truncated: bool
+
+    def log_fields(self) -> dict:
+        """
+        Return the fields to add to the log of the call.
+        """
+        return {
+            "stage": self.stage,
+            "prompt_tokens": self.tokens,
+            "prompt_budget": self.budget,
+            "prompt_truncated": self.truncated,
+        }
+
+
+def build_prompt(stage: str, sections: List[Tuple[str, str, bool]]) -> Prompt:
+    """
+    This function is used to assemble a prompt within the token budget of its stage.
+
+    Args:
+        stage: str - manager, analysis, visualization, combined, debug or summary
+        sections: list - (title, text, trimmable) tuples, in prompt order (stable sections first), a text is a str
+                  or a DatasetProfile
+
+    Returns:
+        Prompt - The prompt text and its token count
+    """
+    budget = get_budget(stage)
+    sections = [(f"{title}:\n" if title else "", text, trimmable) for title, text, trimmable in sections if text]
+
+    # The per-call sections are kept whole, the trimmable ones share what is left of the budget
+    fixed_tokens = sum(count_tokens(prefix + str(text)) for prefix, text, trimmable in sections if not trimmable)
+    trimmable_count = sum(1 for _, _, trimmable in sections if trimmable)
+    share = max(budget - fixed_tokens, 0) // trimmable_count if trimmable_count else 0
+    truncated = False
+    parts = []
+    for prefix, text, trimmable in sections:
+        if not trimmable:
+            parts.append(prefix + str(text))
+        elif hasattr(text, "fit"):
+            # A DatasetProfile (utils/profiler.py) drops per-column detail, never whole columns
+            fitted, cut = text.fit(max(share - count_tokens(prefix), 0))
+            truncated = truncated or cut
+            parts.append(prefix + fitted)
+        else:
+            full = prefix + text
+            fitted = truncate_to_budget(full, share)
+            truncated = truncated or fitted is not full
+            parts.append(fitted)
+
+    text = "\n\n".join(parts)
+    return Prompt(stage=stage, text=text, tokens=count_tokens(text), budget=budget, truncated=truncated)
+
+
+def summarize_error(error: str) -> str:
+    """
+    Reduce an error to its last non-empty line (the exception message of a traceback), capped in length.
+    """
+    lines = [line.strip() for line in str(error).splitlines() if line.strip()]
+    summary = lines[-1] if lines else ""
+    if len(summary) > ERROR_SUMMARY_CHARS:
+        summary = summary[:ERROR_SUMMARY_CHARS] + "..."
+    return summary
+
+
+def compact_error_history(error_history: list) -> str:
+    """
+    This function is used to render the debug history, only the earlier attempts are compacted.
+
+    Args:
+        error_history: list - {"attempt", "error", "code"} dicts, oldest first. The last one is the current attempt
+                       and is sent separately in full, so it is not rendered here.
+
+    Returns:
+        str - One line per earlier attempt
+    """
+    return "\n".join(
+        f"Attempt {entry['attempt']} failed: {summarize_error(entry['error'])}"
+        for entry in error_history[:-1]
+    )
@@ -32,13 +32,17 @@ Here is an example of the input you might receive:
 - Dataset Description: The dataset contains sales data with columns such as 'Sales', 'Region', 'Product', and 'Date'.
 - KPI: "Sales by Region"
 
+For group by / pivot results use the helpers that are already available in the environment (they are cached and shared with the other KPIs, so prefer them over df.groupby/pd.pivot_table):
+- aggregate(by, values=None, func="sum") returns df.groupby(by)[values].agg(func) with the group keys as columns (on df as it is when called, after your filters)
+- pivot(index, columns, values, func="sum") returns pd.pivot_table(df, index=index, columns=columns, values=values, aggfunc=func)
+
 Based on this input, your output must be formatted as Python code:
 ```
 python
 import pandas as pd
 
 # Grouping the sales data by region
-sales_by_region = df.groupby('Region')['Sales'].sum().reset_index()
+sales_by_region = aggregate('Region', 'Sales', 'sum')
 print(sales_by_region)
 ```
 NOTE: Generate only Python code(only table like results), without any additional text or explanations. Always import the libraries you are using.Never generate charts.
@@ -51,6 +55,10 @@ Here is an example of the input you might receive:
 - Dataset Description: The dataset contains sales data with columns such as 'Sales', 'Region', 'Product', and 'Date'.
 - KPI: "Sales by Region"
 
+For group by / pivot results use the helpers that are already available in the environment (they are cached and shared with the analysis code, so prefer them over df.groupby/pd.pivot_table):
+- aggregate(by, values=None, func="sum") returns df.groupby(by)[values].agg(func) with the group keys as columns (on df as it is when called, after your filters)
+- pivot(index, columns, values, func="sum") returns pd.pivot_table(df, index=index, columns=columns, values=values, aggfunc=func)
+
 Based on this input, your output must be formatted as Python code:
 ```
 python
@@ -60,7 +68,7 @@ import matplotlib.pyplot as plt
 
 # Grouping the sales data by region
 # Note: The dataset 'df' is already defined, do not create dummy data.
-sales_by_region = df.groupby('Region')['Sales'].sum().reset_index()
+sales_by_region = aggregate('Region', 'Sales', 'sum')
 
 # Creating a bar chart for sales by region No need to save the chart(Do not use plt.savefig())
 plt.figure(figsize=(10, 6))
@@ -74,6 +82,62 @@ plt.close()# Do not use plt.show()
 NOTE: Generate only Python code, without any additional text or explanations. Always import the libraries you are using. Save all charts in the 'charts' folder. Additionally, remember that the dataset 'df' is already defined, do not create dummy data.Always use plt.close(),plt.savefig() after saving the chart.Do not use plt.show() since it will block the execution of the code.
 """
 
+COMBINED_CODEGEN_PROMPT="""
+You are a data analyst and data visualization expert. For each KPI you receive, write two Python programs that share the same
+grouping/aggregation logic, so the table and the chart always agree:
+- analysis_code: prints table like results for the KPI (print the aggregated data). Never generate charts in it.
+- chart_code: draws one matplotlib chart for the KPI. Import matplotlib.pyplot as plt, end with plt.close(), do not use plt.show() or plt.savefig().
+  If a chart is not possible, print "Chart not possible".
+
+The dataset is always named df and is already available in the environment, do not create sample or dummy data. Always import the libraries you are using.
+For group by / pivot results use the helpers that are already available in the environment (they are cached and shared between the programs):
+- aggregate(by, values=None, func="sum") returns df.groupby(by)[values].agg(func) with the group keys as columns (on df as it is when called, after your filters)
+- pivot(index, columns, values, func="sum") returns pd.pivot_table(df, index=index, columns=columns, values=values, aggfunc=func)
+
+For example, for the KPI "Sales by Region":
+analysis_code:
+import pandas as pd
+sales_by_region = aggregate('Region', 'Sales', 'sum')
+print(sales_by_region)
+
+chart_code:
+import matplotlib.pyplot as plt
+sales_by_region = aggregate('Region', 'Sales', 'sum')
+plt.figure(figsize=(10, 6))
+plt.bar(sales_by_region['Region'], sales_by_region['Sales'])
+plt.title('Sales by Region')
+plt.xlabel('Region')
+plt.ylabel('Sales')
+plt.close()
+
+Return the code as plain Python (no markdown fences), with kpi_name set to the KPI exactly as it was given.
+"""
+
+SQL_ENGINE_PROMPT="""
+A DuckDB engine is also available in the environment: sql(query) runs a SQL query and returns a pandas DataFrame.
+The dataset is registered as the table df. Prefer sql() for aggregations, filters and joins on the dataset since it is
+multi-threaded and much faster than pandas on large data, then use pandas/matplotlib on the (small) result. For example:
+```
+python
+sales_by_region = sql("SELECT Region, SUM(Sales) AS Sales FROM df GROUP BY Region ORDER BY Sales DESC")
+```
+Quote column names that contain spaces or special characters with double quotes, e.g. SELECT "Order Date" FROM df.
+"""
+
+OUT_OF_CORE_PROMPT="""
+IMPORTANT: This dataset is too large for memory, so df is NOT a pandas DataFrame but a lazy out-of-core frame.
+Its aggregations stream over the data on disk and return regular pandas objects. Supported on df:
+- df.columns, df.dtypes, df.shape, len(df), df.head(n)
+- df.groupby(by)[values].agg(func) / .sum() / .mean() / .count() / .min() / .max() / .size(), named aggregation agg(total=('Sales', 'sum'))
+  (func can only be sum, mean, count, min, max, size)
+- df.pivot_table(index=..., columns=..., values=..., aggfunc=...), df.value_counts(subset), df.describe()
+- df['col'].sum() / .mean() / .min() / .max() / .count() / .value_counts() / .nunique()
+- df.query("expression") to filter rows lazily, df[['a', 'b']] to select columns
+- df.sample(n) returns a pandas DataFrame of n random rows (e.g. for scatter plots)
+Boolean indexing (df[df['x'] > 0]), df.apply, df.merge and assigning new columns are NOT supported.
+Aggregate first, then work with the small pandas result.
+"""
+
 DEBUG_PROMPT="""
 You are a python debugging expert. Your task is to debug the given by looking at the error message , code and dataset.
 
@@ -0,0 +1,68 @@
+'''
+Optional DuckDB query engine for the generated analysis and visualization code.
+
+Note:
+1. Opt-in with QUERY_ENGINE=duckdb, pandas stays the default and duckdb is only imported when it is installed.
+2. df is registered in an in-memory DuckDB connection without copying it, so sql() runs multi-threaded
+   vectorized aggregations over it and returns a pandas DataFrame. Nothing leaves the machine.
+'''
+
+import os
+import pandas as pd
+
+try:
+    import duckdb # type: ignore
+except ImportError:
+    duckdb = None
+
+
+def is_duckdb_enabled() -> bool:
+    """
+    Check whether the DuckDB engine was requested and is available.
+    """
+    if os.getenv("QUERY_ENGINE", "pandas").strip().lower() != "duckdb":
+        return False
+    if duckdb is None:
+        print("QUERY_ENGINE=duckdb but duckdb is not installed, falling back to pandas")
+        return False
+    return True
+
+
+class QueryEngine:
+    """
+    An embedded DuckDB connection with the task dataframe registered as the table df.
+    """
+
+    def __init__(self, df, threads: int = None):
+        self.connection = duckdb.connect(database=":memory:")
+        threads = threads or int(os.getenv("QUERY_ENGINE_THREADS", os.cpu_count() or 1))
+        self.connection.execute(f"SET threads TO {threads}")
+        self.register("df", df)
+
+    def register(self, name: str, data):
+        """
+        Register a pandas DataFrame / Arrow table / dataset as a table. DuckDB scans it in place, nothing is copied.
+        """
+        self.connection.register(name, data)
+
+    def sql(self, query: str, params: list = None) -> pd.DataFrame:
+        """
+        This function is used to run a SQL query against df.
+
+        Args:
+            query: str - The SQL query, the dataset is the table df
+            params: list - Optional values for ? placeholders
+
+        Returns:
+            pd.DataFrame - The query result
+        """
+        return self.connection.execute(query, params or []).df()
+
+    def namespace(self) -> dict:
+        """
+        Return the helpers to expose to the generated code.
+        """
+        return {"sql": self.sql}
+
+    def close(self):
+        self.connection.close()
@@ -3,3 +3,13 @@ from pydantic import BaseModel
 
 class KPI(BaseModel):
     kpi_names:list[str]
+
+
+class KPICode(BaseModel):
+    kpi_name:str
+    analysis_code:str
+    chart_code:str
+
+
+class KPICodeBatch(BaseModel):
+    kpis:list[KPICode]
@@ -1,40 +1,100 @@
 '''
 Note:
-1.We will not be logging tokens usage since openai is already logging it, in a nice way.In future we might need a custom logging system.
+1.The tokens, latency, time to first token and retries of every model call are recorded per agent (see llm_telemetry.py),
+  logged with the task and rolled up in the task document as llm_usage.
 '''
 
-from contextlib import redirect_stdout
+import asyncio
+import json
+from contextlib import nullcontext, redirect_stdout
 from io import StringIO
 import pandas as pd
 import numpy as np
 import os
+import tempfile
+import time
 from database.get_client import get_client
 from fastapi import Request,HTTPException
 from datetime import datetime
-from utils.prompts import MANAGER_PROMPT,DATA_ANALYST,DEBUG_PROMPT,BUSINESS_ANALYST,VISUALIZER_PROMPT,SUMMARY_PROMPT
-from agents import Agent,Runner
-from utils.schemas import KPI
+from utils.prompts import MANAGER_PROMPT,DATA_ANALYST,DEBUG_PROMPT,BUSINESS_ANALYST,VISUALIZER_PROMPT,SUMMARY_PROMPT,SQL_ENGINE_PROMPT,OUT_OF_CORE_PROMPT,COMBINED_CODEGEN_PROMPT
+from agents import Agent,Runner,set_default_openai_client
+from openai.types.responses import ResponseTextDeltaEvent
+from utils.schemas import KPI, KPICode, KPICodeBatch
+from utils.code_validator import validate_code, CodeValidationError
+from utils.aggregation_cache import AggregationCache
+from utils.query_engine import QueryEngine
+from utils.profiler import DatasetProfile, build_dataset_profile
+from utils.log_sink import buffered_logs
+from utils.out_of_core import ChunkedFrame, download, get_file_size, is_out_of_core, out_of_core_available, open_chunked_frame, profile_chunked_frame
+from utils.memory_budget import MemoryBudget, MemoryBudgetExceeded, current_memory_budget, read_csv_sampled
+from utils.batch import verified_code, record_verified_code
+from utils.artifact_store import upload_chart
+from utils.storage import get_storage
+from utils.column_selector import prune_dataset_prompt
+from utils.metrics import span, record_span, record_debug_attempt
+from utils.llm_telemetry import record_llm_call, LLM_MAX_RETRIES, LLM_RETRY_BACKOFF, RETRYABLE_ERRORS
+from utils.prompt_builder import Prompt, build_prompt, compact_error_history
+from utils.chart_optimizer import optimize_chart, savefig_code, vision_data_uri, INSIGHTS_IMAGE_DETAIL
 from dotenv import load_dotenv
 import uuid
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 load_dotenv()
 
 os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")
 
+# The model calls retry the transient errors themselves (LLM_MAX_RETRIES) and record them, the client must not retry
+# underneath (its default of 2 retries per attempt would multiply the calls and hide them from the telemetry). One
+# client for the process: the agents and the Business Analyst
+openai_client = AsyncOpenAI(max_retries=0)
+set_default_openai_client(openai_client)
+
+# Number of KPIs analyzed per task
+MAX_KPIS = 3
+
 async def load_data(file_path_or_url: str, client: Request):
     """
     This function is used to load data from either a CSV file or a blob URL.
 
     Args:
-        file_path_or_url: str - Either a local file path or a blob URL
+        file_path_or_url: str - Either a local file path or a blob URL (of the local backend: read from disk)
         client: Request
 
     Returns:
-        df: pd.DataFrame
+        df: pd.DataFrame (a ChunkedFrame for files above OUT_OF_CORE_THRESHOLD_MB)
         columns: list
-        prompt: str
+        prompt: DatasetProfile
     """
+    # Blobs of the local storage backend are read from disk (memory-mapped), without the HTTP round trip
+    local_path = get_storage().local_path(file_path_or_url)
+    if local_path is not None:
+        file_path_or_url = local_path
+
+    # Files bigger than the worker's memory, or whose estimated size is over the task's memory budget, are never
+    # materialized: they are profiled and analyzed out-of-core (or sampled when pyarrow is missing)
+    # In a thread like the other blocking steps of the loading, a HEAD request to the blob for URLs
+    file_size = await asyncio.to_thread(get_file_size, file_path_or_url)
+    memory_budget = current_memory_budget.get() or MemoryBudget(budget_mb=0)
+    memory_budget.plan(file_size, out_of_core_available())
+    if is_out_of_core(file_size) or memory_budget.mode == "out_of_core":
+        memory_budget.mode = "out_of_core"
+        return await load_data_out_of_core(file_path_or_url, client)
+
+    if file_path_or_url.startswith('http') and memory_budget.mode == "sampled":
+        # Sampled like a local file: streamed to a temporary file and read chunk by chunk, the whole dataset is never
+        # downloaded into memory
+        file_descriptor, temporary_path = tempfile.mkstemp(suffix=".csv")
+        os.close(file_descriptor)
+        try:
+            with span("load_data:download"):
+                await asyncio.to_thread(download, file_path_or_url, temporary_path)
+            return await load_data(temporary_path, client)
+        except Exception as e:
+            print(f"Error loading data from blob URL: {e}")
+            return HTTPException(status_code=500, detail=f"Error loading data from blob URL: {e}")
+        finally:
+            os.remove(temporary_path)
+
     # Check if the input is a URL or a local path
     if file_path_or_url.startswith('http'):
         # It's a blob URL, so read directly from the blob
@@ -43,37 +103,34 @@ async def load_data(file_path_or_url: str, client: Request):
         
         try:
             # Download content from blob URL directly
-            response = requests.get(file_path_or_url)
-            response.raise_for_status()  # Raise exception for 4XX/5XX responses
+            with span("load_data:download"):
+                response = requests.get(file_path_or_url)
+                response.raise_for_status()  # Raise exception for 4XX/5XX responses
             
             # Read content directly into pandas using BytesIO
-            file_content = BytesIO(response.content)
-            df = pd.read_csv(file_content)
+            with span("load_data:parse"):
+                file_content = BytesIO(response.content)
+                df = pd.read_csv(file_content)
+                del file_content, response
+                df = memory_budget.fit_dataframe(df)
             columns = df.columns.tolist()
             
             if len(columns) == 0:
                 return HTTPException(status_code=500, detail="No columns found in the file, dataset unfit for analysis")
             
             # Generate prompt with dataset information
-            prompt = f"Here is the dataset description:\n"
-            for column in columns:
-                prompt += f"Column Name: {column}\n"
-                prompt += f"Null Values: {df[column].isnull().sum()}\n"
-                prompt += f"Data Type: {df[column].dtype}\n"
-                unique_values = df[column].unique().tolist()
-                num_to_show = min(20, len(unique_values))
-                prompt += f"Top {num_to_show} Unique Values: {unique_values[:num_to_show]}\n"
-                prompt += f"Number of Unique Values: {len(df[column].unique())}\n"
+            with span("load_data:profile"):
+                prompt = build_dataset_profile(df)
+                prompt.footer += memory_budget.sample_note()
             
             # Log to database
-            db = client['Python-Data-Analyst']
-            collection = db['logs']
+            collection = buffered_logs(client)
             dict = {
                 "timestamp": datetime.now(),
                 "file_path_or_url": file_path_or_url,
                 "columns": columns,
                 "message": "Data loaded successfully from blob URL",
-                "prompt": prompt
+                "prompt": str(prompt)
             }
             await collection.insert_one(dict)
             
@@ -89,25 +146,25 @@ async def load_data(file_path_or_url: str, client: Request):
         
         for encoding in encodings:
             try:
-                df = pd.read_csv(file_path_or_url, encoding=encoding)
+                with span("load_data:parse"):
+                    if memory_budget.mode == "sampled":
+                        # Over the memory budget without the out-of-core mode, only a random sample is kept
+                        df, total_rows = read_csv_sampled(file_path_or_url, encoding, memory_budget.sample_fraction())
+                    else:
+                        # Memory-mapped, the parser reads the page cache directly instead of copying the file into buffers
+                        df = pd.read_csv(file_path_or_url, encoding=encoding, memory_map=True)
+                        total_rows = None
+                    df = memory_budget.fit_dataframe(df, total_rows)
                 columns = df.columns.tolist()
 
                 if len(columns) == 0:
                     return HTTPException(status_code=500, detail="No columns found in the file, dataset unfit for analysis")
 
-                db = client['Python-Data-Analyst']
-                collection = db['logs']
+                collection = buffered_logs(client)
 
-                prompt = f"Here is the dataset description:\n"
-
-                for column in columns:
-                    prompt += f"Column Name: {column}\n"
-                    prompt += f"Null Values: {df[column].isnull().sum()}\n"
-                    prompt += f"Data Type: {df[column].dtype}\n"
-                    unique_values = df[column].unique().tolist()
-                    num_to_show = min(20, len(unique_values))
-                    prompt += f"Top {num_to_show} Unique Values: {unique_values[:num_to_show]}\n"
-                    prompt += f"Number of Unique Values: {len(df[column].unique())}\n"  
+                with span("load_data:profile"):
+                    prompt = build_dataset_profile(df)
+                    prompt.footer += memory_budget.sample_note()
 
                 dict = {
                     "timestamp": datetime.now(),
@@ -115,7 +172,7 @@ async def load_data(file_path_or_url: str, client: Request):
                     "encoding": encoding,
                     "columns": columns,
                     "message": "Data loaded successfully from local file",
-                    "prompt": prompt
+                    "prompt": str(prompt)
                 }
 
                 await collection.insert_one(dict) 
@@ -130,6 +187,208 @@ async def load_data(file_path_or_url: str, client: Request):
         print(f"Could not read file with any of the attempted encodings")
         return HTTPException(status_code=500, detail="Could not read file with any of the attempted encodings")
 
+async def load_data_out_of_core(file_path_or_url: str, client: Request):
+    """
+    This function is used to load a dataset that does not fit in memory as an on-disk Parquet dataset.
+
+    Args:
+        file_path_or_url: str - Either a local file path or a blob URL
+        client: Request
+
+    Returns:
+        df: ChunkedFrame
+        columns: list
+        prompt: DatasetProfile
+    """
+    collection = buffered_logs(client)
+
+    try:
+        # Download (for URLs) and convert the CSV to parquet, then profile it. Both take minutes on the files of this
+        # mode, they run in a thread so the loop keeps serving the other requests and the probes
+        with span("load_data:parse"):
+            frame = await asyncio.to_thread(open_chunked_frame, file_path_or_url)
+        with span("load_data:profile"):
+            columns, prompt = await asyncio.to_thread(profile_chunked_frame, frame)
+        memory_budget = current_memory_budget.get()
+        if memory_budget is not None:
+            memory_budget.mode = "out_of_core"
+            memory_budget.rows = len(frame)
+
+        if len(columns) == 0:
+            frame.close()
+            return HTTPException(status_code=500, detail="No columns found in the file, dataset unfit for analysis")
+
+        await collection.insert_one({
+            "timestamp": datetime.now(),
+            "file_path_or_url": file_path_or_url,
+            "encoding": frame.encoding,
+            "columns": columns,
+            "rows": len(frame),
+            "message": "Data loaded out-of-core as a parquet dataset",
+            "prompt": str(prompt)
+        })
+
+        return frame, columns, prompt
+
+    except Exception as e:
+        print(f"Error loading data out-of-core: {e}")
+        return HTTPException(status_code=500, detail=f"Error loading data out-of-core: {e}")
+
+def engine_instructions(instructions: str, namespace: dict) -> str:
+    """
+    Append the notes about the execution environment (DuckDB sql(), out-of-core df) to the agent instructions.
+
+    Args:
+        instructions: str - The base agent instructions
+        namespace: dict - The namespace the generated code will run in
+
+    Returns:
+        str - The instructions for the agent
+    """
+    if "sql" in namespace:
+        instructions += SQL_ENGINE_PROMPT
+    if isinstance(namespace.get("df"), ChunkedFrame):
+        instructions += OUT_OF_CORE_PROMPT
+    return instructions
+
+async def run_agent(agent:Agent, prompt:str, kpi_name:str=None, client:Request=None):
+    """
+    This function is used to run an agent, timed as the stage "agent:<agent name>". The output is streamed to
+    measure the time to the first token, transient provider errors are retried and the call is recorded
+    (tokens, latency, retries) with record_llm_call.
+
+    Args:
+        agent: Agent - The agent to run
+        prompt: str - The input
+        kpi_name: str - The KPI the call is for (optional)
+        client: Request - Database client, the call is logged when it is given (optional)
+
+    Returns:
+        The run result
+    """
+    started_at = datetime.now()
+    start = time.perf_counter()
+    retries = 0
+    ttft = None
+    result = None
+    status = "error"
+    try:
+        with span(f"agent:{agent.name}", kpi_name):
+            while True:
+                try:
+                    attempt_start = time.perf_counter()
+                    ttft = None
+                    result = Runner.run_streamed(agent, prompt)
+                    async for event in result.stream_events():
+                        if ttft is None and event.type == "raw_response_event" and isinstance(event.data, ResponseTextDeltaEvent):
+                            ttft = time.perf_counter() - attempt_start
+                    status = "success"
+                    return result
+                except RETRYABLE_ERRORS as e:
+                    if retries >= LLM_MAX_RETRIES:
+                        raise
+                    retries += 1
+                    await wait_before_retry(agent.name, retries, e)
+    finally:
+        usage = result.context_wrapper.usage if result is not None else None
+        call = record_llm_call(agent.name, str(agent.model), started_at, time.perf_counter() - start, ttft, usage,
+                               retries, status, kpi_name)
+        if client is not None:
+            await log_llm_call(buffered_logs(client), call)
+
+async def wait_before_retry(name:str, retries:int, error:Exception):
+    """
+    This function is used to wait before retrying a model call, LLM_RETRY_BACKOFF doubled on every retry.
+
+    Args:
+        name: str - The agent
+        retries: int - The retry about to be made (1 for the first one)
+        error: Exception - The transient error of the failed attempt
+    """
+    print(f"{name} call failed ({error}), retry {retries}/{LLM_MAX_RETRIES}")
+    await asyncio.sleep(LLM_RETRY_BACKOFF * 2 ** (retries - 1))
+
+async def log_llm_call(collection, call:dict):
+    """
+    This function is used to log the tokens, latency and retries of a model call.
+
+    Args:
+        collection: The logs collection
+        call: dict - The call, from record_llm_call
+    """
+    await collection.insert_one({
+        "timestamp": datetime.now(),
+        **call,
+        "status": "llm_call",
+        "call_status": call["status"],
+        "message": f"{call['agent']}: {call['input_tokens']} input / {call['output_tokens']} output tokens in {call['latency']}s"
+    })
+
+async def get_kpi_dataset_prompt(kpi_name:str, dataset_prompt:DatasetProfile, client:Request)->DatasetProfile:
+    """
+    This function is used to get the dataset description for the agents of a KPI, only the relevant columns
+    are described in full on wide datasets.
+
+    Args:
+        kpi_name: str - The KPI
+        dataset_prompt: DatasetProfile - The full dataset description
+        client: Request - Database client
+
+    Returns:
+        DatasetProfile - The dataset description for the KPI
+    """
+    prompt, selected_columns = prune_dataset_prompt(kpi_name, dataset_prompt)
+    if selected_columns:
+        collection = buffered_logs(client)
+        await collection.insert_one({
+            "timestamp": datetime.now(),
+            "kpi_name": kpi_name,
+            "status": "columns_pruned",
+            "selected_columns": selected_columns,
+            "message": f"Described {len(selected_columns)} relevant columns for KPI '{kpi_name}'"
+        })
+    return prompt
+
+async def get_verified_code(kind:str, kpi_name:str, collection):
+    """
+    This function is used to get the code of a KPI verified on another file of the same schema in the batch.
+
+    Args:
+        kind: str - analysis or chart
+        kpi_name: str - The KPI
+        collection: The logs collection
+
+    Returns:
+        str - The code, None outside of batches or when no file of the schema got there yet
+    """
+    code = verified_code(kind, kpi_name)
+    if code is not None:
+        await collection.insert_one({
+            "timestamp": datetime.now(),
+            "kpi_name": kpi_name,
+            "status": "code_reused",
+            "code_kind": kind,
+            "message": f"Reused the {kind} code verified on a file with the same schema"
+        })
+    return code
+
+async def log_prompt(collection, prompt:Prompt, kpi_name:str=None):
+    """
+    This function is used to log the size of a prompt before it is sent.
+
+    Args:
+        collection: The logs collection
+        prompt: Prompt - The assembled prompt
+        kpi_name: str - The KPI the prompt is for (optional)
+    """
+    await collection.insert_one({
+        "timestamp": datetime.now(),
+        "kpi_name": kpi_name,
+        "status": "prompt",
+        **prompt.log_fields(),
+        "message": f"{prompt.stage} prompt: {prompt.tokens} tokens (budget {prompt.budget})"
+    })
+
 async def get_kpi(prompt:str,client:Request)->list:
     """
     This function will be talking to the manager agent to get the set of kpi's
@@ -141,25 +400,25 @@ async def get_kpi(prompt:str,client:Request)->list:
     Returns:
         list
     """
+    collection = buffered_logs(client)
     try:
         #Initialize the manager agent
         agent_manager = Agent(name="Manager", instructions=MANAGER_PROMPT, model="gpt-4.1-mini-2025-04-14", output_type=KPI)
 
         #Run the manager agent
-        kpi_result = await Runner.run(agent_manager,prompt)
+        manager_prompt = build_prompt("manager", [("", prompt, True)])
+        await log_prompt(collection, manager_prompt)
+        kpi_result = await run_agent(agent_manager,manager_prompt.text,client=client)
 
         #Extract the kpi names from the kpi result
-        kpi_names = kpi_result.final_output.kpi_names[:3]
+        kpi_names = kpi_result.final_output.kpi_names[:MAX_KPIS]
 
         #Filter two kpi names for testing
         # kpi_names = kpi_names[:2]
 
-        db = client['Python-Data-Analyst']
-        collection = db['logs']
-
         dict={
             "timestamp":datetime.now(),
-            "prompt":prompt,
+            "prompt":str(prompt),
             "kpi_names":kpi_names,
             "message":"KPI's extracted successfully(get_kpi)"
         }
@@ -172,7 +431,7 @@ async def get_kpi(prompt:str,client:Request)->list:
         print(f"Error getting kpi: {e}")
         dict={
             "timestamp":datetime.now(),
-            "prompt":prompt,
+            "prompt":str(prompt),
             "message":f"Error getting kpi: {e}",
             "class":"get_kpi",
             "type":"error"
@@ -181,7 +440,131 @@ async def get_kpi(prompt:str,client:Request)->list:
         return HTTPException(status_code=500, detail=f"Error getting kpi: {e}")
   
 
-async def execute_with_debug(code, namespace, kpi_name, dataset_prompt, client:Request, max_attempts=3):
+class KPINameParser:
+    """
+    Incremental parser of the Manager agent's JSON output ({"kpi_names": ["...", ...]}), returns each name as
+    soon as its string is complete.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.position = None
+        self.decoder = json.JSONDecoder()
+
+    def feed(self, delta: str) -> list:
+        self.buffer += delta
+        if self.position is None:
+            # Wait for the start of the list
+            key = self.buffer.find('"kpi_names"')
+            start = self.buffer.find("[", key) if key != -1 else -1
+            if start == -1:
+                return []
+            self.position = start + 1
+
+        names = []
+        while True:
+            quote = self.buffer.find('"', self.position)
+            if quote == -1:
+                break
+            try:
+                name, end = self.decoder.raw_decode(self.buffer, quote)
+            except json.JSONDecodeError:
+                # The string is not complete yet
+                break
+            names.append(name)
+            self.position = end
+        return names
+
+
+async def stream_kpis(prompt:str, client:Request):
+    """
+    This function will be talking to the manager agent with a streamed output and yield each kpi as soon
+    as it is parsed, so the analysis of the first kpi can start before the manager has finished
+
+    Args:
+        prompt:str(This is detailed dataset description)
+        client:Request
+
+    Yields:
+        str - The kpi names (at most MAX_KPIS)
+    """
+    collection = buffered_logs(client)
+    kpi_names = []
+    try:
+        agent_manager = Agent(name="Manager", instructions=MANAGER_PROMPT, model="gpt-4.1-mini-2025-04-14", output_type=KPI)
+        manager_prompt = build_prompt("manager", [("", prompt, True)])
+        await log_prompt(collection, manager_prompt)
+
+        # Timed by hand, a span would also count the time the consumer spends between the yields
+        started_at = datetime.now()
+        start = time.perf_counter()
+        retries = 0
+        while True:
+            try:
+                attempt_start = time.perf_counter()
+                kpi_result = Runner.run_streamed(agent_manager, manager_prompt.text)
+                parser = KPINameParser()
+                ttft = None
+                async for event in kpi_result.stream_events():
+                    if event.type != "raw_response_event" or not isinstance(event.data, ResponseTextDeltaEvent):
+                        continue
+                    if ttft is None:
+                        ttft = time.perf_counter() - attempt_start
+                    for kpi_name in parser.feed(event.data.delta):
+                        if len(kpi_names) < MAX_KPIS and kpi_name not in kpi_names:
+                            if not kpi_names:
+                                record_span("agent:Manager:first_kpi", started_at, time.perf_counter() - start)
+                            kpi_names.append(kpi_name)
+                            yield kpi_name
+                    if len(kpi_names) >= MAX_KPIS:
+                        # The cap is reached, the rest of the output is not needed
+                        kpi_result.cancel()
+                        break
+                break
+            except RETRYABLE_ERRORS as e:
+                # Retried only until the first KPI is dispatched, a new run could name other KPIs
+                if kpi_names or retries >= LLM_MAX_RETRIES:
+                    raise
+                retries += 1
+                await wait_before_retry(agent_manager.name, retries, e)
+        record_span("agent:Manager", started_at, time.perf_counter() - start)
+        # The usage of a cancelled run only counts the tokens received so far
+        call = record_llm_call(agent_manager.name, agent_manager.model, started_at, time.perf_counter() - start, ttft,
+                               kpi_result.context_wrapper.usage, retries)
+        await log_llm_call(collection, call)
+
+        # Names the parser could have missed are in the final output (None when the run was cancelled)
+        final_output = kpi_result.final_output
+        for kpi_name in (final_output.kpi_names if isinstance(final_output, KPI) else []):
+            if len(kpi_names) < MAX_KPIS and kpi_name not in kpi_names:
+                kpi_names.append(kpi_name)
+                yield kpi_name
+
+        await collection.insert_one({
+            "timestamp":datetime.now(),
+            "prompt":str(prompt),
+            "kpi_names":kpi_names,
+            "message":"KPI's extracted successfully(stream_kpis)"
+        })
+    except Exception as e:
+        print(f"Error streaming kpi: {e}")
+        await collection.insert_one({
+            "timestamp":datetime.now(),
+            "prompt":str(prompt),
+            "kpi_names":kpi_names,
+            "message":f"Error streaming kpi: {e}",
+            "class":"stream_kpis",
+            "type":"error"
+        })
+        if kpi_names:
+            return
+        # Nothing was dispatched yet, fall back to the non-streamed call
+        fallback_names = await get_kpi(prompt, client)
+        if isinstance(fallback_names, list):
+            for kpi_name in fallback_names:
+                yield kpi_name
+
+async def execute_with_debug(code, namespace, kpi_name, dataset_prompt, client:Request, max_attempts=3, code_kind=None, aggregation_cache=None):
     """
     Execute code with debugging capabilities, retrying up to max_attempts times.
     
@@ -192,20 +575,47 @@ async def execute_with_debug(code, namespace, kpi_name, dataset_prompt, client:R
         dataset_prompt: Description of the dataset
         client: Database client
         max_attempts: Maximum number of debugging attempts
+        code_kind: analysis or chart, the code that runs is kept for the files of the same schema (batches)
+        aggregation_cache: The AggregationCache behind the helpers of the namespace, invalidated when the code
+                           modifies a frame in place
         
     Returns:
         The successfully executed code or the last attempted version
     """
-    agent_debug = Agent(name="Debug Agent", instructions=DEBUG_PROMPT, model="gpt-4.1-mini-2025-04-14", output_type=str)
+    # The Debug agent needs to know about sql() / the out-of-core df just like the agent that wrote the code
+    agent_debug = Agent(name="Debug Agent", instructions=engine_instructions(DEBUG_PROMPT, namespace), model="gpt-4.1-mini-2025-04-14", output_type=str)
     error_history = []  # Store error history for context
     current_code = code
     
-    db = client['Python-Data-Analyst']
-    collection = db['logs']
+    collection = buffered_logs(client)
+
+    # Columns of the profiled dataset, used to statically validate the code before running it
+    columns = list(namespace["df"].columns) if "df" in namespace else []
     
     for attempt in range(1, max_attempts + 1):
         try:
-            exec(current_code, namespace)
+            # Fix the trivial mistakes locally and fail fast on the rest, without running the code
+            current_code, validation_errors, fixes = validate_code(current_code, columns)
+            if fixes:
+                await collection.insert_one({
+                    "timestamp": datetime.now(),
+                    "kpi_name": kpi_name,
+                    "attempt": attempt,
+                    "status": "auto_fixed",
+                    "fixes": fixes,
+                    "code": current_code,
+                    "message": f"Applied {len(fixes)} automatic fixes on attempt {attempt}"
+                })
+            if validation_errors:
+                raise CodeValidationError("Static validation failed: " + "; ".join(validation_errors))
+
+            with span("exec", kpi_name), \
+                    (aggregation_cache.executing(current_code) if aggregation_cache is not None else nullcontext()):
+                exec(current_code, namespace)
+            # Frames left by the code count against the task's memory budget
+            memory_budget = current_memory_budget.get()
+            if memory_budget is not None:
+                memory_budget.check(kpi_name, namespace)
             print(f"Code for '{kpi_name}' executed successfully.")
             
             # Log successful execution
@@ -217,8 +627,14 @@ async def execute_with_debug(code, namespace, kpi_name, dataset_prompt, client:R
                 "code": current_code,
                 "message": f"Code executed successfully on attempt {attempt}"
             })
+            # Shared with the next files of the same schema in a batch
+            if code_kind is not None:
+                record_verified_code(code_kind, kpi_name, current_code)
             
             return current_code  # Return the successful code
+        except MemoryBudgetExceeded:
+            # Not a bug of the code, retrying with the Debug Agent would only use more memory
+            raise
         except Exception as e:
             error_message = str(e)
             print(f"Error in '{kpi_name}' (attempt {attempt}): {error_message}")
@@ -244,28 +660,20 @@ async def execute_with_debug(code, namespace, kpi_name, dataset_prompt, client:R
             })
             
             if attempt < max_attempts:
-                # Prepare error history context
-                error_context = ""
-                for entry in error_history:
-                    error_context += f"Attempt {entry['attempt']} for KPI '{entry['kpi']}':\n"
-                    error_context += f"Code: {entry['code']}\n"
-                    error_context += f"Error: {entry['error']}\n\n"
+                # Create debugging prompt: the dataset first (stable prefix), then the earlier attempts as one line
+                # each and the current code and error in full
+                prompt = build_prompt("debug", [
+                    ("", dataset_prompt, True),
+                    ("Current KPI", kpi_name, False),
+                    ("Error History", compact_error_history(error_history), False),
+                    ("Current Code", current_code, False),
+                    ("Current Error", error_message, False),
+                    ("", "Please fix the code to make it run successfully.", False),
+                ])
+                await log_prompt(collection, prompt, kpi_name)
                 
-                # Create debugging prompt with context
-                prompt = f"""
-                Current Error: {e}
-                Current Code: {current_code}
-                Current KPI: {kpi_name}
-                
-                Error History:
-                {error_context}
-                
-                Dataset: {dataset_prompt}
-                
-                Please fix the code to make it run successfully.
-                """
-                
-                result = await Runner.run(agent_debug, prompt)
+                record_debug_attempt()
+                result = await run_agent(agent_debug, prompt.text, kpi_name, client)
                 formatted_code = result.final_output
                 
                 # Extract code from AI response
@@ -306,7 +714,90 @@ async def execute_with_debug(code, namespace, kpi_name, dataset_prompt, client:R
     
     return current_code
 
-async def get_analysis(kpi_name:str, dataset_prompt:str, client:Request, df:pd.DataFrame)->str:
+def get_combined_codegen_mode() -> str:
+    """
+    Return the COMBINED_CODEGEN mode: "off" (separate Data Analyst and Visualization agents), "kpi" (one combined
+    call per KPI) or "batch" (one combined call for all the KPIs).
+    """
+    mode = os.getenv("COMBINED_CODEGEN", "off").strip().lower()
+    return mode if mode in ("off", "kpi", "batch") else "off"
+
+async def get_combined_code(kpi_names:list, dataset_prompt:str, client:Request, df:pd.DataFrame, query_engine:QueryEngine=None)->dict:
+    """
+    This function will be talking to the combined agent to get the analysis and chart code of the given kpis
+    in a single structured-output call
+
+    Args:
+        kpi_names: list - The KPIs (one for the "kpi" mode, all of them for the "batch" mode)
+        dataset_prompt: str - Dataset description
+        client: Request - Database client
+        df: pd.DataFrame - The dataframe the code will run on
+        query_engine: QueryEngine - DuckDB engine exposing sql() to the generated code (optional)
+
+    Returns:
+        dict - KPI name -> KPICode, KPIs missing from the output are left out (they fall back to the separate agents)
+    """
+    collection = buffered_logs(client)
+
+    try:
+        # Only used to pick the engine notes of the instructions
+        namespace = {"df": df}
+        if query_engine is not None:
+            namespace.update(query_engine.namespace())
+
+        batch = len(kpi_names) > 1
+        agent_combined = Agent(
+            name="Combined Code Agent",
+            instructions=engine_instructions(COMBINED_CODEGEN_PROMPT, namespace),
+            model="gpt-4.1-mini-2025-04-14",
+            output_type=KPICodeBatch if batch else KPICode
+        )
+        prompt = build_prompt("combined", [
+            ("", dataset_prompt, True),
+            ("Here are the KPIs to analyze" if batch else "Here is the KPI to analyze", "\n".join(kpi_names), False),
+        ])
+        await log_prompt(collection, prompt, kpi_names[0] if not batch else None)
+
+        combined_result = await run_agent(agent_combined, prompt.text, kpi_names[0] if not batch else None, client)
+        kpi_codes = combined_result.final_output.kpis if batch else [combined_result.final_output]
+
+        # Match the output to the requested names, the model may change the case or spacing
+        requested = {kpi_name.strip().lower(): kpi_name for kpi_name in kpi_names}
+        code_by_kpi = {}
+        for kpi_code in kpi_codes:
+            kpi_name = requested.get(kpi_code.kpi_name.strip().lower())
+            if kpi_name is None and not batch:
+                kpi_name = kpi_names[0]
+            if kpi_name is not None:
+                code_by_kpi[kpi_name] = kpi_code
+
+        await collection.insert_one({
+            "timestamp": datetime.now(),
+            "kpi_names": kpi_names,
+            "status": "agent_response_received",
+            "generated_kpis": list(code_by_kpi),
+            "message": f"Received analysis and chart code for {len(code_by_kpi)}/{len(kpi_names)} KPIs from the combined agent"
+        })
+
+        return code_by_kpi
+    except Exception as e:
+        error_message = str(e)
+        print(f"Error getting combined code: {error_message}")
+
+        await collection.insert_one({
+            "timestamp": datetime.now(),
+            "kpi_names": kpi_names,
+            "status": "error",
+            "error": error_message,
+            "class": "get_combined_code",
+            "type": "error",
+            "message": f"Error getting combined code: {error_message}"
+        })
+
+        # The KPIs fall back to the separate agents
+        return {}
+
+async def get_analysis(kpi_name:str, dataset_prompt:str, client:Request, df:pd.DataFrame, aggregation_cache:AggregationCache=None, query_engine:QueryEngine=None, code:str=None)->str:
     """
     This function will be talking to the data analyst agent to get the analysis for the given kpi
 
@@ -314,37 +805,56 @@ async def get_analysis(kpi_name:str, dataset_prompt:str, client:Request, df:pd.D
         kpi_name: str - The KPI to analyze
         client: Request - Database client
         df: pd.DataFrame - The dataframe to analyze
+        aggregation_cache: AggregationCache - Task wide memoized groupby/pivot helpers (optional)
+        query_engine: QueryEngine - DuckDB engine exposing sql() to the generated code (optional)
+        code: str - Analysis code from the combined agent (get_combined_code), the Data Analyst agent is skipped
 
     Returns:
         str - The analysis result
     """
-    db = client['Python-Data-Analyst']
-    collection = db['logs']
+    collection = buffered_logs(client)
     
     try:
         f1 = StringIO()
-        # Initialize the data analyst agent
-        agent_data_analyst = Agent(name="Data Analyst", instructions=DATA_ANALYST, model="gpt-4.1-mini-2025-04-14", output_type=str)
-        prompt=f"Here is the dataset description:\n{dataset_prompt}\n\nHere is the KPI to analyze:\n{kpi_name}"
-        # Run the data analyst agent
-        analysis_result = await Runner.run(agent_data_analyst, prompt)
-        
-        # Log agent response received
-        await collection.insert_one({
-            "timestamp": datetime.now(),
-            "kpi_name": kpi_name,
-            "status": "agent_response_received",
-            "raw_response": analysis_result.final_output,
-            "message": "Received analysis from Data Analyst agent"
-        })
-
-        clean_python_code = analysis_result.final_output.replace("```python", "").replace("```", "")
         # Create a namespace for the python code
+        if aggregation_cache is None:
+            aggregation_cache = AggregationCache(df)
         namespace = {"df": df, "pd": pd, "np": np}
+        namespace.update(aggregation_cache.namespace(namespace))
+        if query_engine is not None:
+            namespace.update(query_engine.namespace())
+
+        if code is None:
+            # Code that ran on another file with the same schema (batches), the agent is skipped
+            code = await get_verified_code("analysis", kpi_name, collection)
+        if code is None:
+            # Initialize the data analyst agent
+            agent_data_analyst = Agent(name="Data Analyst", instructions=engine_instructions(DATA_ANALYST, namespace), model="gpt-4.1-mini-2025-04-14", output_type=str)
+            prompt = build_prompt("analysis", [
+                ("", dataset_prompt, True),
+                ("Here is the KPI to analyze", kpi_name, False),
+            ])
+            await log_prompt(collection, prompt, kpi_name)
+            # Run the data analyst agent
+            analysis_result = await run_agent(agent_data_analyst, prompt.text, kpi_name, client)
+            code = analysis_result.final_output
+            
+            # Log agent response received
+            await collection.insert_one({
+                "timestamp": datetime.now(),
+                "kpi_name": kpi_name,
+                "status": "agent_response_received",
+                "raw_response": code,
+                "message": "Received analysis from Data Analyst agent"
+            })
+
+        clean_python_code = code.replace("```python", "").replace("```", "")
 
         # Execute with debugging and capture output
         with redirect_stdout(f1):
-            debugged_code = await execute_with_debug(clean_python_code, namespace, kpi_name, dataset_prompt, client)
+            with span("analysis:execute", kpi_name):
+                debugged_code = await execute_with_debug(clean_python_code, namespace, kpi_name, dataset_prompt, client,
+                                                         code_kind="analysis", aggregation_cache=aggregation_cache)
         
         output = f1.getvalue()
 
@@ -353,7 +863,7 @@ async def get_analysis(kpi_name:str, dataset_prompt:str, client:Request, df:pd.D
             "timestamp": datetime.now(),
             "kpi_name": kpi_name,
             "status": "success",
-            "analysis": analysis_result.final_output,
+            "analysis": code,
             "execution_output": output,
             "final_code": debugged_code,
             "message": "Analysis generated successfully"
@@ -380,7 +890,7 @@ async def get_analysis(kpi_name:str, dataset_prompt:str, client:Request, df:pd.D
         
         return HTTPException(status_code=500, detail=f"Error getting analysis: {error_message}")
 
-async def get_analysis_insights(kpi_name:str, client:Request, analysis_result:str, visualization_url:str=None)->str:
+async def get_analysis_insights(kpi_name:str, client:Request, analysis_result:str, visualization_url:str=None, image_bytes:bytes=None)->str:
     """
     This function will be talking to the business analyst agent to get the insights for the given kpi
     using both text analysis and visualization image if available
@@ -389,42 +899,81 @@ async def get_analysis_insights(kpi_name:str, client:Request, analysis_result:st
         kpi_name: str - The KPI to analyze
         client: Request - Database client
         analysis_result: str - The analysis result to get insights from
-        visualization_url: str - Optional URL to the visualization image
+        visualization_url: str - Optional URL to the visualization image, only used when image_bytes is not available
+        image_bytes: bytes - Optional chart (PNG/WebP) from the visualization stage, sent inline
 
     Returns:
         str - The insights
     """
-    db = client['Python-Data-Analyst']
-    collection = db['logs']
+    collection = buffered_logs(client)
+    image_source = "inline" if image_bytes else ("url" if visualization_url else None)
     
     try:
-        openai_client = OpenAI()
-        
         # Prepare content based on whether we have an image or not
         content = [
             { "type": "input_text", "text": BUSINESS_ANALYST + f"Here is the KPI to analyze:\n{kpi_name}\n\nHere is the analysis result:\n{analysis_result}" }
         ]
         
-        # Add image to content if available
-        if visualization_url:
+        # Add image to content if available, inline so the provider doesn't have to fetch our blob
+        image_start = time.perf_counter()
+        if image_bytes:
+            content.append({
+                "type": "input_image",
+                "image_url": await asyncio.to_thread(vision_data_uri, image_bytes),
+                "detail": INSIGHTS_IMAGE_DETAIL
+            })
+        elif visualization_url:
             content.append({
                 "type": "input_image",
-                "image_url": visualization_url
+                "image_url": visualization_url,
+                "detail": INSIGHTS_IMAGE_DETAIL
             })
+        image_seconds = time.perf_counter() - image_start
             
-        # Create the response using OpenAI client with multimodal input
-        response = openai_client.responses.create(
-            model="gpt-4.1-mini-2025-04-14",
-            input=[
-                {
-                    "role": "user",
-                    "content": content
-                }
-            ]
-        )
+        # Create the response using OpenAI client with multimodal input, streamed to measure the time to first token
+        model_start = time.perf_counter()
+        started_at = datetime.now()
+        with span("agent:Business Analyst", kpi_name):
+            ttft = None
+            response = None
+            retries = 0
+            try:
+                while True:
+                    try:
+                        attempt_start = time.perf_counter()
+                        stream = await openai_client.responses.create(
+                            model="gpt-4.1-mini-2025-04-14",
+                            input=[
+                                {
+                                    "role": "user",
+                                    "content": content
+                                }
+                            ],
+                            stream=True
+                        )
+                        ttft = None
+                        async for event in stream:
+                            if ttft is None and event.type == "response.output_text.delta":
+                                ttft = time.perf_counter() - attempt_start
+                            elif event.type == "response.completed":
+                                response = event.response
+                        break
+                    except RETRYABLE_ERRORS as e:
+                        if retries >= LLM_MAX_RETRIES:
+                            raise
+                        retries += 1
+                        await wait_before_retry("Business Analyst", retries, e)
+            finally:
+                call = record_llm_call("Business Analyst", "gpt-4.1-mini-2025-04-14", started_at,
+                                       time.perf_counter() - model_start, ttft,
+                                       response.usage if response is not None else None, retries,
+                                       status="success" if response is not None else "error", kpi_name=kpi_name)
+                await log_llm_call(collection, call)
+        
+        model_seconds = time.perf_counter() - model_start
         
         # Extract just the text content from the response
-        insights_text = response.output[0].content[0].text if response.output else "No insights generated"
+        insights_text = response.output_text if response is not None and response.output else "No insights generated"
         
         # Log successful insights generation
         await collection.insert_one({
@@ -432,7 +981,10 @@ async def get_analysis_insights(kpi_name:str, client:Request, analysis_result:st
             "kpi_name": kpi_name,
             "status": "success",
             "insights": insights_text,
-            "visualization_included": visualization_url is not None,
+            "visualization_included": image_source is not None,
+            "image_source": image_source,
+            "image_latency_seconds": image_seconds,
+            "model_latency_seconds": model_seconds,
             "message": "Business insights generated successfully with multimodal input"
         })
         
@@ -449,7 +1001,8 @@ async def get_analysis_insights(kpi_name:str, client:Request, analysis_result:st
             "error": error_message,
             "class": "get_analysis_insights",
             "type": "error",
-            "visualization_included": visualization_url is not None,
+            "visualization_included": image_source is not None,
+            "image_source": image_source,
             "message": f"Error getting analysis insights: {error_message}"
         })
         
@@ -473,7 +1026,7 @@ def sanitize_kpi_name(kpi_name: str) -> str:
     sanitized = '_'.join(filter(None, sanitized.split('_')))
     return sanitized
 
-async def get_visualization(kpi_name:str, dataset_prompt:str, client:Request, df:pd.DataFrame, blob_client:Request)->dict:
+async def get_visualization(kpi_name:str, dataset_prompt:str, client:Request, df:pd.DataFrame, blob_client:Request, aggregation_cache:AggregationCache=None, query_engine:QueryEngine=None, code:str=None)->dict:
     """
     This function will be talking to the visualization agent to get the visualization for the given kpi
     
@@ -482,13 +1035,16 @@ async def get_visualization(kpi_name:str, dataset_prompt:str, client:Request, df
         dataset_prompt: str - Dataset description
         client: Request - Database client
         df: pd.DataFrame - The dataframe to visualize
-        blob_client: Request - Azure blob storage client
+        blob_client: StorageBackend - Storage backend (see storage.py)
+        aggregation_cache: AggregationCache - Task wide memoized groupby/pivot helpers (optional)
+        query_engine: QueryEngine - DuckDB engine exposing sql() to the generated code (optional)
+        code: str - Chart code from the combined agent (get_combined_code), the Visualization agent is skipped
         
     Returns:
-        dict - Contains the file path of the saved visualization
+        dict - Contains the URL of the saved visualization and its size (chart), plus its bytes as image_bytes
+               and raster_bytes (PNG/WebP), which are not JSON serializable
     """
-    db = client['Python-Data-Analyst']
-    collection = db['logs']
+    collection = buffered_logs(client)
     
     try:
         f1 = StringIO()
@@ -498,15 +1054,32 @@ async def get_visualization(kpi_name:str, dataset_prompt:str, client:Request, df
         file_name = f"{sanitized_kpi_name}_{unique_id}.png"
         container_name = "images-analysis"
         
-        # Initialize the visualization agent
-        agent_visualization = Agent(name="Visualization Agent", instructions=VISUALIZER_PROMPT, model="gpt-4.1-mini-2025-04-14", output_type=str)
-        prompt = f"Here is the KPI to analyze:\n{kpi_name}\n\nHere is the dataset description:\n{dataset_prompt}"
-        
-        # Generate the visualization code
-        visualization_result = await Runner.run(agent_visualization, prompt)
+        # Create a namespace for the python code
+        if aggregation_cache is None:
+            aggregation_cache = AggregationCache(df)
+        namespace = {"df": df, "pd": pd, "np": np}
+        namespace.update(aggregation_cache.namespace(namespace))
+        if query_engine is not None:
+            namespace.update(query_engine.namespace())
+
+        if code is None:
+            code = await get_verified_code("chart", kpi_name, collection)
+        if code is None:
+            # Initialize the visualization agent
+            agent_visualization = Agent(name="Visualization Agent", instructions=engine_instructions(VISUALIZER_PROMPT, namespace), model="gpt-4.1-mini-2025-04-14", output_type=str)
+            # The dataset description comes first so the prompt shares its prefix with the other calls of the task
+            prompt = build_prompt("visualization", [
+                ("", dataset_prompt, True),
+                ("Here is the KPI to analyze", kpi_name, False),
+            ])
+            await log_prompt(collection, prompt, kpi_name)
+            
+            # Generate the visualization code
+            visualization_result = await run_agent(agent_visualization, prompt.text, kpi_name, client)
+            code = visualization_result.final_output
         
         # Clean the code
-        clean_python_code = visualization_result.final_output
+        clean_python_code = code
         if "```python" in clean_python_code:
             clean_python_code = clean_python_code.split("```python")[1].split("```")[0].strip()
         elif "```" in clean_python_code:
@@ -517,8 +1090,8 @@ async def get_visualization(kpi_name:str, dataset_prompt:str, client:Request, df
 
         clean_python_code = clean_python_code.replace("plt.savefig", "# plt.savefig")
             
-        # Add code to save figure to blob storage
-        save_code = f"\n# Save figure to blob storage\nplt.savefig('{file_name}')\n"
+        # Add code to save figure to blob storage (at the target DPI, plus an SVG when enabled)
+        save_code = savefig_code(file_name)
         
         # Insert save_code before plt.close() if it exists, otherwise append it
         if "plt.close()" in clean_python_code:
@@ -535,14 +1108,14 @@ async def get_visualization(kpi_name:str, dataset_prompt:str, client:Request, df
 
         print(clean_python_code)
 
-        # Create a namespace for the python code
-        namespace = {"df": df, "pd": pd, "np": np}
-
         # Execute the code
         with redirect_stdout(f1):
-            execution_result = await execute_with_debug(clean_python_code, namespace, kpi_name, dataset_prompt, client)
+            with span("chart:render", kpi_name):
+                execution_result = await execute_with_debug(clean_python_code, namespace, kpi_name, dataset_prompt, client,
+                                                            code_kind="chart", aggregation_cache=aggregation_cache)
         
         # Upload the visualization to blob storage
+        svg_file_name = os.path.splitext(file_name)[0] + ".svg"
         try:
             # Check if the file exists before trying to upload it
             if not os.path.exists(file_name):
@@ -566,16 +1139,21 @@ async def get_visualization(kpi_name:str, dataset_prompt:str, client:Request, df
                 
             container_client = blob_client.get_container_client(container_name)
             
-            # Upload the file to blob storage
-            blob_client = container_client.get_blob_client(file_name)
+            # Keep the chart bytes, the report and the insights stage reuse them instead of downloading the blob
             with open(file_name, "rb") as data:
-                blob_client.upload_blob(data, overwrite=True)
-            
-            # Get the URL of the uploaded blob
-            blob_url = blob_client.url
-            
-            # Remove the local file after uploading
-            os.remove(file_name)
+                image_bytes = data.read()
+            svg_bytes = None
+            if os.path.exists(svg_file_name):
+                with open(svg_file_name, "rb") as data:
+                    svg_bytes = data.read()
+
+            # Downscale and re-encode the chart, keeping the smallest format
+            with span("chart:optimize", kpi_name):
+                chart = await asyncio.to_thread(optimize_chart, image_bytes, svg_bytes)
+
+            # Upload the file to blob storage under its content hash (identical charts are stored once)
+            with span("chart:upload", kpi_name):
+                blob_url = upload_chart(container_client, chart.data, chart.extension)
             
             # Log successful visualization
             await collection.insert_one({
@@ -583,6 +1161,7 @@ async def get_visualization(kpi_name:str, dataset_prompt:str, client:Request, df
                 "kpi_name": kpi_name,
                 "status": "success",
                 "visualization_url": blob_url,
+                "chart": chart.stats(),
                 "final_code": execution_result,
                 "message": "Visualization generated and uploaded successfully"
             })
@@ -591,7 +1170,10 @@ async def get_visualization(kpi_name:str, dataset_prompt:str, client:Request, df
                 "status": "success",
                 "visualization_url": blob_url,
                 "kpi_name": kpi_name,
-                "message": "Visualization generated successfully"
+                "chart": chart.stats(),
+                "message": "Visualization generated successfully",
+                "image_bytes": chart.data,
+                "raster_bytes": chart.raster
             }
             
         except Exception as e:
@@ -617,6 +1199,11 @@ async def get_visualization(kpi_name:str, dataset_prompt:str, client:Request, df
                 "message": "Failed to upload visualization to blob storage",
                 "visualization_url": None  # No URL available since upload failed
             }
+        finally:
+            # Remove the local files, uploaded or not
+            for local_file in (file_name, svg_file_name):
+                if os.path.exists(local_file):
+                    os.remove(local_file)
                         
     except Exception as e:
         error_message = str(e)
@@ -654,11 +1241,12 @@ async def get_insights_from_openai(insights:str,client:Request)->str:
         str - The summary of insights
     """
     try:
-        db = client['Python-Data-Analyst']
-        collection = db['logs']
+        collection = buffered_logs(client)
         
         summary_agent = Agent(name="Summary Agent", instructions=SUMMARY_PROMPT, model="gpt-4.1-mini-2025-04-14", output_type=str)
-        summary_result = await Runner.run(summary_agent, insights)
+        prompt = build_prompt("summary", [("", insights, True)])
+        await log_prompt(collection, prompt)
+        summary_result = await run_agent(summary_agent, prompt.text, client=client)
         
         # Log successful summary generation
         await collection.insert_one({
@@ -0,0 +1,235 @@
+'''
+Storage backends for the uploaded files and the task artifacts.
+
+Note:
+1. STORAGE_BACKEND selects azure (Blob Storage, BLOB_STORAGE_ACCOUNT_KEY) or local (files under STORAGE_LOCAL_ROOT,
+   for single-node deployments and benchmarks). Both expose the part of the azure.storage.blob API the app uses
+   (get_container_client / get_blob_client / upload_blob / exists / url), so artifact_store works with either.
+2. The URL format belongs to the backend: parse_url replaces the container/blob splitting and local_path returns the
+   file behind a URL of the local backend, so load_data reads it memory-mapped instead of downloading it over HTTP.
+3. Local blobs are served by GET /storage/{container}/{blob} with the content type, encoding and cache control they
+   were uploaded with, kept next to the blob in a .meta.json file.
+'''
+
+import json
+import mmap
+import os
+import tempfile
+from types import SimpleNamespace
+from urllib.parse import quote, unquote, urlparse
+
+try:
+    from azure.storage.blob import BlobServiceClient, ContentSettings # type: ignore
+except ImportError:
+    BlobServiceClient = None
+    ContentSettings = None
+
+METADATA_SUFFIX = ".meta.json"
+
+
+def memory_map(path: str):
+    """
+    Map a file read-only, the readers get its pages from the page cache without a copy (empty files give b"").
+    """
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def content_settings(**fields):
+    """
+    Content settings of an upload (content_type, content_encoding, cache_control): azure's ContentSettings when the
+    package is installed, the local backend reads the same attributes from a plain namespace.
+    """
+    return ContentSettings(**fields) if ContentSettings is not None else SimpleNamespace(**fields)
+
+
+class StorageBackend:
+    """
+    Interface of the storage backends.
+    """
+
+    name = None
+
+    def get_container_client(self, container: str):
+        raise NotImplementedError
+
+    def get_blob_client(self, container: str, blob: str):
+        raise NotImplementedError
+
+    def parse_url(self, url: str) -> tuple:
+        """
+        Split a blob URL into its container and blob name.
+        """
+        path_parts = unquote(urlparse(url).path).strip('/').split('/')
+        return path_parts[0], '/'.join(path_parts[1:])
+
+    def local_path(self, url: str):
+        """
+        Return the local file of a blob URL, None when the blob is not on this machine.
+        """
+        return None
+
+    def read(self, url: str):
+        """
+        Return the content of a blob (bytes, or a read-only mmap for local blobs).
+        """
+        container, blob = self.parse_url(url)
+        return self.get_blob_client(container, blob).download_blob().readall()
+
+
+class AzureStorage(StorageBackend):
+    """
+    Azure Blob Storage, a thin wrapper of BlobServiceClient.
+    """
+
+    name = "azure"
+
+    def __init__(self, connection_string: str = None):
+        connection_string = connection_string or os.getenv("BLOB_STORAGE_ACCOUNT_KEY")
+        if not connection_string:
+            raise ValueError("BLOB_STORAGE_ACCOUNT_KEY environment variable is not set")
+        if BlobServiceClient is None:
+            raise ValueError("azure-storage-blob is not installed, set STORAGE_BACKEND=local or install it")
+        self.service_client = BlobServiceClient.from_connection_string(connection_string)
+
+    def get_container_client(self, container: str):
+        return self.service_client.get_container_client(container)
+
+    def get_blob_client(self, container: str, blob: str):
+        return self.service_client.get_blob_client(container=container, blob=blob)
+
+
+class LocalBlobClient:
+    def __init__(self, storage, container: str, blob: str):
+        self.storage = storage
+        self.container = container
+        self.blob = blob
+        self.path = storage.blob_path(container, blob)
+        self.url = f"{storage.base_url}/{quote(container)}/{quote(blob)}"
+
+    def upload_blob(self, data, overwrite: bool = False, content_settings=None, **kwargs):
+        if not overwrite and os.path.exists(self.path):
+            raise FileExistsError(f"Blob {self.container}/{self.blob} already exists")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        # Written next to the blob and renamed, readers never see a partial file
+        descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".upload-")
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                if isinstance(data, (bytes, bytearray, memoryview)):
+                    file.write(data)
+                elif hasattr(data, "read"):
+                    for chunk in iter(lambda: data.read(8 * 1024 * 1024), b""):
+                        file.write(chunk)
+                else:
+                    for chunk in data:
+                        file.write(chunk)
+            # mkstemp creates the file readable by its owner only
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        metadata = {
+            "content_type": getattr(content_settings, "content_type", None),
+            "content_encoding": getattr(content_settings, "content_encoding", None),
+            "cache_control": getattr(content_settings, "cache_control", None),
+        }
+        with open(self.path + METADATA_SUFFIX, "w") as file:
+            json.dump(metadata, file)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def get_metadata(self) -> dict:
+        try:
+            with open(self.path + METADATA_SUFFIX) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def download_blob(self):
+        return SimpleNamespace(readall=lambda: bytes(memory_map(self.path)))
+
+
+class LocalContainerClient:
+    def __init__(self, storage, container: str):
+        self.storage = storage
+        self.container = container
+
+    def get_blob_client(self, blob: str) -> LocalBlobClient:
+        return LocalBlobClient(self.storage, self.container, blob)
+
+
+class LocalStorage(StorageBackend):
+    """
+    Blobs stored as files under STORAGE_LOCAL_ROOT/<container>/<blob>.
+    """
+
+    name = "local"
+
+    def __init__(self, root: str = None, base_url: str = None):
+        self.root = os.path.abspath(root or os.getenv("STORAGE_LOCAL_ROOT", "storage"))
+        # Public address of GET /storage, relative by default (the reports and the API share the host)
+        self.base_url = (base_url or os.getenv("STORAGE_PUBLIC_URL", "/storage")).rstrip("/")
+        os.makedirs(self.root, exist_ok=True)
+
+    def blob_path(self, container: str, blob: str) -> str:
+        path = os.path.abspath(os.path.join(self.root, container, blob))
+        # Names come from URLs, they must not escape the root
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"Invalid blob name {container}/{blob}")
+        return path
+
+    def get_container_client(self, container: str) -> LocalContainerClient:
+        return LocalContainerClient(self, container)
+
+    def get_blob_client(self, container: str, blob: str) -> LocalBlobClient:
+        return LocalBlobClient(self, container, blob)
+
+    def parse_url(self, url: str) -> tuple:
+        path = url[len(self.base_url):] if url.startswith(self.base_url + "/") else urlparse(url).path
+        path_parts = unquote(path).strip('/').split('/')
+        return path_parts[0], '/'.join(path_parts[1:])
+
+    def local_path(self, url: str):
+        if not url.startswith(self.base_url + "/"):
+            return None
+        try:
+            path = self.blob_path(*self.parse_url(url))
+        except ValueError:
+            return None
+        return path if os.path.exists(path) else None
+
+    def read(self, url: str):
+        path = self.local_path(url)
+        if path is None:
+            raise FileNotFoundError(f"Blob not found: {url}")
+        return memory_map(path)
+
+
+_storage = None
+
+
+def get_storage() -> StorageBackend:
+    """
+    Return the process wide storage backend (STORAGE_BACKEND: azure or local).
+    """
+    global _storage
+    if _storage is None:
+        backend = os.getenv("STORAGE_BACKEND", "azure").strip().lower()
+        _storage = LocalStorage() if backend == "local" else AzureStorage()
+    return _storage
+
+
+def set_storage(storage: StorageBackend) -> StorageBackend:
+    """
+    Replace the storage backend (benchmarks), returns the previous one.
+    """
+    global _storage
+    previous, _storage = _storage, storage
+    return previous
@@ -0,0 +1,223 @@
+'''
+Warm-up of a worker, so the first analysis after a deploy or scale-out doesn't pay the cold start.
+
+Note:
+1. The lifespan of app.py starts warm_up after the database setup: it loads the landing page (bytes + ETag, served
+   from memory afterwards), imports the analysis stack that run_analysis imports lazily (agents SDK, pandas,
+   matplotlib, seaborn...), builds the Matplotlib font cache by rendering a text figure, and opens the pooled
+   clients (MongoDB, storage backend).
+2. The blocking steps run in a thread, the event loop keeps answering the probes meanwhile. ReadinessGate holds the
+   other requests until the warm-up is done (WARMUP_GATE_TIMEOUT seconds at most, then 503 with Retry-After).
+3. A failed step is recorded and the warm-up goes on: the worker is ready, the step is paid by the first task as
+   before. Step durations are in GET /warmup and the warmup_step_seconds gauge (import time per module).
+'''
+
+import asyncio
+import hashlib
+import importlib
+import os
+import sys
+import time
+from datetime import datetime
+from utils.metrics import metrics_enabled
+
+try:
+    from prometheus_client import Gauge # type: ignore
+except ImportError:
+    Gauge = None
+
+LANDING_PAGE_PATH = os.path.join("templates", "index.html")
+
+# Imported lazily by run_analysis and the generated code, in import order
+ANALYSIS_MODULES = (
+    "pandas",
+    "numpy",
+    "matplotlib.pyplot",
+    "seaborn",
+    "openai",
+    "agents",
+    "utils.services",
+    "utils.html_report_generator",
+    "utils.artifact_store",
+    "utils.query_engine",
+    "utils.aggregation_cache",
+    "utils.out_of_core",
+)
+
+# Requests served while warming up (liveness and monitoring)
+UNGATED_PATHS = ("/health", "/health/live", "/health/ready", "/metrics", "/warmup")
+
+WARMUP_GATE_TIMEOUT = float(os.getenv("WARMUP_GATE_TIMEOUT", "30"))
+
+if metrics_enabled() and Gauge is not None:
+    WARMUP_STEP_SECONDS = Gauge("warmup_step_seconds", "Duration of the warm-up steps of the worker", ["step"])
+
+
+class LandingPage:
+    """
+    The landing page, read once and served from memory with an ETag.
+    """
+
+    def __init__(self, path: str = LANDING_PAGE_PATH):
+        self.path = path
+        self.body = None
+        self.etag = None
+
+    def load(self):
+        with open(self.path, "rb") as file:
+            self.body = file.read()
+        self.etag = '"' + hashlib.sha256(self.body).hexdigest()[:32] + '"'
+
+    def get(self) -> tuple:
+        """
+        Return the body and ETag of the page (loaded on first use when the warm-up didn't do it).
+        """
+        if self.body is None:
+            self.load()
+        return self.body, self.etag
+
+
+landing_page = LandingPage()
+
+warmup_state = {
+    "status": "pending",
+    "started_at": None,
+    "duration": None,
+    "steps": {},
+    "import_seconds": {},
+    "errors": {},
+}
+
+_ready = None
+
+
+def ready_event() -> asyncio.Event:
+    global _ready
+    if _ready is None:
+        _ready = asyncio.Event()
+    return _ready
+
+
+def is_ready() -> bool:
+    return warmup_state["status"] in ("ready", "degraded")
+
+
+def record_step(step: str, seconds: float, error: Exception = None):
+    warmup_state["steps"][step] = round(seconds, 4)
+    if error is not None:
+        warmup_state["errors"][step] = f"{type(error).__name__}: {error}"
+    if metrics_enabled() and Gauge is not None:
+        WARMUP_STEP_SECONDS.labels(step=step).set(seconds)
+
+
+def import_analysis_stack() -> dict:
+    """
+    This function is used to import the modules of the analysis, timing each one.
+
+    Returns:
+        dict - Import seconds per module (0 for the modules that were already imported)
+    """
+    import_seconds = {}
+    for module in ANALYSIS_MODULES:
+        start = time.perf_counter()
+        try:
+            if module not in sys.modules:
+                importlib.import_module(module)
+        except Exception as e:
+            # seaborn is only used by some generated code, a missing package is not a failure of the worker
+            if not (isinstance(e, ImportError) and module == "seaborn"):
+                warmup_state["errors"][f"import:{module}"] = f"{type(e).__name__}: {e}"
+        import_seconds[module] = round(time.perf_counter() - start, 4)
+    return import_seconds
+
+
+def build_font_cache():
+    """
+    Load (or build, on a fresh machine) the Matplotlib font cache and render a text figure to fill the glyph caches.
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    figure = Figure(figsize=(2, 2))
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+    axes.set_title("Warm-up")
+    axes.plot([0, 1], [0, 1], label="series")
+    axes.legend()
+    figure.canvas.draw()
+
+
+async def open_clients():
+    """
+    Create the process wide clients: the MongoDB pool and the storage backend.
+    """
+    from database.get_client import get_client
+    from utils.storage import get_storage
+
+    client = await get_client()
+    if client is None:
+        warmup_state["errors"]["clients:mongodb"] = "MongoDB client unavailable (uri not set)"
+    else:
+        # The pool connects lazily, the ping opens its first connection
+        await client.admin.command("ping")
+    try:
+        get_storage()
+    except ValueError as e:
+        # Not configured (no Azure key): the uploads fail as before, the worker still serves the rest
+        warmup_state["errors"]["clients:storage"] = str(e)
+
+
+async def warm_up():
+    """
+    This function is used to warm the worker up, then open the readiness gate.
+    """
+    warmup_state["status"] = "running"
+    warmup_state["started_at"] = datetime.now()
+    start = time.perf_counter()
+
+    async def step(name: str, function, *args, blocking: bool = True):
+        step_start = time.perf_counter()
+        result, error = None, None
+        try:
+            result = await asyncio.to_thread(function, *args) if blocking else await function(*args)
+        except Exception as e:
+            error = e
+            print(f"Warm-up step {name} failed: {e}")
+        record_step(name, time.perf_counter() - step_start, error)
+        return result
+
+    try:
+        await step("landing_page", landing_page.load)
+        import_seconds = await step("imports", import_analysis_stack)
+        for module, seconds in (import_seconds or {}).items():
+            warmup_state["import_seconds"][module] = seconds
+            if metrics_enabled() and Gauge is not None:
+                WARMUP_STEP_SECONDS.labels(step=f"import:{module}").set(seconds)
+        await step("font_cache", build_font_cache)
+        await step("clients", open_clients, blocking=False)
+    finally:
+        warmup_state["duration"] = round(time.perf_counter() - start, 4)
+        warmup_state["status"] = "degraded" if warmup_state["errors"] else "ready"
+        ready_event().set()
+        print(f"Warm-up {warmup_state['status']} in {warmup_state['duration']}s")
+
+
+class ReadinessGate:
+    """
+    ASGI middleware holding the requests until the warm-up is done.
+    """
+
+    def __init__(self, app, timeout: float = WARMUP_GATE_TIMEOUT):
+        self.app = app
+        self.timeout = timeout
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and not is_ready() and scope["path"] not in UNGATED_PATHS:
+            try:
+                await asyncio.wait_for(ready_event().wait(), self.timeout)
+            except asyncio.TimeoutError:
+                await send({"type": "http.response.start", "status": 503,
+                            "headers": [(b"content-type", b"text/plain"), (b"retry-after", b"5")]})
+                await send({"type": "http.response.body", "body": b"Warming up"})
+                return
+        await self.app(scope, receive, send)